@@ -1,18 +1,48 @@
 import dash
-from dash import dcc, html, Input, Output, State, ALL
+from dash import dcc, html, dash_table, Input, Output, State, ALL, Patch
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objs as go
-from plotly.subplots import make_subplots
-import io
-import base64
+import os
+import functools
 import logging
 
+import aggcache
+import backends
+import charts
+import compare
+import compression
+import datastore
+import dbsource
+import drilldown
+import dropfolder
+import eventstore
+import exchangecube
+import exports
+import figpatch
+import funnel
+import generations
+import governor
+import imagecache
+import ingest
+import lod
+import preview
+import rowview
+import typeahead
+import warmer
+import workbooks
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 app = dash.Dash(__name__, suppress_callback_exceptions=True)
+server = app.server
+governor.register_routes(server)
+compression.register(server)
+exports.register_routes(server)
+imagecache.register_routes(server)
+dropfolder.start()
 
 # Layout for Page 1 (Welcome Page)
 layout_page1 = html.Div([
@@ -24,9 +54,28 @@ layout_page1 = html.Div([
             multiple=False,
             style={'display': 'inline-block'}
         ),
+        # Only shown when ETBR_DB_PATH points at the DMS database
+        html.Button('Load From Database', id='page1-load-database', n_clicks=0,
+                    style={'fontSize': '20px', 'marginLeft': '10px', 'display': 'inline-block' if dbsource.enabled() else 'none'}),
+        # Server-rendered images instead of figure JSON; remembered per browser, shown when kaleido is installed
+        dcc.Checklist(id='page1-static-mode', options=[{'label': ' Static images (slow connections)', 'value': 'static'}], value=[],
+                      persistence=True, persistence_type='local',
+                      style={'fontSize': '16px', 'marginLeft': '10px', 'display': 'inline-block' if imagecache.available() else 'none'}),
         html.Div(id='page1-output-data-upload', style={'display': 'inline-block', 'marginLeft': '10px', 'verticalAlign': 'middle'})
     ], style={'display': 'flex', 'alignItems': 'center', 'marginBottom': '10px'}),
     dcc.Store(id='page1-stored-data'),
+    dcc.Store(id='page1-figure-signatures'),
+    # The debounced filter values; see generations.py
+    dcc.Store(id='page1-filter-settled'),
+    # Polls the drop folder's dataset key; only runs when ETBR_WATCH_DIR is set
+    dcc.Interval(id='page1-folder-interval', interval=dropfolder.WATCH_INTERVAL * 1000, disabled=not dropfolder.enabled()),
+    dcc.Store(id='page1-folder-version'),
+    # Polls the background parse of a previewed upload; enabled only while it runs
+    dcc.Interval(id='page1-preview-interval', interval=preview.POLL_INTERVAL * 1000, disabled=True),
+    dcc.Store(id='page1-preview-ready'),
+    # Polls the background build of the exact charts after 'Load Full Detail'; see lod.py
+    dcc.Interval(id='page1-detail-interval', interval=lod.POLL_INTERVAL * 1000, disabled=True),
+    dcc.Store(id='page1-detail-job'),
     html.Div([
         html.Div([
             dcc.Dropdown(
@@ -40,7 +89,10 @@ layout_page1 = html.Div([
                     {'label': 'Team vs ETBR', 'value': 'Team vs Enquiry, Booking, Test Drive, Retail'},
                     {'label': 'Team vs Enquiry Type ETBR', 'value': 'Team vs Enquiry Type Report'},
                     {'label': 'Walk In ETBR', 'value': 'Walk In ETBR'},
-                    {'label': 'All Visualisations', 'value': 'All Visualisations'}
+                    {'label': 'All Visualisations', 'value': 'All Visualisations'},
+                    {'label': 'Drill Down', 'value': drilldown.VIEW},
+                    {'label': 'Compare', 'value': compare.VIEW},
+                    {'label': 'Funnel & Leaderboard', 'value': funnel.VIEW}
                 ],
                 placeholder='Select Visualization',
                 style={'width': '200px', 'fontSize': '16px', 'textAlign': 'left'}
@@ -50,6 +102,8 @@ layout_page1 = html.Div([
             dcc.Dropdown(
                 id='page1-location-dropdown',
                 placeholder='Select Location',
+                # Options come from the server as you type; keep its ranking
+                search_order='original',
                 style={'width': '200px', 'fontSize': '16px', 'textAlign': 'left'}
             )
         ], style={'display': 'inline-block', 'marginRight': '10px'}),
@@ -57,6 +111,8 @@ layout_page1 = html.Div([
             dcc.Dropdown(
                 id='page1-sales-manager-dropdown',
                 placeholder='Select Sales Manager',
+                # Options come from the server as you type; keep its ranking
+                search_order='original',
                 style={'width': '350px', 'fontSize': '16px', 'textAlign': 'left'}
             )
         ], style={'display': 'inline-block', 'marginRight': '10px'}),
@@ -64,11 +120,131 @@ layout_page1 = html.Div([
             dcc.Dropdown(
                 id='page1-consultant-dropdown',
                 placeholder='Select Sales Consultant',
+                # Options come from the server as you type; keep its ranking
+                search_order='original',
                 style={'width': '350px', 'fontSize': '16px', 'textAlign': 'left'}
             )
+        ], style={'display': 'inline-block', 'marginRight': '10px'}),
+        # Only used for uploads with dated events; exports carry fixed MTD/LMTD columns
+        html.Div([
+            dcc.Dropdown(
+                id='page1-period-dropdown',
+                options=[{'label': period, 'value': period} for period in eventstore.PERIODS],
+                value='MTD',
+                clearable=False,
+                style={'width': '120px', 'fontSize': '16px', 'textAlign': 'left'}
+            )
+        ], style={'display': 'inline-block', 'marginRight': '10px'}),
+        html.Div([
+            dcc.DatePickerRange(id='page1-period-range')
         ], style={'display': 'inline-block'})
     ], style={'textAlign': 'left'}),
+    html.Div([
+        dcc.Dropdown(
+            id='page1-download-format',
+            options=[{'label': 'CSV', 'value': 'csv'}, {'label': 'Parquet', 'value': 'parquet'}, {'label': 'Excel', 'value': 'xlsx'}],
+            value='csv',
+            clearable=False,
+            style={'width': '120px', 'fontSize': '16px', 'textAlign': 'left'}
+        ),
+        html.Button('Download Aggregates', id='page1-download-aggregates-button', n_clicks=0,
+                    style={'fontSize': '16px', 'marginLeft': '10px'}),
+        # Raw rows are streamed by a Flask route (see exports.py), not sent through the callback
+        html.A(html.Button('Download Rows', style={'fontSize': '16px'}), id='page1-download-rows-link',
+               style={'marginLeft': '10px', 'display': 'none'}),
+        dcc.Download(id='page1-download-aggregates'),
+        # Only shown while a chart is drawn with less detail to answer quickly
+        html.Button('Load Full Detail', id='page1-full-detail', n_clicks=0,
+                    style={'fontSize': '16px', 'marginLeft': '10px', 'display': 'none'})
+    ], style={'display': 'flex', 'alignItems': 'center', 'marginTop': '10px'}),
     html.Div(id='page1-visualization-container'),
+    # Rows behind the charts; clicking a bar or slice narrows them to its category
+    html.Div([
+        html.Div(id='page1-rows-caption', style={'marginTop': '20px', 'marginBottom': '10px', 'fontSize': '16px'}),
+        dash_table.DataTable(
+            id='page1-rows-table',
+            page_current=0,
+            page_size=rowview.PAGE_SIZE,
+            page_action='custom',
+            sort_action='custom',
+            sort_mode='multi',
+            sort_by=[],
+            filter_action='custom',
+            filter_query='',
+            style_table={'overflowX': 'auto'},
+            style_cell={'fontSize': '13px', 'textAlign': 'left'}
+        ),
+        dcc.Store(id='page1-rows-category', data={})
+    ], id='page1-rows-container', style={'display': 'none'}),
+    # Click-driven drill-down, shown when 'Drill Down' is selected
+    html.Div([
+        dcc.RadioItems(id='page1-drill-chart', options=drilldown.CHART_TYPES, value='Bar', inline=True,
+                       style={'fontSize': '16px', 'marginTop': '10px'}),
+        html.Div(id='page1-drill-breadcrumb', style={'marginTop': '10px', 'fontSize': '16px'}),
+        dcc.Graph(id='page1-drill-graph', style={'width': '90vw', 'height': '600px'}),
+        html.Div(id='page1-drill-description', style={
+            'marginTop': '20px',
+            'padding': '15px',
+            'backgroundColor': '#f0f0f0',
+            'borderRadius': '5px',
+            'boxShadow': '0 2px 4px rgba(0,0,0,0.1)',
+            'fontSize': '14px',
+            'lineHeight': '1.5',
+            'whiteSpace': 'pre-wrap'
+        }),
+        dcc.Store(id='page1-drill-path', data=[])
+    ], id='page1-drill-container', style={'display': 'none'}),
+    # Small multiples for several entities, shown when 'Compare' is selected
+    html.Div([
+        html.Div([
+            dcc.RadioItems(id='page1-compare-dimension', options=compare.DIMENSIONS, value='Dealer Location', inline=True,
+                           style={'fontSize': '16px'}),
+            dcc.Dropdown(id='page1-compare-entities', multi=True, placeholder='Select values to compare',
+                         style={'width': '700px', 'fontSize': '16px', 'textAlign': 'left', 'marginTop': '10px'})
+        ], style={'marginTop': '10px'}),
+        dcc.Graph(id='page1-compare-graph', style={'width': '90vw'}),
+        html.Div(id='page1-compare-description', style={
+            'marginTop': '20px',
+            'padding': '15px',
+            'backgroundColor': '#f0f0f0',
+            'borderRadius': '5px',
+            'boxShadow': '0 2px 4px rgba(0,0,0,0.1)',
+            'fontSize': '14px',
+            'lineHeight': '1.5',
+            'whiteSpace': 'pre-wrap'
+        })
+    ], id='page1-compare-container', style={'display': 'none'}),
+    # Conversion funnel and a server-paged leaderboard, shown when 'Funnel & Leaderboard' is selected
+    html.Div([
+        html.Div([
+            dcc.RadioItems(id='page1-funnel-dimension', options=funnel.LEVELS, value='Sales Consultant', inline=True,
+                           style={'fontSize': '16px'}),
+            dcc.Dropdown(id='page1-funnel-rank', options=funnel.RANK_BY, value='E→R %', clearable=False,
+                         style={'width': '300px', 'fontSize': '16px', 'textAlign': 'left', 'marginTop': '10px'})
+        ], style={'marginTop': '10px'}),
+        dcc.Graph(id='page1-funnel-graph', style={'width': '90vw'}),
+        html.Div(id='page1-funnel-description', style={
+            'marginTop': '20px',
+            'padding': '15px',
+            'backgroundColor': '#f0f0f0',
+            'borderRadius': '5px',
+            'boxShadow': '0 2px 4px rgba(0,0,0,0.1)',
+            'fontSize': '14px',
+            'lineHeight': '1.5',
+            'whiteSpace': 'pre-wrap'
+        }),
+        dash_table.DataTable(
+            id='page1-funnel-table',
+            page_current=0,
+            page_size=funnel.PAGE_SIZE,
+            page_action='custom',
+            sort_action='custom',
+            sort_mode='single',
+            sort_by=[],
+            style_table={'overflowX': 'auto', 'marginTop': '20px'},
+            style_cell={'fontSize': '13px', 'textAlign': 'left'}
+        )
+    ], id='page1-funnel-container', style={'display': 'none'}),
     html.Div([
         html.Button("Go to Page 2", id="go-to-page2", n_clicks=0, 
                     style={'fontSize': '20px', 'padding': '0px 2px'})
@@ -76,6 +252,45 @@ layout_page1 = html.Div([
 ])
 
 
+def chart_graph(chart, fig, style, image=None):
+    # Static mode: an <img> of the server-rendered chart instead of the figure JSON
+    if image:
+        return html.Img(src=image, alt=chart, style=dict(style, height='auto', maxWidth='100%'))
+    return dcc.Graph(id={'type': 'page1-chart-graph', 'index': chart}, figure=fig, style=style)
+
+
+# Page 1 filters whose rapid changes the browser debounces into 'page1-filter-settled'; see generations.py
+CASCADE_INPUTS = [('page1-visualization-dropdown', 'value'), ('page1-location-dropdown', 'value'), ('page1-sales-manager-dropdown', 'value'),
+                  ('page1-consultant-dropdown', 'value'), ('page1-period-dropdown', 'value'), ('page1-period-range', 'start_date'), ('page1-period-range', 'end_date')]
+
+app.clientside_callback(generations.PAGE_ID_SCRIPT, Output('page-id', 'data'), Input('page-id', 'modified_timestamp'), State('page-id', 'data'))
+app.clientside_callback(generations.DEBOUNCE_SCRIPT, Output('page1-filter-settled', 'data', allow_duplicate=True),
+                        [Input(component, prop) for component, prop in CASCADE_INPUTS], State('page1-filter-settled', 'data'),
+                        prevent_initial_call=True)
+
+def dropdown_index(stored_data):
+    # Distinct Location / Manager / Consultant rows behind the filter dropdowns; see typeahead.py
+    if stored_data.get('source') == 'database' and dbsource.enabled():
+        # The database can change under us, so its index is only kept for ETBR_DB_INDEX_TTL seconds
+        return typeahead.get_index(dbsource.snapshot('search index'), lambda: dbsource.distinct_rows(typeahead.LEVELS))
+    key = stored_data['key']
+    return typeahead.get_index(key, lambda: datastore.attach(key))
+
+def filtered_source(stored_data, filters, selected_period, start_date, end_date):
+    # The rows behind the current view, the backend that aggregates them and their aggcache key
+    backend = backends.get_backend()
+    key = stored_data.get('key')
+    if stored_data.get('source') == 'database' and dbsource.enabled():
+        return dbsource.backend.filter(dbsource.TableRef(), filters), dbsource.backend, None
+    if stored_data.get('mode') == 'events':
+        # Dated events: slice the selected window out of the date-sorted store
+        store = eventstore.get_store(key, lambda: datastore.load_dataset(key))
+        windows = eventstore.period_windows(selected_period, eventstore.latest_date(store), start_date, end_date)
+        return eventstore.window_frame(store, windows, filters), backend, None
+    # The configured backend filters the memory-mapped table directly
+    return backend.filter(datastore.attach(key), filters), backend, aggcache.key(key, filters)
+
+
 @app.callback(
     [Output('page1-location-dropdown', 'options'),
      Output('page1-sales-manager-dropdown', 'options'),
@@ -83,16 +298,38 @@ layout_page1 = html.Div([
      Output('page1-stored-data', 'data'),
      Output('page1-consultant-dropdown', 'value'),
      Output('page1-visualization-container', 'children'),
-     Output('page1-output-data-upload', 'children')],
+     Output('page1-output-data-upload', 'children'),
+     Output('page1-figure-signatures', 'data'),
+     Output('page1-filter-settled', 'data')],
     [Input('page1-upload-data', 'contents'),
-     Input('page1-visualization-dropdown', 'value'),
-     Input('page1-sales-manager-dropdown', 'value'),
-     Input('page1-consultant-dropdown', 'value'),
-     Input('page1-location-dropdown', 'value')],
-    [State('page1-upload-data', 'filename'),
-     State('page1-stored-data', 'data')]
+     Input('page1-filter-settled', 'data'),
+     Input('page1-load-database', 'n_clicks'),
+     Input('page1-folder-version', 'data'),
+     Input('page1-preview-ready', 'data'),
+     Input('page1-static-mode', 'value')],
+    [State('page1-visualization-dropdown', 'value'),
+     State('page1-sales-manager-dropdown', 'value'),
+     State('page1-consultant-dropdown', 'value'),
+     State('page1-location-dropdown', 'value'),
+     State('page1-period-dropdown', 'value'),
+     State('page1-period-range', 'start_date'),
+     State('page1-period-range', 'end_date'),
+     State('page1-upload-data', 'filename'),
+     State('page1-stored-data', 'data'),
+     State('page1-figure-signatures', 'data'),
+     State('page-id', 'data')]
 )
-def update_visualizations(contents, selected_visualization, selected_sales_manager, selected_consultant, selected_location, filename, stored_data):
+def update_visualizations(contents, settled_filters, load_database_clicks, folder_version, preview_ready, static_mode, selected_visualization, selected_sales_manager, selected_consultant, selected_location, selected_period, start_date, end_date, filename, stored_data, previous_signatures, page_id):
+    # Filter changes arrive debounced through 'page1-filter-settled'; the answer records the
+    # values it was built for, so the browser does not send the server's own changes back
+    outputs = build_visualizations(contents, preview_ready, static_mode, selected_visualization, selected_sales_manager, selected_consultant, selected_location,
+                                   selected_period, start_date, end_date, filename, stored_data, previous_signatures, page_id)
+    retained_consultant = outputs[4]
+    return (*outputs, [selected_visualization, selected_location, selected_sales_manager, retained_consultant, selected_period, start_date, end_date])
+
+
+def build_visualizations(contents, preview_ready, static_mode, selected_visualization, selected_sales_manager, selected_consultant, selected_location, selected_period, start_date, end_date, filename, stored_data, previous_signatures, page_id):
+    triggered = dash.callback_context.triggered_id
 
     location_options, sales_manager_options, consultant_options = [], [], []
     location_display = ''
@@ -100,360 +337,135 @@ def update_visualizations(contents, selected_visualization, selected_sales_manag
     filtered_df = pd.DataFrame()
     retained_consultant = selected_consultant
     visualization_output = []
-
-    if contents:
-        content_type, content_string = contents.split(',')
-        decoded = base64.b64decode(content_string)
-        data_df = pd.read_excel(io.BytesIO(decoded))
-
-        required_columns = ['Dealer Location', 'Sales Manager', 'Sales Consultant', 'Enquiry Type']
-        missing_columns = [col for col in required_columns if col not in data_df.columns]
-        if missing_columns:
-            return location_options, sales_manager_options, consultant_options, stored_data, retained_consultant, [html.Div(f"Missing columns: {', '.join(missing_columns)}")], None
-
-        locations = data_df['Dealer Location'].dropna().unique()
-        location_options = [{'label': loc, 'value': loc} for loc in locations]
-        stored_data = data_df.to_dict('records')
-        upload_message = f'File "{filename}" successfully uploaded!'
-
-    if stored_data:
-        data_df = pd.DataFrame(stored_data)
-
-        location_display = selected_location if selected_location else "All Locations"
-        manager_display = f", {selected_sales_manager}" if selected_sales_manager else ""
-        consultant_display = f", {selected_consultant}" if selected_consultant else ""
-
-        filtered_df = data_df
-
-        if selected_location:
-            filtered_df = filtered_df[filtered_df['Dealer Location'] == selected_location]
-
-        locations = data_df['Dealer Location'].dropna().unique()
-        location_options = [{'label': loc, 'value': loc} for loc in locations]
-
-        sales_managers = filtered_df['Sales Manager'].dropna().unique()
-        sales_manager_options = [{'label': manager, 'value': manager} for manager in sales_managers]
-
-        if selected_sales_manager:
-            filtered_df = filtered_df[filtered_df['Sales Manager'] == selected_sales_manager]
-
-        consultants = filtered_df['Sales Consultant'].dropna().unique()
-        consultant_options = [{'label': consultant, 'value': consultant} for consultant in consultants]
+    signatures = None
+    uploaded = triggered == 'page1-upload-data'
+    # Filter changes are dropped once a newer request from this page arrives
+    build = generations.begin(page_id, 'page1-charts', abandonable=triggered == 'page1-filter-settled')
+
+    # The upload contents stay set after the first upload; only re-ingest when they change
+    if contents and (uploaded or not stored_data):
+        try:
+            # Size checks run on the encoded payload and the sheet dimensions, before any parse
+            governor.check_upload(contents)
+            decoded = datastore.decode_contents(contents)
+
+            # Validate against the header rows before paying for a full parse; in a
+            # multi-sheet export only the sheet with the page 1 columns is parsed
+            header = ingest.read_header(decoded, filename)
+            required_columns = ['Dealer Location', 'Sales Manager', 'Sales Consultant', 'Enquiry Type']
+            chart_columns = required_columns + charts.required_columns(charts.chart_keys(selected_visualization))
+            sheet = ingest.find_sheet(header, chart_columns)
+            columns = header.get(sheet, [])
+            missing_columns = ingest.missing_columns(columns, chart_columns)
+            if missing_columns:
+                return location_options, sales_manager_options, consultant_options, stored_data, retained_consultant, [html.Div(f"Missing columns: {', '.join(missing_columns)}")], None, None
+
+            # Only parse the columns the charts, filters and event windows can use
+            usecols = ingest.stored_columns(columns, required_columns + charts.used_columns() + eventstore.EVENT_COLUMNS)
+            key = datastore.dataset_key(decoded, usecols, sheet)
+            # Rows and an estimate of the memory they need, from the sheet dimensions
+            governor.check_rows(decoded, filename, sheet, usecols)
+
+            def parse(raw):
+                df = ingest.read_frame(raw, filename, usecols, sheet=sheet)
+                # This page's previous dataset no longer counts against the worker
+                governor.check_dataset(key, df, f'{page_id}:page1' if page_id else None)
+                return df
+
+            mode = 'events' if eventstore.is_event_data(columns) else 'export'
+            # Precompute every Location / Manager / Consultant view while the user picks a chart
+            warm = warmer.start if mode == 'export' else None
+            with governor.heavy_job():
+                if preview.wanted(decoded, key):
+                    # Chart the first rows now; the full parse runs in the background
+                    preview_key = preview.start(decoded, filename, usecols, parse, then=warm, sheet=sheet)
+                else:
+                    preview_key = None
+                    datastore.ingest(decoded, parse, columns=usecols, sheet=sheet)
+        except governor.ResourceLimitError as e:
+            return location_options, sales_manager_options, consultant_options, stored_data, retained_consultant, [html.Div(str(e))], None, None
+
+        # Only the dataset key goes to the browser; the rows stay in the shared store
+        if preview_key:
+            stored_data = {'key': preview_key, 'mode': mode, 'preview_of': key}
+        else:
+            stored_data = {'key': key, 'mode': mode}
+            if warm:
+                warm(key)
+            upload_message = f'File "{filename}" successfully uploaded!'
+        # Page 2 parses its own sheets from the same upload when its charts are opened
+        stored_data['workbook'] = workbooks.remember(decoded, filename, header)
+
+    if triggered == 'page1-preview-ready' and stored_data and stored_data.get('preview_of') == preview_ready:
+        if preview.status(preview_ready) == 'done':
+            stored_data = {name: value for name, value in stored_data.items() if name != 'preview_of'}
+            stored_data['key'] = preview_ready
+            upload_message = f'File "{filename}" fully loaded.'
+        else:
+            return location_options, sales_manager_options, consultant_options, None, retained_consultant, [], preview.error(preview_ready), None
+
+    if stored_data and stored_data.get('preview_of'):
+        upload_message = f'Showing the first {preview.PREVIEW_ROWS} rows of "{filename}" while the rest loads...'
+
+    if triggered == 'page1-load-database' and dbsource.enabled():
+        # Aggregations are pushed down to the database; the store only records the mode
+        stored_data = {'source': 'database'}
+        upload_message = f'Connected to "{os.path.basename(dbsource.DB_PATH)}"'
+
+    if triggered == 'page1-folder-version':
+        folder = dropfolder.current()
+        # Sessions without data, or already on the folder, follow it; an explicit upload wins
+        if folder and (not stored_data or stored_data.get('source') == 'folder'):
+            stored_data = folder
+            upload_message = 'Showing the latest files from the drop folder'
+
+    from_database = bool(stored_data) and stored_data.get('source') == 'database' and dbsource.enabled()
+    if from_database or (stored_data and datastore.exists(stored_data.get('key'))):
+        key = stored_data.get('key')
+        # The first matches only; typing in a dropdown searches the rest on the server
+        index = dropdown_index(stored_data)
+        location_options = typeahead.options(index, 'Dealer Location', selected=selected_location)
+        sales_manager_options = typeahead.options(index, 'Sales Manager', {'Dealer Location': selected_location}, selected=selected_sales_manager)
+        consultant_options = typeahead.options(index, 'Sales Consultant', {'Dealer Location': selected_location, 'Sales Manager': selected_sales_manager},
+                                               selected=selected_consultant)
 
         if selected_consultant and selected_consultant not in [opt['value'] for opt in consultant_options]:
             retained_consultant = None
 
-        if retained_consultant:
-            filtered_df = filtered_df[filtered_df['Sales Consultant'] == retained_consultant]
-
-        def create_title(base_title):
-            return f"{base_title} for {location_display}{manager_display}{consultant_display}"
-
-        def create_etbr_report():
-            metrics = ['ENQUIRY MTD', 'TD MTD', 'BOOKING MTD', 'RETAIL MTD']
-            values = [filtered_df[metric].sum() if metric in filtered_df.columns else 0 for metric in metrics]
-            if not selected_location:
-                values = [v / 2 for v in values]
-            chart_df = pd.DataFrame({'Metric': metrics, 'Value': values})
-            fig = px.pie(chart_df, values='Value', names='Metric', title=create_title('ETBR Report'))
-            
-            fig.update_traces(
-                textposition='inside',
-                texttemplate='%{label}<br>%{value:.2f}<br>%{percent}',
-                hovertemplate='<b>%{label}</b><br>Value: %{value:.2f}<br>Percentage: %{percent}'
-            )
-            fig.update_layout(
-                height=600,
-                width=600)
-            
-            total = sum(values)
-            description = f"""
-            This pie chart shows the distribution of Enquiry, Test Drive, Booking, and Retail metrics for the Month-To-Date (MTD) period.
-            
-
-            Enquiries: {values[0]:.0f} ({values[0]/total*100:.1f}%)
-            Test Drives: {values[1]:.0f} ({values[1]/total*100:.1f}%)
-            Bookings: {values[2]:.0f} ({values[2]/total*100:.1f}%)
-            Retails: {values[3]:.0f} ({values[3]/total*100:.1f}%)
-            """
-            
-            return fig, description
-
-        def create_lmtd_etbr():
-            metrics = ['ENQUIRY', 'TD', 'BOOKING', 'RETAIL']
-            mtd_values = [filtered_df[f'{metric} MTD'].sum() if f'{metric} MTD' in filtered_df.columns else 0 for metric in metrics]
-            lmtd_values = [filtered_df[f'{metric} LMTD'].sum() if f'{metric} LMTD' in filtered_df.columns else 0 for metric in metrics]
-            if not selected_location:
-                mtd_values = [v / 2 for v in mtd_values]
-                lmtd_values = [v / 2 for v in lmtd_values]
-            fig = go.Figure()
-            fig.add_trace(go.Bar(x=metrics, y=mtd_values, name='MTD', text=mtd_values, textposition='outside'))
-            fig.add_trace(go.Bar(x=metrics, y=lmtd_values, name='LMTD', text=lmtd_values, textposition='outside'))
-            fig.update_layout(
-                barmode='group', 
-                title=create_title('LMTD vs MTD ETBR'), 
-                xaxis_title='Metrics', 
-                yaxis_title='Values', 
-                height=600,
-                width=1000,
-                legend_title='Period', 
-                legend=dict(orientation="h"),
-                bargap=0.2, 
-                bargroupgap=0.1,
-                xaxis=dict(tickangle=0)
-            )
-            
-            mtd_total = sum(mtd_values)
-            lmtd_total = sum(lmtd_values)
-            percent_change = ((mtd_total - lmtd_total) / lmtd_total) * 100
-            
-            description = f"""
-            This grouped bar chart compares Month-To-Date (MTD) and Last Month-To-Date (LMTD) values for Enquiry, Test Drive, Booking, and Retail metrics.
-            
-            Total MTD: {mtd_total:.0f}
-            Total LMTD: {lmtd_total:.0f}
-            Percent change: {percent_change:.1f}%
-            """
-            
-            return fig, description
-
-        def create_model_etbr():
-            metrics = ['ENQUIRY MTD', 'TD MTD', 'BOOKING MTD', 'RETAIL MTD']
-            data = []
-            for metric in metrics:
-                metric_df = filtered_df.groupby('Model').agg({metric: 'sum'}).reset_index()
-                metric_df['Metric'] = metric
-                metric_df = metric_df.rename(columns={metric: 'Value'})
-                data.append(metric_df)
-            chart_df = pd.concat(data)
-            fig = px.bar(
-                chart_df,
-                x='Model',
-                y='Value',
-                color='Metric',
-                barmode='group',
-                title=create_title('MODEL ETBR'),
-                labels={'Value': 'Total Value', 'Model': 'Model'},
-                text='Value'
-            )
-            fig.update_layout(
-                yaxis=dict(title='Total Value'),
-                xaxis=dict(title='Model'),
-                showlegend=True,
-                margin=dict(l=40, r=40, t=40, b=40),
-                height=600,
-                width=1000,
-                bargap=0.2,
-                font=dict(size=12)
-            )
-            
-            top_model = chart_df.groupby('Model')['Value'].sum().idxmax()
-            top_model_value = chart_df.groupby('Model')['Value'].sum().max()
-
-            if chart_df.empty:
-        # Return an empty figure and a message if there's no data
-                fig = go.Figure()
-                fig.update_layout(
-                title=create_title('MODEL ETBR - No Data Available'),
-                annotations=[dict(
-                text='No data available for the current selection',
-                showarrow=False,
-                xref="paper",
-                yref="paper",
-                x=0.5,
-                y=0.5,
-                font=dict(size=20)
-            )]
-        )
-            
-            description = f"""
-            This grouped bar chart shows the performance of different car models across Enquiry, Test Drive, Booking, and Retail metrics for the Month-To-Date period.
-            
-            Top performing model: {top_model}
-            Total value for top model: {top_model_value:.0f}
-            """
-            
-            return fig, description
-
-        def create_enquiry_type_etbr():
-            metrics = ['ENQUIRY MTD', 'TD MTD', 'BOOKING MTD', 'RETAIL MTD']
-            data = []
-            metric_abbr = {
-                'ENQUIRY MTD': 'E',
-                'TD MTD': 'T',
-                'BOOKING MTD': 'B',
-                'RETAIL MTD': 'R'
-            }
-            for metric in metrics:
-                metric_df = filtered_df.groupby('Enquiry Type').agg({metric: 'sum'}).reset_index()
-                metric_df['Metric'] = metric
-                metric_df = metric_df.rename(columns={metric: 'Value'})
-                data.append(metric_df)
-            chart_df = pd.concat(data)
-            chart_df['Metric'] = chart_df['Metric'].map(metric_abbr)
-            chart_df['Hierarchy'] = chart_df['Enquiry Type'] + ' - ' + chart_df['Metric']
-            fig = px.sunburst(
-                chart_df,
-                path=['Enquiry Type', 'Metric'],
-                values='Value',
-                title=create_title('Enquiry Type vs ETBR Report')
-            )
-            fig.update_traces(
-                texttemplate='%{label}<br>%{value}',
-                textfont=dict(size=12, color='black')
-            )
-            fig.update_layout(
-                height=600,
-                width=1000)
-            
-            top_enquiry_type = chart_df.groupby('Enquiry Type')['Value'].sum().idxmax()
-            top_enquiry_value = chart_df.groupby('Enquiry Type')['Value'].sum().max()
-            
-            description = f"""
-            This sunburst chart shows the distribution of Enquiry Types across ETBR (Enquiry, Test Drive, Booking, Retail) metrics.
-            
-            Top performing Enquiry Type: {top_enquiry_type}
-            Total value for top Enquiry Type: {top_enquiry_value:.0f}
-            """
-            
-            return fig, description
-
-
-        def create_enquiry_source_etbr():
-            metrics = ['ENQUIRY MTD', 'TD MTD', 'BOOKING MTD', 'RETAIL MTD']
-            data = []
-            for metric in metrics:
-                metric_df = filtered_df.groupby('Enquiry Source').agg({metric: 'sum'}).reset_index()
-                metric_df['Metric'] = metric
-                metric_df = metric_df.rename(columns={metric: 'Value'})
-                data.append(metric_df)
-                chart_df = pd.concat(data)
-                fig = px.bar(chart_df, x='Metric', y='Value', color='Enquiry Source', title=f'Enquiry Source vs ETBR for {location_display}')
-                fig.update_traces(texttemplate='%{y}', textposition='outside')
-                fig.update_layout(
-                height=600,
-                width=1000)
-                top_source = chart_df.groupby('Enquiry Source')['Value'].sum().idxmax()
-                top_source_value = chart_df.groupby('Enquiry Source')['Value'].sum().max()
-    
-                description = f"""
-    This stacked bar chart shows how different Enquiry Sources contribute to ETBR metrics.
-    
-    Top performing Enquiry Source: {top_source}
-    Total value for top Enquiry Source: {top_source_value:.0f}
-    """
-    
-            return fig, description
-
-
-        def create_team_etbr():
-            metrics = ['ENQUIRY MTD', 'TD MTD', 'BOOKING MTD', 'RETAIL MTD']
-            data = []
-            for metric in metrics:
-                metric_df = filtered_df.groupby('Sales Consultant').agg({metric: 'sum'}).reset_index()
-                metric_df['Metric'] = metric
-                metric_df = metric_df.rename(columns={metric: 'Value'})
-                data.append(metric_df)
-            chart_df = pd.concat(data)
-            fig = px.bar(chart_df, x='Metric', y='Value', color='Sales Consultant', title=f'Team vs Enquiry, Booking, Test Drive, Retail for {location_display}')
-            fig.update_traces(texttemplate='%{y}', textposition='outside')
-            fig.update_layout(
-                height=600,
-                width=1000)
-            top_consultant = chart_df.groupby('Sales Consultant')['Value'].sum().idxmax()
-            top_consultant_value = chart_df.groupby('Sales Consultant')['Value'].sum().max()
-            
-            description = f"""
-            This stacked bar chart shows the performance of individual Sales Consultants across ETBR metrics.
-            
-            Top performing Sales Consultant: {top_consultant}
-            Total value for top Sales Consultant: {top_consultant_value:.0f}
-            """
-            
-            return fig, description
-
-        def create_team_enquiry_type():
-            metrics = ['ENQUIRY MTD', 'TD MTD', 'BOOKING MTD', 'RETAIL MTD']
-            data = []
-            for metric in metrics:
-                metric_df = filtered_df.groupby('Enquiry Type').agg({metric: 'sum'}).reset_index()
-                metric_df['Metric'] = metric
-                metric_df = metric_df.rename(columns={metric: 'Value'})
-                data.append(metric_df)
-            chart_df = pd.concat(data)
-            fig = px.bar(chart_df, x='Enquiry Type', y='Value', color='Metric', title=create_title('Team vs Enquiry Type ETBR Report'))
-            fig.update_traces(texttemplate='%{y}', textposition='outside')
-            fig.update_layout(barmode='group',
-                height=600,
-                width=1000)
-            
-            top_enquiry_type = chart_df.groupby('Enquiry Type')['Value'].sum().idxmax()
-            top_enquiry_type_value = chart_df.groupby('Enquiry Type')['Value'].sum().max()
-            
-            description = f"""
-            This grouped bar chart shows how different Enquiry Types perform across ETBR metrics.
-            
-            Top performing Enquiry Type: {top_enquiry_type}
-            Total value for top Enquiry Type: {top_enquiry_type_value:.0f}
-            """
-            
-            return fig, description
-
-        def create_walk_in_etbr():
-            metrics = ['ENQUIRY MTD', 'TD MTD', 'BOOKING MTD', 'RETAIL MTD']
-            walk_in_df = filtered_df[filtered_df['Enquiry Type'] == 'Walk-in']
-            values = [walk_in_df[metric].sum() if metric in walk_in_df.columns else 0 for metric in metrics]
-            chart_df = pd.DataFrame({'Metric': metrics, 'Value': values})
-            fig = px.pie(chart_df, names='Metric', values='Value', title=create_title('Walk In Report'))
-            fig.update_traces(
-                textinfo='label+percent',
-                textposition='inside',
-                textfont=dict(
-                    color='black',
-                    family='Arial',
-                    size=12
-                )
-            )
-            fig.update_layout(
-                title_text='Walk In ETBR',
-                title_x=0.5,
-                height=600,
-                width=1000,
-                uniformtext_minsize=12,
-                uniformtext_mode='hide'
-            )
-            
-            total = sum(values)
-            description = f"""
-            This pie chart shows the distribution of Walk-in enquiries across ETBR metrics.
-            
-            Total Walk-in ETBR: {total:.0f}
-            Enquiries: {values[0]:.0f} ({values[0]/total*100:.1f}%)
-            Test Drives: {values[1]:.0f} ({values[1]/total*100:.1f}%)
-            Bookings: {values[2]:.0f} ({values[2]/total*100:.1f}%)
-            Retails: {values[3]:.0f} ({values[3]/total*100:.1f}%)
-            """
-            
-            return fig, description
+        filters = {'Dealer Location': selected_location, 'Sales Manager': selected_sales_manager, 'Sales Consultant': retained_consultant}
+        # The charts must be back within the budget, the aggregation included; see lod.py.
+        # Images are cached under the view's name for a year, so they are always drawn in full
+        static = 'static' in (static_mode or []) and imagecache.available()
+        budget = lod.Budget()
+        failed = False
+        filtered_df, backend, cache_key = filtered_source(stored_data, filters, selected_period, start_date, end_date)
+
+        ctx = charts.view_context(selected_location, selected_sales_manager, selected_consultant, stored_data.get('mode'))
+        # Charts that share a groupby are aggregated together in a single pass
+        try:
+            with governor.heavy_job():
+                generations.check(build, 'filter')
+                viz_data = charts.build_charts(charts.chart_keys(selected_visualization), filtered_df, ctx, backend, cache_key,
+                                               checkpoint=functools.partial(generations.check, build, 'aggregation'), budget=None if static else budget)
+            if stored_data.get('preview_of'):
+                viz_data = preview.mark(viz_data)
+        except governor.ResourceLimitError as e:
+            viz_data = [(go.Figure(), str(e))]
+            failed = True
+
+        images = {}
+        # A blank figure in place of a refused view is never cached as its image
+        if static and not failed:
+            # Windows of dated events are part of the view, so they are part of the image name
+            params = dict(filters, Period=selected_period, Start=start_date, End=end_date) if stored_data.get('mode') == 'events' else filters
+            images = {chart: imagecache.image_src(key, chart, fig, params) for chart, (fig, _) in zip(charts.chart_keys(selected_visualization), viz_data)}
 
         if selected_visualization == 'All Visualisations':
-            # Create all visualizations
-            viz_data = [
-                create_etbr_report(),
-                create_lmtd_etbr(),
-                create_model_etbr(),
-                create_enquiry_type_etbr(),
-                create_enquiry_source_etbr(),
-                create_team_etbr(),
-                create_team_enquiry_type(),
-                create_walk_in_etbr()
-            ]
-            
             # Create a layout with all visualizations and descriptions
             visualization_output = [
                 html.Div([
-                    dcc.Graph(figure=fig, style={'width': '100%', 'height': '600px'}),
-                    html.Div(description, style={
+                    chart_graph(chart, fig, {'width': '100%', 'height': '600px'}, images.get(chart)),
+                    html.Div(description, id={'type': 'page1-chart-description', 'index': chart}, style={
                         'marginTop': '20px',
                         'marginBottom': '40px',
                         'padding': '15px',
@@ -463,32 +475,18 @@ def update_visualizations(contents, selected_visualization, selected_sales_manag
                         'fontSize': '14px',
                         'lineHeight': '1.5'
                     })
-                ]) for fig, description in viz_data
+                ]) for chart, (fig, description) in zip(charts.chart_keys(selected_visualization), viz_data)
             ]
         else:
-            # Create the selected visualization
-            if selected_visualization == 'ETBR Report':
-                fig, description = create_etbr_report()
-            elif selected_visualization == 'LMTD ETBR':
-                fig, description = create_lmtd_etbr()
-            elif selected_visualization == 'Model ETBR':
-                fig, description = create_model_etbr()
-            elif selected_visualization == 'Enquiry Type vs ETBR':
-                fig, description = create_enquiry_type_etbr()
-            elif selected_visualization == 'Enquiry Source vs ETBR':
-                fig, description = create_enquiry_source_etbr()
-            elif selected_visualization == 'Team vs Enquiry, Booking, Test Drive, Retail':
-                fig, description = create_team_etbr()
-            elif selected_visualization == 'Team vs Enquiry Type Report':
-                fig, description = create_team_enquiry_type()
-            elif selected_visualization == 'Walk In ETBR':
-                fig, description = create_walk_in_etbr()
+            if viz_data:
+                fig, description = viz_data[0]
             else:
                 fig, description = go.Figure(), "No visualization selected"
+                viz_data = [(fig, description)]
 
             visualization_output = [
-                dcc.Graph(figure=fig, style={'width': '90vw', 'height': '600px'}),
-                html.Div(description, style={
+                chart_graph(str(selected_visualization), fig, {'width': '90vw', 'height': '600px'}, images.get(selected_visualization)),
+                html.Div(description, id={'type': 'page1-chart-description', 'index': str(selected_visualization)}, style={
                     'marginTop': '20px',
                     'padding': '15px',
                     'backgroundColor': '#f0f0f0',
@@ -500,10 +498,443 @@ def update_visualizations(contents, selected_visualization, selected_sales_manag
                 })
             ]
 
-    return location_options, sales_manager_options, consultant_options, stored_data, retained_consultant, visualization_output, upload_message
+        # A filter change that keeps the same charts and categories only needs new numbers;
+        # the charts reduced to fit the budget show the 'Load Full Detail' button
+        signatures = [selected_visualization, [figpatch.figure_signature(selected_visualization, fig) for fig, _ in viz_data], budget.reduced]
+        if selected_visualization in (drilldown.VIEW, compare.VIEW, funnel.VIEW):
+            # The drill-down, comparison and funnel panels have their own callbacks
+            visualization_output, signatures = [], None
+        elif any(images.values()):
+            # Images are swapped whole; never patch them as figures
+            signatures = None
+        elif not uploaded and signatures == previous_signatures:
+            visualization_output = figpatch.visualization_patch(viz_data, nested=selected_visualization == 'All Visualisations')
+
+    return location_options, sales_manager_options, consultant_options, stored_data, retained_consultant, visualization_output, upload_message, signatures
+
+
+def search_options(stored_data, level, search_value, selected, filters=None):
+    if not stored_data or not (stored_data.get('source') == 'database' and dbsource.enabled() or datastore.exists(stored_data.get('key'))):
+        return dash.no_update
+    return typeahead.options(dropdown_index(stored_data), level, filters, search_value, selected)
+
+
+@app.callback(Output('page1-location-dropdown', 'options', allow_duplicate=True),
+              Input('page1-location-dropdown', 'search_value'),
+              [State('page1-location-dropdown', 'value'),
+               State('page1-stored-data', 'data')],
+              prevent_initial_call=True)
+def search_locations(search_value, selected_location, stored_data):
+    return search_options(stored_data, 'Dealer Location', search_value, selected_location)
+
+
+@app.callback(Output('page1-sales-manager-dropdown', 'options', allow_duplicate=True),
+              Input('page1-sales-manager-dropdown', 'search_value'),
+              [State('page1-sales-manager-dropdown', 'value'),
+               State('page1-location-dropdown', 'value'),
+               State('page1-stored-data', 'data')],
+              prevent_initial_call=True)
+def search_sales_managers(search_value, selected_sales_manager, selected_location, stored_data):
+    return search_options(stored_data, 'Sales Manager', search_value, selected_sales_manager, {'Dealer Location': selected_location})
+
+
+@app.callback(Output('page1-consultant-dropdown', 'options', allow_duplicate=True),
+              Input('page1-consultant-dropdown', 'search_value'),
+              [State('page1-consultant-dropdown', 'value'),
+               State('page1-location-dropdown', 'value'),
+               State('page1-sales-manager-dropdown', 'value'),
+               State('page1-stored-data', 'data')],
+              prevent_initial_call=True)
+def search_consultants(search_value, selected_consultant, selected_location, selected_sales_manager, stored_data):
+    return search_options(stored_data, 'Sales Consultant', search_value, selected_consultant,
+                          {'Dealer Location': selected_location, 'Sales Manager': selected_sales_manager})
+
+
+@app.callback(
+    [Output('page1-drill-container', 'style'),
+     Output('page1-drill-graph', 'figure'),
+     Output('page1-drill-description', 'children'),
+     Output('page1-drill-breadcrumb', 'children'),
+     Output('page1-drill-path', 'data')],
+    [Input('page1-visualization-dropdown', 'value'),
+     Input('page1-stored-data', 'data'),
+     Input('page1-location-dropdown', 'value'),
+     Input('page1-sales-manager-dropdown', 'value'),
+     Input('page1-consultant-dropdown', 'value'),
+     Input('page1-drill-graph', 'clickData'),
+     Input({'type': 'page1-drill-crumb', 'index': ALL}, 'n_clicks'),
+     Input('page1-drill-chart', 'value')],
+    [State('page1-drill-path', 'data')]
+)
+def update_drill_down(selected_visualization, stored_data, selected_location, selected_sales_manager, selected_consultant, click_data, crumb_clicks, chart_type, path):
+    if selected_visualization != drilldown.VIEW or not stored_data:
+        return {'display': 'none'}, go.Figure(), None, [], []
+
+    if stored_data.get('source') == 'database' and dbsource.enabled():
+        # The database can change under us, so its hierarchy is not cached
+        hierarchy = drilldown.build_hierarchy(dbsource.TableRef(), dbsource.backend)
+    elif stored_data.get('mode') == 'export' and datastore.exists(stored_data.get('key')):
+        key = stored_data['key']
+        hierarchy = drilldown.get_hierarchy(key, lambda: datastore.attach(key))
+    else:
+        return {'display': 'block'}, go.Figure(), 'Drill-down needs an export with MTD columns.', [], []
+
+    triggered = dash.callback_context.triggered_id
+    if triggered == 'page1-drill-graph':
+        path = drilldown.clicked_path(click_data) or path
+    elif isinstance(triggered, dict):
+        # Breadcrumbs also fire when they are first rendered, with no clicks
+        if dash.callback_context.triggered[0]['value']:
+            path = path[:triggered['index']]
+    elif triggered != 'page1-drill-chart':
+        # Start from whatever the dropdowns already select
+        path = []
+        for value in (selected_location, selected_sales_manager, selected_consultant):
+            if value is None:
+                break
+            path.append(value)
+
+    fig, description = drilldown.create_drill_figure(hierarchy, path, chart_type)
+    crumbs = []
+    for index, label in enumerate(drilldown.breadcrumb(path)):
+        if crumbs:
+            crumbs.append(' > ')
+        crumbs.append(html.Button(label, id={'type': 'page1-drill-crumb', 'index': index}, n_clicks=0,
+                                  style={'border': 'none', 'background': 'none', 'color': '#1f77b4', 'cursor': 'pointer', 'fontSize': '16px'}))
+    return {'display': 'block'}, fig, description, crumbs, path
+
+
+@app.callback(
+    [Output('page1-compare-container', 'style'),
+     Output('page1-compare-entities', 'options'),
+     Output('page1-compare-entities', 'value'),
+     Output('page1-compare-graph', 'figure'),
+     Output('page1-compare-description', 'children')],
+    [Input('page1-visualization-dropdown', 'value'),
+     Input('page1-stored-data', 'data'),
+     Input('page1-compare-dimension', 'value'),
+     Input('page1-compare-entities', 'value')]
+)
+def update_comparison(selected_visualization, stored_data, dimension, entities):
+    if selected_visualization != compare.VIEW or not stored_data:
+        return {'display': 'none'}, [], entities, go.Figure(), None
+
+    if stored_data.get('source') == 'database' and dbsource.enabled():
+        backend, source, cache_key = dbsource.backend, dbsource.TableRef(), None
+        values = dbsource.distinct(dimension)
+    elif stored_data.get('mode') == 'export' and datastore.exists(stored_data.get('key')):
+        key = stored_data['key']
+        # The unfiltered groupby is shared by every comparison on this dataset
+        backend, source, cache_key = backends.get_backend(), datastore.attach(key), aggcache.key(key, None)
+        values = datastore.unique_values(key, dimension)
+    else:
+        return {'display': 'block'}, [], [], go.Figure(), 'Comparison needs an export with MTD and LMTD columns.'
+
+    options = [{'label': value, 'value': value} for value in values]
+    entities = [entity for entity in entities or [] if entity in values]
+    if not entities:
+        return {'display': 'block'}, options, entities, go.Figure(), f'Select the {dimension} values to compare.'
+
+    try:
+        with governor.heavy_job():
+            agg = compare.compare_aggregate(source, dimension, entities, backend, cache_key)
+    except governor.ResourceLimitError as e:
+        return {'display': 'block'}, options, entities, go.Figure(), str(e)
+    fig, description = compare.create_comparison(agg, dimension)
+    return {'display': 'block'}, options, entities, fig, description
+
+
+@app.callback(
+    [Output('page1-funnel-container', 'style'),
+     Output('page1-funnel-graph', 'figure'),
+     Output('page1-funnel-description', 'children'),
+     Output('page1-funnel-table', 'data'),
+     Output('page1-funnel-table', 'columns'),
+     Output('page1-funnel-table', 'page_count')],
+    [Input('page1-visualization-dropdown', 'value'),
+     Input('page1-stored-data', 'data'),
+     Input('page1-location-dropdown', 'value'),
+     Input('page1-sales-manager-dropdown', 'value'),
+     Input('page1-consultant-dropdown', 'value'),
+     Input('page1-period-dropdown', 'value'),
+     Input('page1-period-range', 'start_date'),
+     Input('page1-period-range', 'end_date'),
+     Input('page1-funnel-dimension', 'value'),
+     Input('page1-funnel-rank', 'value'),
+     Input('page1-funnel-table', 'page_current'),
+     Input('page1-funnel-table', 'sort_by')]
+)
+def update_funnel(selected_visualization, stored_data, selected_location, selected_sales_manager, selected_consultant, selected_period, start_date, end_date, level, rank_by, page_current, sort_by):
+    if selected_visualization != funnel.VIEW or not stored_data:
+        return {'display': 'none'}, go.Figure(), None, [], [], 1
+    if not (stored_data.get('source') == 'database' and dbsource.enabled()) and not datastore.exists(stored_data.get('key')):
+        return {'display': 'none'}, go.Figure(), None, [], [], 1
+
+    # Each level is ranked among its peers: its parents' selections filter, its own is highlighted
+    depth = funnel.LEVELS.index(level)
+    selected = [selected_location, selected_sales_manager, selected_consultant]
+    filters = dict.fromkeys(funnel.LEVELS)
+    filters.update(zip(funnel.LEVELS[:depth], selected[:depth]))
+    source, backend, cache_key = filtered_source(stored_data, filters, selected_period, start_date, end_date)
+    missing = [column for column in funnel.LEVELS + funnel.METRICS if column not in backends.columns(source)]
+    if missing:
+        return {'display': 'block'}, go.Figure(), f"No rows for this selection, or missing columns: {', '.join(missing)}", [], [], 1
+    try:
+        with governor.heavy_job():
+            agg = funnel.level_aggregate(source, level, backend, cache_key)
+    except governor.ResourceLimitError as e:
+        return {'display': 'block'}, go.Figure(), str(e), [], [], 1
+
+    board = funnel.leaderboard(agg, rank_by)
+    page_count = max(1, -(-len(board) // funnel.PAGE_SIZE))
+    rows = funnel.page(board, sort_by, min(page_current or 0, page_count - 1), funnel.PAGE_SIZE)
+    if dash.callback_context.triggered_id == 'page1-funnel-table':
+        # Paging and sorting leave the funnel and the summary as they are
+        return {'display': 'block'}, dash.no_update, dash.no_update, rows, funnel.columns(board), page_count
+    scope = ' > '.join(value for value in selected[:depth] if value) or 'All Locations'
+    total = funnel.totals(agg)
+    description = funnel.describe(board, total, level, rank_by, selected[depth])
+    return {'display': 'block'}, funnel.create_funnel(total, scope), description, rows, funnel.columns(board), page_count
+
+
+@app.callback(
+    Output('page1-download-aggregates', 'data'),
+    Input('page1-download-aggregates-button', 'n_clicks'),
+    [State('page1-stored-data', 'data'),
+     State('page1-visualization-dropdown', 'value'),
+     State('page1-location-dropdown', 'value'),
+     State('page1-sales-manager-dropdown', 'value'),
+     State('page1-consultant-dropdown', 'value'),
+     State('page1-period-dropdown', 'value'),
+     State('page1-period-range', 'start_date'),
+     State('page1-period-range', 'end_date'),
+     State('page1-download-format', 'value')],
+    prevent_initial_call=True
+)
+def download_aggregates(n_clicks, stored_data, selected_visualization, selected_location, selected_sales_manager, selected_consultant, selected_period, start_date, end_date, download_format):
+    if not stored_data or not (stored_data.get('source') == 'database' and dbsource.enabled() or datastore.exists(stored_data.get('key'))):
+        return None
+    filters = {'Dealer Location': selected_location, 'Sales Manager': selected_sales_manager, 'Sales Consultant': selected_consultant}
+    # Views without a chart of their own (drill-down, comparison) export every chart's aggregates
+    keys = charts.chart_keys(selected_visualization) or charts.ALL_CHARTS
+    with governor.heavy_job():
+        source, backend, cache_key = filtered_source(stored_data, filters, selected_period, start_date, end_date)
+        tables = exports.aggregate_tables(keys, source, backend, cache_key)
+    data, filename = exports.aggregates_file(tables, download_format)
+    return dcc.send_bytes(data, filename)
+
+
+@app.callback(
+    [Output('page1-download-rows-link', 'href'),
+     Output('page1-download-rows-link', 'style')],
+    [Input('page1-stored-data', 'data'),
+     Input('page1-location-dropdown', 'value'),
+     Input('page1-sales-manager-dropdown', 'value'),
+     Input('page1-consultant-dropdown', 'value'),
+     Input('page1-download-format', 'value')]
+)
+def update_download_rows_link(stored_data, selected_location, selected_sales_manager, selected_consultant, download_format):
+    from_database = bool(stored_data) and stored_data.get('source') == 'database' and dbsource.enabled()
+    if not from_database and not (stored_data and datastore.exists(stored_data.get('key'))):
+        return None, {'marginLeft': '10px', 'display': 'none'}
+    key = exports.DATABASE_KEY if from_database else stored_data.get('key')
+    filters = {'Dealer Location': selected_location, 'Sales Manager': selected_sales_manager, 'Sales Consultant': selected_consultant}
+    return exports.export_url(key, download_format, filters), {'marginLeft': '10px', 'display': 'inline-block'}
+
+
+@app.callback(
+    [Output('page1-rows-category', 'data'),
+     Output('page1-rows-table', 'page_current')],
+    [Input({'type': 'page1-chart-graph', 'index': ALL}, 'clickData'),
+     Input('page1-visualization-dropdown', 'value')],
+    prevent_initial_call=True
+)
+def select_row_category(click_data, selected_visualization):
+    triggered = dash.callback_context.triggered_id
+    if not isinstance(triggered, dict):
+        # A different visualization: start again from all rows
+        return {}, 0
+    click = dash.callback_context.triggered[0]['value']
+    if not click:
+        # Re-rendered graphs fire without a click
+        return dash.no_update, dash.no_update
+    return {'chart': triggered['index'], 'filters': rowview.category_filter(triggered['index'], click)}, 0
+
+
+@app.callback(
+    [Output('page1-rows-table', 'data'),
+     Output('page1-rows-table', 'columns'),
+     Output('page1-rows-table', 'page_count'),
+     Output('page1-rows-caption', 'children'),
+     Output('page1-rows-container', 'style')],
+    [Input('page1-stored-data', 'data'),
+     Input('page1-location-dropdown', 'value'),
+     Input('page1-sales-manager-dropdown', 'value'),
+     Input('page1-consultant-dropdown', 'value'),
+     Input('page1-rows-category', 'data'),
+     Input('page1-rows-table', 'page_current'),
+     Input('page1-rows-table', 'page_size'),
+     Input('page1-rows-table', 'sort_by'),
+     Input('page1-rows-table', 'filter_query')]
+)
+def update_rows_table(stored_data, selected_location, selected_sales_manager, selected_consultant, category, page_current, page_size, sort_by, filter_query):
+    if not stored_data or not (stored_data.get('source') == 'database' and dbsource.enabled() or datastore.exists(stored_data.get('key'))):
+        return [], [], 0, None, {'display': 'none'}
+    filters = {'Dealer Location': selected_location, 'Sales Manager': selected_sales_manager, 'Sales Consultant': selected_consultant}
+    category_filters = (category or {}).get('filters') or {}
+    filters.update(category_filters)
+
+    # Only the requested page leaves the server
+    rows, total = rowview.query_rows(stored_data, filters, filter_query, sort_by, page_current or 0, page_size)
+    columns = [{'name': column, 'id': column} for column in rowview.columns(stored_data)]
+    caption = f'{total} matching rows'
+    if category_filters:
+        caption += ' for ' + ', '.join(f'{column} = {value}' for column, value in category_filters.items())
+    caption += '. Click a bar or slice to see the rows behind it.'
+    return rows, columns, max(1, (total + page_size - 1) // page_size), caption, {'display': 'block'}
+
+
+@app.callback(
+    Output('page1-folder-version', 'data'),
+    Input('page1-folder-interval', 'n_intervals'),
+    State('page1-folder-version', 'data')
+)
+def check_folder_version(n_intervals, folder_version):
+    # A cheap key comparison; the page 1 callback only runs when a new file arrived
+    folder = dropfolder.current()
+    if not folder or folder['key'] == folder_version:
+        return dash.no_update
+    return folder['key']
+
+
+@app.callback(
+    [Output('page1-preview-ready', 'data'),
+     Output('page1-preview-interval', 'disabled')],
+    [Input('page1-preview-interval', 'n_intervals'),
+     Input('page1-stored-data', 'data')]
+)
+def check_preview(n_intervals, stored_data):
+    # Poll only while a preview is on screen; the page 1 callback swaps in the full dataset
+    full_key = (stored_data or {}).get('preview_of')
+    if not full_key:
+        return dash.no_update, True
+    if preview.status(full_key) == 'running':
+        return dash.no_update, False
+    return full_key, True
+
+
+def detail_view(stored_data, selected_visualization, selected_location, selected_sales_manager, selected_consultant, selected_period, start_date, end_date):
+    # Everything the page 1 charts depend on; the exact charts of a view are built once
+    view = {'data': stored_data, 'chart': selected_visualization,
+            'filters': [selected_location, selected_sales_manager, selected_consultant]}
+    if stored_data.get('mode') == 'events':
+        view['period'] = [selected_period, start_date, end_date]
+    return view
+
+
+def full_detail_button(reduced, job, signatures):
+    # Style, label and disabled flag of a 'Load Full Detail' button, shown while charts are reduced
+    style = {'fontSize': '16px', 'marginLeft': '10px', 'display': 'inline-block' if reduced else 'none'}
+    if reduced and job and job['signatures'] == signatures:
+        if job.get('failed'):
+            return style, 'Full detail failed; try again', False
+        return style, 'Loading Full Detail...', True
+    return style, 'Load Full Detail', False
+
+
+@app.callback(
+    [Output('page1-full-detail', 'style'),
+     Output('page1-full-detail', 'children'),
+     Output('page1-full-detail', 'disabled')],
+    [Input('page1-figure-signatures', 'data'),
+     Input('page1-detail-job', 'data')]
+)
+def show_full_detail(signatures, job):
+    # Only while charts on screen were reduced to fit the response-time budget
+    return full_detail_button(signatures and signatures[2], job, signatures)
+
+
+@app.callback(
+    [Output('page1-detail-job', 'data'),
+     Output('page1-detail-interval', 'disabled')],
+    Input('page1-full-detail', 'n_clicks'),
+    [State('page1-stored-data', 'data'),
+     State('page1-visualization-dropdown', 'value'),
+     State('page1-location-dropdown', 'value'),
+     State('page1-sales-manager-dropdown', 'value'),
+     State('page1-consultant-dropdown', 'value'),
+     State('page1-period-dropdown', 'value'),
+     State('page1-period-range', 'start_date'),
+     State('page1-period-range', 'end_date'),
+     State('page1-figure-signatures', 'data')],
+    prevent_initial_call=True
+)
+def load_full_detail(n_clicks, stored_data, selected_visualization, selected_location, selected_sales_manager, selected_consultant, selected_period, start_date, end_date, signatures):
+    if not n_clicks or not stored_data or not signatures:
+        return dash.no_update, dash.no_update
+    view = detail_view(stored_data, selected_visualization, selected_location, selected_sales_manager, selected_consultant, selected_period, start_date, end_date)
+    filters = {'Dealer Location': selected_location, 'Sales Manager': selected_sales_manager, 'Sales Consultant': selected_consultant}
+    ctx = charts.view_context(selected_location, selected_sales_manager, selected_consultant, stored_data.get('mode'))
+    keys = charts.chart_keys(selected_visualization)
+
+    def build():
+        # The exact charts, without a budget; runs in lod's background thread
+        filtered_df, backend, cache_key = filtered_source(stored_data, filters, selected_period, start_date, end_date)
+        viz_data = charts.build_charts(keys, filtered_df, ctx, backend, cache_key)
+        if stored_data.get('preview_of'):
+            viz_data = preview.mark(viz_data)
+        return {'charts': keys, 'figures': [fig for fig, _ in viz_data], 'descriptions': [description for _, description in viz_data],
+                'signatures': [selected_visualization, [figpatch.figure_signature(selected_visualization, fig) for fig, _ in viz_data], []]}
+
+    job = lod.job_id(view, reuse=not (stored_data.get('source') == 'database' and dbsource.enabled()))
+    lod.start(job, build)
+    return {'job': job, 'view': lod.job_id(view), 'signatures': signatures}, False
+
+
+@app.callback(
+    [Output({'type': 'page1-chart-graph', 'index': ALL}, 'figure', allow_duplicate=True),
+     Output({'type': 'page1-chart-description', 'index': ALL}, 'children', allow_duplicate=True),
+     Output('page1-figure-signatures', 'data', allow_duplicate=True),
+     Output('page1-detail-job', 'data', allow_duplicate=True),
+     Output('page1-detail-interval', 'disabled', allow_duplicate=True)],
+    Input('page1-detail-interval', 'n_intervals'),
+    [State('page1-detail-job', 'data'),
+     State('page1-stored-data', 'data'),
+     State('page1-visualization-dropdown', 'value'),
+     State('page1-location-dropdown', 'value'),
+     State('page1-sales-manager-dropdown', 'value'),
+     State('page1-consultant-dropdown', 'value'),
+     State('page1-period-dropdown', 'value'),
+     State('page1-period-range', 'start_date'),
+     State('page1-period-range', 'end_date'),
+     State('page1-figure-signatures', 'data')],
+    prevent_initial_call=True
+)
+def check_full_detail(n_intervals, job, stored_data, selected_visualization, selected_location, selected_sales_manager, selected_consultant, selected_period, start_date, end_date, signatures):
+    graphs, descriptions = dash.callback_context.outputs_list[:2]
+    unchanged = [dash.no_update] * len(graphs), [dash.no_update] * len(descriptions), dash.no_update
+    if not job or job.get('failed'):
+        return *unchanged, dash.no_update, True
+    view = detail_view(stored_data or {}, selected_visualization, selected_location, selected_sales_manager, selected_consultant, selected_period, start_date, end_date)
+    if lod.job_id(view) != job['view'] or signatures != job['signatures']:
+        # The view changed since the click; its exact charts are not wanted any more
+        return *unchanged, None, True
+    status = lod.status(job['job'])
+    if status == 'running':
+        return *unchanged, dash.no_update, False
+    if status == 'failed':
+        return *unchanged, dict(job, failed=True), True
+    result = lod.result(job['job'])
+    figures = dict(zip(result['charts'], result['figures']))
+    texts = dict(zip(result['charts'], result['descriptions']))
+    return ([figures.get(graph['id']['index'], dash.no_update) for graph in graphs],
+            [texts.get(description['id']['index'], dash.no_update) for description in descriptions],
+            result['signatures'], None, True)
 
 
 # Layout for Page 2 (Visualization Page)
+PAGE2_GRAPH_STYLE = {'height': '600px', 'width': '80%', 'margin': '0 auto'}
+
 layout_page2 = html.Div([
     html.H1("Data Visualization", style={'textAlign': 'center'}),
     html.Div([
@@ -513,9 +944,13 @@ layout_page2 = html.Div([
             multiple=False,
             style={'display': 'inline-block'}
         ),
+        dcc.Checklist(id='page2-static-mode', options=[{'label': ' Static images (slow connections)', 'value': 'static'}], value=[],
+                      persistence=True, persistence_type='local',
+                      style={'fontSize': '16px', 'marginLeft': '10px', 'display': 'inline-block' if imagecache.available() else 'none'}),
         html.Div(id='page2-output-data-upload', style={'display': 'inline-block', 'marginLeft': '10px', 'verticalAlign': 'middle'})
     ], style={'display': 'flex', 'alignItems': 'center', 'marginBottom': '10px', 'justifyContent': 'center'}),
     dcc.Store(id='page2-stored-data'),
+    dcc.Store(id='page2-figure-signature'),
     html.Div(
         dcc.Dropdown(
             id='page2-visualization-dropdown',
@@ -531,7 +966,13 @@ layout_page2 = html.Div([
         style={'textAlign': 'center', 'marginBottom': '20px'}
     ),
     html.Div(id='page2-conditional-dropdowns', style={'textAlign': 'center', 'display': 'flex', 'flexDirection': 'row', 'gap': '-1px', 'justifyContent': 'center'}),
-    dcc.Graph(id='page2-selected-graph', style={'height': '600px', 'width': '80%', 'margin': '0 auto'}),
+    # Only shown while the chart is drawn with less detail to answer quickly; see lod.py
+    html.Div(html.Button('Load Full Detail', id='page2-full-detail', n_clicks=0, style={'display': 'none'}),
+             style={'textAlign': 'center', 'marginTop': '10px'}),
+    dcc.Interval(id='page2-detail-interval', interval=lod.POLL_INTERVAL * 1000, disabled=True),
+    dcc.Store(id='page2-detail-job'),
+    dcc.Graph(id='page2-selected-graph', style=PAGE2_GRAPH_STYLE),
+    html.Div(id='page2-static-chart', style={'width': '80%', 'margin': '0 auto', 'overflowX': 'auto'}),
     html.Div(id='page2-visualization-description', style={'width': '80%', 'margin': '20px auto', 'textAlign': 'left', 'fontSize': '16px'}),
     html.Div(id='page2-error-message', style={'color': 'red', 'marginTop': '10px', 'textAlign': 'center'}),
     html.Div([
@@ -543,6 +984,10 @@ layout_page2 = html.Div([
 # Main app layout
 app.layout = html.Div([
     dcc.Location(id='url', refresh=False),
+    # The page 1 upload, kept across navigation so page 2 can chart its other sheets
+    dcc.Store(id='shared-workbook'),
+    # A random id for this page load, so builds in other tabs never supersede ours; see generations.py
+    dcc.Store(id='page-id'),
     html.Div(id='page-content')
 ])
 
@@ -555,6 +1000,13 @@ def display_page(pathname):
         return layout_page1
 
 # Callbacks for navigation
+@app.callback(Output('shared-workbook', 'data'), Input('page1-stored-data', 'data'))
+def share_workbook(stored_data):
+    # Page 1's store is reset whenever page 1 is shown again; keep the last source until a new one loads
+    if stored_data is None:
+        return dash.no_update
+    return stored_data.get('workbook')
+
 @app.callback(Output('url', 'pathname'), Input('go-to-page2', 'n_clicks'))
 def go_to_page2(n_clicks):
     if n_clicks > 0:
@@ -570,14 +1022,17 @@ def go_to_page1(n_clicks):
     return dash.no_update
 
 # Utility functions
-def parse_contents(contents, filename):
-    content_type, content_string = contents.split(',')
-    decoded = base64.b64decode(content_string)
+# Columns each page 2 chart reads; uploads are checked against these before parsing
+PAGE2_COLUMNS = {
+    'vehicle': ['Existing vehicle Latest1'],
+    'family': ['Product Family', 'Intrested In Exchange'],
+    'followup': ['Completed Followup Count', 'Dealer Location', 'Sales Manager', 'Sales Consultant']
+}
+
+def parse_decoded(decoded, filename, usecols=None, sheet=None):
     try:
-        if 'csv' in filename:
-            df = pd.read_csv(io.StringIO(decoded.decode('utf-8')))
-        elif 'xls' in filename:
-            df = pd.read_excel(io.BytesIO(decoded))
+        if 'csv' in filename or 'xls' in filename:
+            df = ingest.read_frame(decoded, filename, usecols, sheet=sheet)
         else:
             return None, 'Unsupported file type.'
         logger.info(f"File {filename} parsed successfully. Shape: {df.shape}")
@@ -586,8 +1041,59 @@ def parse_contents(contents, filename):
         logger.error(f"Error processing file {filename}: {str(e)}")
         return None, f'There was an error processing this file: {str(e)}'
 
-def create_vehicle_chart(df):
-    df_count = df['Existing vehicle Latest1'].value_counts().reset_index()
+def store_contents(contents, filename, selected_viz=None, workbook=None, session=None):
+    try:
+        if contents is not None:
+            governor.check_upload(contents)
+            decoded = datastore.decode_contents(contents)
+            header = ingest.read_header(decoded, filename)
+        else:
+            # No page 2 upload: use the workbook uploaded on page 1, whose header rows were read then
+            decoded, filename, header = workbooks.read(workbook), workbook['filename'], dict(workbook['sheets'])
+        # Each chart parses only the sheet that has its columns
+        sheet = ingest.find_sheet(header, PAGE2_COLUMNS.get(selected_viz, []))
+        columns = header.get(sheet, [])
+    except governor.ResourceLimitError as e:
+        return None, str(e)
+    except Exception as e:
+        logger.error(f"Error reading header of {filename}: {str(e)}")
+        return None, f'There was an error processing this file: {str(e)}'
+    missing_columns = ingest.missing_columns(columns, PAGE2_COLUMNS.get(selected_viz, []))
+    if missing_columns:
+        return None, f"Missing columns: {', '.join(missing_columns)}"
+
+    # Within a sheet the projection does not depend on the selected chart, so every callback resolves the same key
+    usecols = ingest.stored_columns(columns, [col for cols in PAGE2_COLUMNS.values() for col in cols])
+    key = datastore.dataset_key(decoded, usecols, sheet)
+    if datastore.exists(key):
+        return key, 'Data uploaded successfully.'
+
+    def parse(raw):
+        df, message = parse_decoded(raw, filename, usecols, sheet)
+        if df is None:
+            raise ValueError(message)
+        governor.check_dataset(key, df, session)
+        return df
+
+    try:
+        # Rows and an estimate of the memory they need, from the sheet dimensions
+        governor.check_rows(decoded, filename, sheet, usecols)
+        with governor.heavy_job():
+            # Managers uploading the same file together parse it once
+            datastore.ingest(decoded, parse, columns=usecols, sheet=sheet)
+            # Built once from the stored rows, so the first chart only sums the cube
+            load_cube(key)
+    except (governor.ResourceLimitError, ValueError) as e:
+        return None, str(e)
+    return key, 'Data uploaded successfully.'
+
+def load_cube(key):
+    # The page 2 charts are sums over this small cube, never scans of the rows; see exchangecube.py
+    return exchangecube.get_cube(key, lambda: datastore.load_dataset(key, columns=exchangecube.DIMENSIONS))
+
+def create_vehicle_chart(cube, keep=None):
+    # ``keep``: at most this many bars, the smallest models summed as 'Other' (see lod.coarsen)
+    df_count = lod.coarsen(exchangecube.counts(cube, 'Existing vehicle Latest1'), keep).reset_index()
     df_count.columns = ['Existing vehicle Latest1', 'Interested_Count']
     x_col = 'Existing vehicle Latest1'
     title = "Number of Interested Customers by Existing Vehicle Model"
@@ -603,10 +1109,9 @@ def create_vehicle_chart(df):
     
     return fig
 
-def create_family_etbr(df):
-    total_enquiries_df = df.groupby('Product Family').size().reset_index(name='Total_Enquiries')
-    interested_df = df[df['Intrested In Exchange'] == True]
-    interested_df = interested_df.groupby('Product Family').size().reset_index(name='Interested_Enquiries')
+def create_family_etbr(cube):
+    total_enquiries_df = exchangecube.counts(cube, 'Product Family', sort=True).reset_index(name='Total_Enquiries')
+    interested_df = exchangecube.counts(cube[cube['Intrested In Exchange'] == True], 'Product Family', sort=True).reset_index(name='Interested_Enquiries')
     merged_df = pd.merge(total_enquiries_df, interested_df, on='Product Family', how='left').fillna(0)
     melted_df = merged_df.melt(id_vars=['Product Family'], 
                                value_vars=['Total_Enquiries', 'Interested_Enquiries'],
@@ -625,25 +1130,21 @@ def create_family_etbr(df):
     fig.update_traces(texttemplate='%{text}', textposition='outside')
     return fig
 
-def create_followup_tracks(df, location=None, manager=None, consultant=None):
-    if 'Completed Followup Count' not in df.columns:
+def followup_level(location=None, manager=None, consultant=None):
+    # The column the follow-up chart has a group of bars for
+    return 'Sales Consultant' if consultant else ('Sales Manager' if manager else ('Dealer Location' if location else 'Sales Consultant'))
+
+def create_followup_tracks(cube, location=None, manager=None, consultant=None, keep=None):
+    # ``cube`` is already narrowed to the selected location, manager and consultant
+    if 'Completed Followup Count' not in cube.columns:
         raise ValueError("'Completed Followup Count' column not found in the data.")
     
-    # Apply filters
-    if location:
-        df = df[df['Dealer Location'] == location]
-    if manager:
-        df = df[df['Sales Manager'] == manager]
-    if consultant:
-        df = df[df['Sales Consultant'] == consultant]
-    
-    df_filtered = df[df['Completed Followup Count'].isin([0, 1])]
-    
-    groupby_column = 'Sales Consultant' if consultant else ('Sales Manager' if manager else ('Dealer Location' if location else 'Sales Consultant'))
-    
-    df_count = df_filtered.groupby([groupby_column, 'Completed Followup Count']).size().reset_index(name='Count')
+    groupby_column = followup_level(location, manager, consultant)
+
+    tracked = cube[cube['Completed Followup Count'].isin([0, 1])]
+    df_count = exchangecube.counts(tracked, [groupby_column, 'Completed Followup Count'], sort=True).reset_index(name='Count')
     df_pivot = df_count.pivot(index=groupby_column, columns='Completed Followup Count', values='Count').fillna(0)
-    df_pivot = df_pivot.reset_index().rename(columns={0: 'Followup_0', 1: 'Followup_1'})
+    df_pivot = lod.coarsen(df_pivot, keep).reset_index().rename(columns={0: 'Followup_0', 1: 'Followup_1'})
     df_pivot['Total_Followups'] = df_pivot['Followup_0'] + df_pivot['Followup_1']
     df_melted = df_pivot.melt(id_vars=[groupby_column], value_vars=['Followup_0', 'Followup_1'], 
                               var_name='Followup_Status', value_name='Count')
@@ -663,23 +1164,26 @@ def create_followup_tracks(df, location=None, manager=None, consultant=None):
     fig.update_traces(texttemplate='%{text}', textposition='outside')
     return fig
 
-def get_vehicle_description(df):
-    total_customers = len(df)
-    unique_models = df['Existing vehicle Latest1'].nunique()
-    top_model = df['Existing vehicle Latest1'].value_counts().index[0]
+def get_vehicle_description(cube):
+    total_customers = exchangecube.total(cube)
+    model_counts = exchangecube.counts(cube, 'Existing vehicle Latest1')
+    unique_models = len(model_counts)
+    top_model = model_counts.index[0]
     return f"This graph shows the distribution of interested customers across different existing vehicle models. There are {total_customers} total customers interested in an exchange, spread across {unique_models} unique vehicle models. The most common existing vehicle model is '{top_model}'."
 
-def get_family_description(df):
-    total_enquiries = df['Product Family'].count()
-    interested_enquiries = df[df['Intrested In Exchange'] == True]['Product Family'].count()
-    top_family = df['Product Family'].value_counts().index[0]
+def get_family_description(cube):
+    family_counts = exchangecube.counts(cube, 'Product Family')
+    total_enquiries = family_counts.sum()
+    interested_enquiries = exchangecube.counts(cube[cube['Intrested In Exchange'] == True], 'Product Family').sum()
+    top_family = family_counts.index[0]
     return f"This graph compares the total enquiries and interested enquiries for each product family. Out of {total_enquiries} total enquiries, {interested_enquiries} showed interest in an exchange. The product family with the most enquiries is '{top_family}'."
 
-def get_followup_description(df, location, manager, consultant):
-    total_followups = len(df)
-    called_once = df[df['Completed Followup Count'] == 1].shape[0]
-    called_at_least_once = df[df['Completed Followup Count'] >= 1].shape[0]
-    not_called = df[df['Completed Followup Count'] == 0].shape[0]
+def get_followup_description(cube, location, manager, consultant):
+    followups = cube['Completed Followup Count']
+    total_followups = exchangecube.total(cube)
+    called_once = exchangecube.total(cube[followups == 1])
+    called_at_least_once = exchangecube.total(cube[followups >= 1])
+    not_called = exchangecube.total(cube[followups == 0])
     call_rate = (called_at_least_once / total_followups) * 100 if total_followups > 0 else 0
     
     filter_text = f"Location: {location}, " if location else ""
@@ -701,26 +1205,58 @@ def get_followup_description(df, location, manager, consultant):
     
     return description
 
+def page2_chart(selected_viz, cube, location=None, manager=None, consultant=None, budget=None):
+    # Figure and description of a page 2 chart; with a ``budget``, one with too many bars is reduced (see lod.py)
+    level = {'vehicle': 'Existing vehicle Latest1', 'followup': followup_level(location, manager, consultant)}.get(selected_viz)
+    detail = None
+    if budget is not None and level in cube.columns:
+        detail = budget.plan([(selected_viz, 'bars', cube[level].nunique())]).get(selected_viz)
+    keep = detail.keep if detail else None
+    if selected_viz == 'vehicle':
+        fig, description = create_vehicle_chart(cube, keep), get_vehicle_description(cube)
+    elif selected_viz == 'family':
+        fig, description = create_family_etbr(cube), get_family_description(cube)
+    elif selected_viz == 'followup':
+        fig = create_followup_tracks(cube, location, manager, consultant, keep)
+        description = get_followup_description(cube, location, manager, consultant)
+    else:
+        return go.Figure(), ''
+    return lod.apply(detail, fig, description, level)
+
+# The chart image route renders page 2 charts on demand too, e.g. for intranet embeds
+# Each reads only the hierarchy filters from the query string
+imagecache.register('page2-vehicle', lambda key, params: create_vehicle_chart(
+    exchangecube.select(load_cube(key), params)), imagecache.FILTER_COLUMNS)
+imagecache.register('page2-family', lambda key, params: create_family_etbr(
+    exchangecube.select(load_cube(key), params)), imagecache.FILTER_COLUMNS)
+imagecache.register('page2-followup', lambda key, params: create_followup_tracks(
+    exchangecube.select(load_cube(key), params),
+    params.get('Dealer Location'), params.get('Sales Manager'), params.get('Sales Consultant')), imagecache.FILTER_COLUMNS)
+
 @app.callback(
     Output('page2-conditional-dropdowns', 'children'),
     Input('page2-visualization-dropdown', 'value')
 )
 def update_dropdowns(selected_viz):
-    if selected_viz == 'followup':
+    # Every page 2 chart can be narrowed to a location, manager and consultant
+    if selected_viz in PAGE2_COLUMNS:
         return [
             dcc.Dropdown(
                 id={'type': 'page2-dynamic-dropdown', 'index': 'location'}, 
                 placeholder='Select Location', 
+                search_order='original',
                 style={'width': '100%', 'margin': '0', 'padding': '0'}
             ),
             dcc.Dropdown(
                 id={'type': 'page2-dynamic-dropdown', 'index': 'manager'}, 
                 placeholder='Select Sales Manager', 
+                search_order='original',
                 style={'width': '100%', 'margin': '0', 'padding': '0'}
             ),
             dcc.Dropdown(
                 id={'type': 'page2-dynamic-dropdown', 'index': 'consultant'}, 
                 placeholder='Select Sales Consultant', 
+                search_order='original',
                 style={'width': '100%', 'margin': '0', 'padding': '0'}
             )
         ]
@@ -731,14 +1267,21 @@ def update_dropdowns(selected_viz):
      Output('page2-selected-graph', 'figure'),
      Output('page2-error-message', 'children'),
      Output('page2-stored-data', 'data'),
-     Output('page2-visualization-description', 'children')],
+     Output('page2-visualization-description', 'children'),
+     Output('page2-figure-signature', 'data'),
+     Output('page2-static-chart', 'children'),
+     Output('page2-selected-graph', 'style')],
     [Input('page2-upload-data', 'contents'),
      Input('page2-visualization-dropdown', 'value'),
-     Input({'type': 'page2-dynamic-dropdown', 'index': ALL}, 'value')],
+     Input({'type': 'page2-dynamic-dropdown', 'index': ALL}, 'value'),
+     Input('page2-static-mode', 'value')],
     [State('page2-upload-data', 'filename'),
-     State('page2-stored-data', 'data')]
+     State('page2-stored-data', 'data'),
+     State('page2-figure-signature', 'data'),
+     State('shared-workbook', 'data'),
+     State('page-id', 'data')]
 )
-def update_output(upload_contents, selected_viz, dynamic_values, filename, stored_data):
+def update_output(upload_contents, selected_viz, dynamic_values, static_mode, filename, stored_data, previous_signature, workbook, page_id):
     ctx = dash.callback_context
     triggered_id = ctx.triggered[0]['prop_id'].split('.')[0]
     
@@ -746,101 +1289,178 @@ def update_output(upload_contents, selected_viz, dynamic_values, filename, store
     error_message = ''
     description = ''
 
-    if upload_contents is None and stored_data is None:
-        return 'No data uploaded yet.', fig, '', None, ''
-
-    if triggered_id == 'page2-upload-data':
-        df, message = parse_contents(upload_contents, filename)
-        if df is None:
-            return message, fig, message, None, ''
-        stored_data = df.to_json(date_format='iso', orient='split')
-    elif stored_data:
-        df = pd.read_json(stored_data, orient='split')
-    else:
-        return 'No data available.', fig, 'Please upload data first.', None, ''
-
+    shared = upload_contents is None and workbooks.exists(workbook)
+    if upload_contents is None and stored_data is None and not shared:
+        return 'No data uploaded yet.', fig, '', None, '', None, [], PAGE2_GRAPH_STYLE
+    if shared and selected_viz not in PAGE2_COLUMNS:
+        # Nothing is parsed until a chart asks for one of the workbook's sheets
+        return f'Using "{workbook["filename"]}" from page 1.', fig, '', stored_data, '', None, [], PAGE2_GRAPH_STYLE
+
+    # A different chart may need a different sheet of the same workbook
+    if triggered_id in ('page2-upload-data', 'page2-visualization-dropdown') or (shared and not stored_data):
+        key, message = store_contents(upload_contents, filename, selected_viz, workbook, f'{page_id}:page2' if page_id else None)
+        if key is None:
+            return message, fig, message, None, '', None, [], PAGE2_GRAPH_STYLE
+        stored_data = {'key': key}
+    elif not (stored_data and datastore.exists(stored_data.get('key'))):
+        return 'No data available.', fig, 'Please upload data first.', None, '', None, [], PAGE2_GRAPH_STYLE
+
+    required_columns = PAGE2_COLUMNS.get(selected_viz)
+    missing_columns = ingest.missing_columns(datastore.column_names(stored_data['key']), required_columns or [])
+    if missing_columns:
+        message = f"Missing columns: {', '.join(missing_columns)}"
+        return 'Data processed successfully.', fig, message, stored_data, '', None, [], PAGE2_GRAPH_STYLE
+    location = dynamic_values[0] if len(dynamic_values) > 0 else None
+    manager = dynamic_values[1] if len(dynamic_values) > 1 else None
+    consultant = dynamic_values[2] if len(dynamic_values) > 2 else None
+    filters = {'Dealer Location': location, 'Sales Manager': manager, 'Sales Consultant': consultant}
+
+    # The chart must be back within the budget; see lod.py. Images are cached
+    # under the view's name for a year, so they are always drawn in full
+    static = 'static' in (static_mode or []) and imagecache.available()
+    budget = lod.Budget()
     try:
-        if selected_viz == 'vehicle':
-            fig = create_vehicle_chart(df)
-            description = get_vehicle_description(df)
-        elif selected_viz == 'family':
-            fig = create_family_etbr(df)
-            description = get_family_description(df)
-        elif selected_viz == 'followup':
-            location = dynamic_values[0] if len(dynamic_values) > 0 else None
-            manager = dynamic_values[1] if len(dynamic_values) > 1 else None
-            consultant = dynamic_values[2] if len(dynamic_values) > 2 else None
-            fig = create_followup_tracks(df, location, manager, consultant)
-            description = get_followup_description(df, location, manager, consultant)
+        with governor.heavy_job():
+            cube = exchangecube.select(load_cube(stored_data['key']), filters)
+            fig, description = page2_chart(selected_viz, cube, location, manager, consultant, None if static else budget)
 
         logger.info(f"Visualization {selected_viz} created successfully")
     except Exception as e:
         error_message = f"Error creating visualization: {str(e)}"
         logger.error(error_message)
 
-    return 'Data processed successfully.', fig, error_message, stored_data, description
+    image = None
+    if static and selected_viz in PAGE2_COLUMNS and not error_message:
+        image = imagecache.image_src(stored_data['key'], f'page2-{selected_viz}', fig, filters)
+    if image:
+        # The browser gets the cached image; the graph is hidden and left empty
+        return ('Data processed successfully.', go.Figure(), error_message, stored_data, description, None,
+                html.Img(src=image, alt=selected_viz), dict(PAGE2_GRAPH_STYLE, display='none'))
+
+    # Same chart and categories as on screen: send only the new numbers and title;
+    # a chart reduced to fit the budget shows the 'Load Full Detail' button
+    signature = [figpatch.figure_signature(selected_viz, fig), budget.reduced]
+    if triggered_id != 'page2-upload-data' and signature == previous_signature:
+        fig = figpatch.fill_patch(Patch(), fig)
+
+    return 'Data processed successfully.', fig, error_message, stored_data, description, signature, [], PAGE2_GRAPH_STYLE
+
+def page2_filters(dynamic_values):
+    values = list(dynamic_values or []) + [None] * 3
+    return {'Dealer Location': values[0], 'Sales Manager': values[1], 'Sales Consultant': values[2]}
 
 @app.callback(
-    Output({'type': 'page2-dynamic-dropdown', 'index': 'location'}, 'options'),
-    [Input('page2-upload-data', 'contents'),
-     Input('page2-visualization-dropdown', 'value')],
-    State('page2-upload-data', 'filename')
+    [Output('page2-full-detail', 'style'),
+     Output('page2-full-detail', 'children'),
+     Output('page2-full-detail', 'disabled')],
+    [Input('page2-figure-signature', 'data'),
+     Input('page2-detail-job', 'data')]
 )
-def update_location_options(upload_contents, selected_viz, filename):
-    if selected_viz != 'followup' or upload_contents is None:
-        return []
+def show_page2_full_detail(signature, job):
+    return full_detail_button(signature and signature[1], job, signature)
+
+@app.callback(
+    [Output('page2-detail-job', 'data'),
+     Output('page2-detail-interval', 'disabled')],
+    Input('page2-full-detail', 'n_clicks'),
+    [State('page2-stored-data', 'data'),
+     State('page2-visualization-dropdown', 'value'),
+     State({'type': 'page2-dynamic-dropdown', 'index': ALL}, 'value'),
+     State('page2-figure-signature', 'data')],
+    prevent_initial_call=True
+)
+def load_page2_full_detail(n_clicks, stored_data, selected_viz, dynamic_values, signature):
+    if not n_clicks or not stored_data or not signature:
+        return dash.no_update, dash.no_update
+    key = stored_data['key']
+    filters = page2_filters(dynamic_values)
+
+    def build():
+        # The exact chart, without a budget; runs in lod's background thread
+        cube = exchangecube.select(load_cube(key), filters)
+        fig, description = page2_chart(selected_viz, cube, *filters.values())
+        return {'figure': fig, 'description': description, 'signature': [figpatch.figure_signature(selected_viz, fig), []]}
+
+    job = lod.job_id({'data': key, 'chart': selected_viz, 'filters': filters})
+    lod.start(job, build)
+    return {'job': job, 'view': job, 'signatures': signature}, False
 
-    df, _ = parse_contents(upload_contents, filename)
-    if df is None:
+@app.callback(
+    [Output('page2-selected-graph', 'figure', allow_duplicate=True),
+     Output('page2-visualization-description', 'children', allow_duplicate=True),
+     Output('page2-figure-signature', 'data', allow_duplicate=True),
+     Output('page2-detail-job', 'data', allow_duplicate=True),
+     Output('page2-detail-interval', 'disabled', allow_duplicate=True)],
+    Input('page2-detail-interval', 'n_intervals'),
+    [State('page2-detail-job', 'data'),
+     State('page2-stored-data', 'data'),
+     State('page2-visualization-dropdown', 'value'),
+     State({'type': 'page2-dynamic-dropdown', 'index': ALL}, 'value'),
+     State('page2-figure-signature', 'data')],
+    prevent_initial_call=True
+)
+def check_page2_full_detail(n_intervals, job, stored_data, selected_viz, dynamic_values, signature):
+    if not job or job.get('failed'):
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update, True
+    view = {'data': (stored_data or {}).get('key'), 'chart': selected_viz, 'filters': page2_filters(dynamic_values)}
+    if lod.job_id(view) != job['view'] or signature != job['signatures']:
+        # The chart or its filters changed since the click; the exact chart is not wanted any more
+        return dash.no_update, dash.no_update, dash.no_update, None, True
+    status = lod.status(job['job'])
+    if status == 'running':
+        return dash.no_update, dash.no_update, dash.no_update, dash.no_update, False
+    if status == 'failed':
+        return dash.no_update, dash.no_update, dash.no_update, dict(job, failed=True), True
+    result = lod.result(job['job'])
+    return result['figure'], result['description'], result['signature'], None, True
+
+def followup_options(stored_data, level, filters, search_value, selected):
+    # Options come from the dataset update_output resolved, so keystrokes never resend the upload
+    key = (stored_data or {}).get('key')
+    if not datastore.exists(key) or ingest.missing_columns(datastore.column_names(key), typeahead.LEVELS):
         return []
+    # The first matches only; typing searches the rest on the server
+    return typeahead.options(typeahead.get_index(key, lambda: datastore.attach(key)), level, filters, search_value, selected)
 
-    locations = df['Dealer Location'].unique()
-    return [{'label': loc, 'value': loc} for loc in locations]
+@app.callback(
+    Output({'type': 'page2-dynamic-dropdown', 'index': 'location'}, 'options'),
+    [Input('page2-stored-data', 'data'),
+     Input('page2-visualization-dropdown', 'value'),
+     Input({'type': 'page2-dynamic-dropdown', 'index': 'location'}, 'search_value')],
+    State({'type': 'page2-dynamic-dropdown', 'index': 'location'}, 'value')
+)
+def update_location_options(stored_data, selected_viz, search_value, selected_location):
+    if selected_viz not in PAGE2_COLUMNS:
+        return []
+    return followup_options(stored_data, 'Dealer Location', None, search_value, selected_location)
 
 @app.callback(
     Output({'type': 'page2-dynamic-dropdown', 'index': 'manager'}, 'options'),
     [Input({'type': 'page2-dynamic-dropdown', 'index': 'location'}, 'value'),
-     Input('page2-upload-data', 'contents'),
-     Input('page2-visualization-dropdown', 'value')],
-    State('page2-upload-data', 'filename')
+     Input('page2-stored-data', 'data'),
+     Input('page2-visualization-dropdown', 'value'),
+     Input({'type': 'page2-dynamic-dropdown', 'index': 'manager'}, 'search_value')],
+    State({'type': 'page2-dynamic-dropdown', 'index': 'manager'}, 'value')
 )
-def update_manager_options(selected_location, upload_contents, selected_viz, filename):
-    if selected_viz != 'followup' or upload_contents is None:
-        return []
-
-    df, _ = parse_contents(upload_contents, filename)
-    if df is None:
+def update_manager_options(selected_location, stored_data, selected_viz, search_value, selected_manager):
+    if selected_viz not in PAGE2_COLUMNS:
         return []
-
-    if selected_location:
-        df = df[df['Dealer Location'] == selected_location]
-    
-    managers = df['Sales Manager'].unique()
-    return [{'label': mgr, 'value': mgr} for mgr in managers]
+    return followup_options(stored_data, 'Sales Manager', {'Dealer Location': selected_location}, search_value, selected_manager)
 
 @app.callback(
     Output({'type': 'page2-dynamic-dropdown', 'index': 'consultant'}, 'options'),
     [Input({'type': 'page2-dynamic-dropdown', 'index': 'manager'}, 'value'),
      Input({'type': 'page2-dynamic-dropdown', 'index': 'location'}, 'value'),
-     Input('page2-upload-data', 'contents'),
-     Input('page2-visualization-dropdown', 'value')],
-    State('page2-upload-data', 'filename')
+     Input('page2-stored-data', 'data'),
+     Input('page2-visualization-dropdown', 'value'),
+     Input({'type': 'page2-dynamic-dropdown', 'index': 'consultant'}, 'search_value')],
+    State({'type': 'page2-dynamic-dropdown', 'index': 'consultant'}, 'value')
 )
-def update_consultant_options(selected_manager, selected_location, upload_contents, selected_viz, filename):
-    if selected_viz != 'followup' or upload_contents is None:
-        return []
-
-    df, _ = parse_contents(upload_contents, filename)
-    if df is None:
+def update_consultant_options(selected_manager, selected_location, stored_data, selected_viz, search_value, selected_consultant):
+    if selected_viz not in PAGE2_COLUMNS:
         return []
-
-    if selected_location:
-        df = df[df['Dealer Location'] == selected_location]
-    if selected_manager:
-        df = df[df['Sales Manager'] == selected_manager]
-    
-    consultants = df['Sales Consultant'].unique()
-    return [{'label': cons, 'value': cons} for cons in consultants]
+    return followup_options(stored_data, 'Sales Consultant', {'Dealer Location': selected_location, 'Sales Manager': selected_manager},
+                            search_value, selected_consultant)
 
 if __name__ == '__main__':
     app.run_server(debug=True)
\ No newline at end of file
@@ -0,0 +1,129 @@
+"""Per-worker LRU cache of chart aggregates.
+
+Entries are keyed by dataset key, backend, the active Location / Manager /
+Consultant filters and the groupby. Each entry holds the sums for every
+metric computed so far, so a single chart can reuse an aggregate that was
+computed for 'All Visualisations'. Datasets are content-addressed, so an
+entry never goes stale. Old entries are simply evicted (ETBR_AGG_CACHE_ENTRIES,
+default 4096).
+
+Entries can also be published to ``<ETBR_DATA_DIR>/aggregates`` (see
+warmer.py). A worker that misses in its own LRU reads a published entry
+before aggregating, so a view warmed by one worker is warm in all of them.
+The shared directory is trimmed to ETBR_AGG_SHARED_MB (default 256),
+oldest first.
+"""
+import hashlib
+import json
+import os
+import pickle
+import threading
+import uuid
+from collections import OrderedDict
+
+import pandas as pd
+
+import datastore
+
+MAX_ENTRIES = int(os.environ.get('ETBR_AGG_CACHE_ENTRIES', 4096))
+MAX_SHARED_BYTES = int(float(os.environ.get('ETBR_AGG_SHARED_MB', 256)) * 2**20)
+SHARED_DIR = os.path.join(datastore.DATA_DIR, 'aggregates')
+
+_entries = OrderedDict()
+_lock = threading.Lock()
+_writes = [0]
+
+
+def key(dataset_key, filters):
+    return (dataset_key, tuple(sorted((column, value) for column, value in (filters or {}).items() if value is not None)))
+
+
+def _metrics(agg):
+    # Grouped aggregates are DataFrames with one column per metric; totals are Series
+    return list(agg.columns) if agg.ndim == 2 else list(agg.index)
+
+
+def _shared_path(entry):
+    spec = json.dumps(entry, default=str)
+    return os.path.join(SHARED_DIR, hashlib.sha256(spec.encode('utf-8')).hexdigest() + '.pickle')
+
+
+def _read_shared(entry):
+    try:
+        with open(_shared_path(entry), 'rb') as handle:
+            return pickle.load(handle)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def _trim():
+    entries = []
+    for item in os.scandir(SHARED_DIR):
+        try:
+            stat = item.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, item.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= MAX_SHARED_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def publish(cache_key, backend_name, group_by):
+    """Share this worker's entry for ``group_by`` with the other workers."""
+    entry = (cache_key, backend_name, group_by)
+    with _lock:
+        agg = _entries.get(entry)
+    if agg is None:
+        return
+    os.makedirs(SHARED_DIR, exist_ok=True)
+    # Write then rename, so another worker never reads half a pickle
+    path = _shared_path(entry)
+    temp_path = f'{path}.{uuid.uuid4().hex}'
+    with open(temp_path, 'wb') as handle:
+        pickle.dump(agg, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+    with _lock:
+        _writes[0] += 1
+        trim = _writes[0] % 50 == 0
+    if trim:
+        _trim()
+
+
+def get(cache_key, backend_name, group_by, metrics):
+    entry = (cache_key, backend_name, group_by)
+    with _lock:
+        agg = _entries.get(entry)
+    if agg is None or not set(metrics) <= set(_metrics(agg)):
+        shared = _read_shared(entry)
+        if shared is None:
+            return None
+        put(cache_key, backend_name, group_by, shared)
+    with _lock:
+        agg = _entries.get(entry)
+        if agg is None or not set(metrics) <= set(_metrics(agg)):
+            return None
+        _entries.move_to_end(entry)
+    # A fresh selection, so the builders never see (or modify) the cached object
+    return agg[list(metrics)]
+
+
+def put(cache_key, backend_name, group_by, agg):
+    entry = (cache_key, backend_name, group_by)
+    with _lock:
+        cached = _entries.get(entry)
+        if cached is not None:
+            # Keep metrics an earlier, wider plan already computed
+            extra = [metric for metric in _metrics(cached) if metric not in _metrics(agg)]
+            if extra:
+                agg = agg.join(cached[extra]) if agg.ndim == 2 else pd.concat([agg, cached[extra]])
+        _entries[entry] = agg
+        _entries.move_to_end(entry)
+        while len(_entries) > MAX_ENTRIES:
+            _entries.popitem(last=False)
@@ -0,0 +1,231 @@
+"""Pluggable filter/aggregate backends.
+
+All chart aggregations go through one of these backends:
+
+* ``pandas``: the reference implementation, single-threaded;
+* ``polars``: multi-threaded, reads the memory-mapped Arrow table without copying;
+* ``duckdb``: in-process SQL engine, multi-threaded, scans Arrow or pandas directly.
+
+Set ETBR_BACKEND to choose one. Every backend takes a pandas DataFrame or a
+pyarrow Table and returns pandas objects shaped exactly like the pandas
+backend's output: groups sorted, null keys dropped, missing metrics as zero.
+``benchmark_backends.py`` checks that they agree.
+"""
+import os
+import threading
+
+import pandas as pd
+import pyarrow as pa
+
+import datastore
+
+BACKEND = os.environ.get('ETBR_BACKEND', 'pandas')
+
+
+def columns(source):
+    # Arrow tables and database table references both expose column_names
+    return source.column_names if hasattr(source, 'column_names') else list(source.columns)
+
+
+def _to_pandas(source):
+    return source.to_pandas() if isinstance(source, pa.Table) else source
+
+
+def _is_integer(source, column):
+    if isinstance(source, pa.Table):
+        return pa.types.is_integer(source.schema.field(column).type)
+    return pd.api.types.is_integer_dtype(source[column])
+
+
+def _finish_aggregate(agg, source, metrics, present):
+    # Missing metrics count as zero; integer sums stay integers like pandas' sum
+    if isinstance(agg, pd.DataFrame):
+        for metric in metrics:
+            if metric not in present:
+                agg[metric] = 0
+            elif _is_integer(source, metric):
+                agg[metric] = agg[metric].fillna(0).astype('int64')
+        return agg[metrics]
+    totals = {}
+    for metric in metrics:
+        value = agg[metric] if metric in present else 0
+        if pd.isna(value):
+            value = 0
+        totals[metric] = int(value) if metric in present and _is_integer(source, metric) else value
+    return pd.Series(totals, dtype='object')
+
+
+class PandasBackend:
+    name = 'pandas'
+
+    def filter(self, source, filters):
+        if isinstance(source, pa.Table):
+            return datastore.filter_table(source, filters).to_pandas()
+        for column, value in (filters or {}).items():
+            if value is None or column not in source.columns:
+                continue
+            if isinstance(value, (list, tuple)):
+                source = source[source[column].isin(value)]
+            else:
+                source = source[source[column] == value]
+        return source
+
+    def aggregate(self, source, group_by, metrics):
+        df = _to_pandas(source)
+        present = [metric for metric in metrics if metric in df.columns]
+        if group_by:
+            agg = df.groupby(list(group_by))[present].sum()
+        else:
+            agg = df[present].sum()
+        return _finish_aggregate(agg, df, metrics, present)
+
+    def count(self, source, group_by, filters=None):
+        df = self.filter(_to_pandas(source), filters)
+        return df.groupby(list(group_by)).size()
+
+
+class PolarsBackend:
+    name = 'polars'
+
+    def __init__(self):
+        import polars
+        self.pl = polars
+
+    def _frame(self, source):
+        if isinstance(source, pa.Table):
+            return self.pl.from_arrow(source)
+        return self.pl.from_pandas(source)
+
+    def _mask(self, filters, names):
+        pl = self.pl
+        expr = None
+        for column, value in (filters or {}).items():
+            if value is None or column not in names:
+                continue
+            condition = pl.col(column).is_in(list(value)) if isinstance(value, (list, tuple)) else pl.col(column) == value
+            expr = condition if expr is None else expr & condition
+        return expr
+
+    def filter(self, source, filters):
+        mask = self._mask(filters, columns(source))
+        if mask is None:
+            return source
+        return self._frame(source).filter(mask).to_arrow()
+
+    def aggregate(self, source, group_by, metrics):
+        pl = self.pl
+        present = [metric for metric in metrics if metric in columns(source)]
+        lazy = self._frame(source).lazy()
+        if group_by:
+            keys = list(group_by)
+            result = (lazy.drop_nulls(keys)
+                      .group_by(keys)
+                      .agg([pl.col(metric).sum() for metric in present])
+                      .sort(keys)
+                      .collect())
+            agg = result.to_pandas().set_index(keys)
+        else:
+            result = lazy.select([pl.col(metric).sum() for metric in present]).collect()
+            agg = result.to_pandas().iloc[0] if present else pd.Series(dtype='float64')
+        return _finish_aggregate(agg, source, metrics, present)
+
+    def count(self, source, group_by, filters=None):
+        pl = self.pl
+        keys = list(group_by)
+        lazy = self._frame(source).lazy()
+        mask = self._mask(filters, columns(source))
+        if mask is not None:
+            lazy = lazy.filter(mask)
+        result = lazy.drop_nulls(keys).group_by(keys).agg(pl.len().alias('size')).sort(keys).collect()
+        return result.to_pandas().set_index(keys)['size'].astype('int64')
+
+
+def sql_quote(name):
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def sql_where(filters, names, nulls=()):
+    """Build a parameterised WHERE clause from equality / IN filters, skipping None values."""
+    clauses, params = [f'{sql_quote(col)} IS NOT NULL' for col in nulls], []
+    for column, value in (filters or {}).items():
+        if value is None or column not in names:
+            continue
+        if isinstance(value, (list, tuple)):
+            clauses.append(f"{sql_quote(column)} IN ({', '.join('?' for _ in value)})")
+            params.extend(value)
+        else:
+            clauses.append(f'{sql_quote(column)} = ?')
+            params.append(value)
+    return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+
+class DuckDBBackend:
+    name = 'duckdb'
+
+    def __init__(self):
+        import duckdb
+        self.duckdb = duckdb
+        self._local = threading.local()
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self.duckdb.connect()
+            self._local.connection = connection
+        return connection
+
+    def _query(self, source, sql, params):
+        connection = self._connection()
+        connection.register('source', source)
+        try:
+            return connection.execute(sql, params).df()
+        finally:
+            connection.unregister('source')
+
+    def filter(self, source, filters):
+        where, params = sql_where(filters, columns(source))
+        if not where:
+            return source
+        connection = self._connection()
+        connection.register('source', source)
+        try:
+            # A relation, whose to_arrow_table() every duckdb>=1.0 has and none deprecates
+            return connection.sql(f'SELECT * FROM source{where}', params=params).to_arrow_table()
+        finally:
+            connection.unregister('source')
+
+    def aggregate(self, source, group_by, metrics):
+        present = [metric for metric in metrics if metric in columns(source)]
+        sums = ', '.join(f'SUM({sql_quote(metric)}) AS {sql_quote(metric)}' for metric in present)
+        if group_by:
+            keys = ', '.join(sql_quote(col) for col in group_by)
+            where, params = sql_where(None, columns(source), nulls=group_by)
+            select = f'{keys}, {sums}' if sums else keys
+            agg = self._query(source, f'SELECT {select} FROM source{where} GROUP BY {keys} ORDER BY {keys}', params).set_index(list(group_by))
+        elif present:
+            agg = self._query(source, f'SELECT {sums} FROM source', []).iloc[0].fillna(0)
+        else:
+            agg = pd.Series(dtype='float64')
+        return _finish_aggregate(agg, source, metrics, present)
+
+    def count(self, source, group_by, filters=None):
+        keys = ', '.join(sql_quote(col) for col in group_by)
+        where, params = sql_where(filters, columns(source), nulls=group_by)
+        result = self._query(source, f'SELECT {keys}, COUNT(*) AS size FROM source{where} GROUP BY {keys} ORDER BY {keys}', params)
+        return result.set_index(list(group_by))['size'].astype('int64')
+
+
+BACKENDS = {
+    'pandas': PandasBackend,
+    'polars': PolarsBackend,
+    'duckdb': DuckDBBackend
+}
+
+_instances = {}
+
+
+def get_backend(name=None):
+    name = name or BACKEND
+    if name not in _instances:
+        _instances[name] = BACKENDS[name]()
+    return _instances[name]
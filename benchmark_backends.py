@@ -0,0 +1,115 @@
+"""Check that every compute backend agrees with pandas, then time them.
+
+    python benchmark_backends.py --rows 1000000 --backends pandas,polars,duckdb
+
+Parity covers all chart aggregation plans (unfiltered and filtered), the
+page 2 grouped counts, and the chart figures and descriptions built from
+them. The process exits non-zero if any backend differs from pandas.
+"""
+import argparse
+import statistics
+import sys
+import time
+
+import pandas as pd
+import pyarrow as pa
+
+import backends
+import charts
+from loadtest import synthetic_frame
+
+CTX = {
+    'location_display': 'All Locations',
+    'manager_display': '',
+    'consultant_display': '',
+    'halve_totals': True
+}
+
+
+def workload(backend, source):
+    """The aggregations one 'All Visualisations' view and the page 2 charts need."""
+    location = source['Dealer Location'][0].as_py()
+    filtered = backend.filter(source, {'Dealer Location': location})
+    results = {}
+    plan = charts.plan_aggregations(charts.ALL_CHARTS)
+    for group_by, metrics in plan.items():
+        results[('all',) + group_by] = backend.aggregate(source, group_by, metrics)
+        results[('filtered',) + group_by] = backend.aggregate(filtered, group_by, metrics)
+    results['family'] = backend.count(source, ['Product Family'])
+    results['family interested'] = backend.count(source, ['Product Family'], {'Intrested In Exchange': True})
+    results['followup'] = backend.count(source, ['Sales Manager', 'Completed Followup Count'], {'Dealer Location': location, 'Completed Followup Count': [0, 1]})
+    return results
+
+
+def _same(expected, actual):
+    if isinstance(expected, pd.DataFrame):
+        pd.testing.assert_frame_equal(expected, actual, check_dtype=False, check_index_type=False)
+    else:
+        pd.testing.assert_series_equal(expected.astype('float64'), actual.astype('float64'), check_names=False, check_index_type=False)
+
+
+def check_parity(source, names):
+    reference = backends.get_backend('pandas')
+    expected = workload(reference, source)
+    expected_charts = [(fig.to_json(), description) for fig, description in charts.build_charts(charts.ALL_CHARTS, source, CTX, reference)]
+    failures = 0
+    for name in names:
+        if name == 'pandas':
+            continue
+        # Counted per backend, so one backend's differences never fail the next
+        differences = 0
+        backend = backends.get_backend(name)
+        actual = workload(backend, source)
+        for key, value in expected.items():
+            try:
+                _same(value, actual[key])
+            except AssertionError as e:
+                differences += 1
+                print(f'[{name}] {key} differs from pandas:\n{e}')
+        actual_charts = [(fig.to_json(), description) for fig, description in charts.build_charts(charts.ALL_CHARTS, source, CTX, backend)]
+        for chart, expected_chart, actual_chart in zip(charts.ALL_CHARTS, expected_charts, actual_charts):
+            if expected_chart != actual_chart:
+                differences += 1
+                print(f'[{name}] chart {chart!r} differs from pandas')
+        print(f'[{name}] parity {"FAILED" if differences else "ok"}')
+        failures += differences
+    return failures
+
+
+def benchmark(source, names, repeat):
+    timings = {}
+    for name in names:
+        backend = backends.get_backend(name)
+        workload(backend, source)
+        runs = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            workload(backend, source)
+            runs.append(time.perf_counter() - start)
+        timings[name] = statistics.median(runs)
+    baseline = timings.get('pandas')
+    print(f"\n{'backend':<10}{'median ms':>12}{'speedup':>10}")
+    for name, seconds in timings.items():
+        speedup = f'{baseline / seconds:.1f}x' if baseline else '-'
+        print(f'{name:<10}{seconds * 1000:>12.1f}{speedup:>10}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--backends', default=','.join(backends.BACKENDS))
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    names = args.backends.split(',')
+
+    print(f'Generating {args.rows} rows...')
+    # Same shape the app hands to the backends: an Arrow table from the dataset store
+    source = pa.Table.from_pandas(synthetic_frame(args.rows), preserve_index=False)
+
+    failures = check_parity(source, names)
+    benchmark(source, names, args.repeat)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,461 @@
+"""Page 1 chart registry and aggregation planner.
+
+Each chart declares the columns it needs, the dimensions it groups by and
+the metrics it sums. ``build_charts`` merges the aggregations of every
+requested chart so that identical groupbys run once. For example, 'Enquiry
+Type vs ETBR', 'Team vs Enquiry Type Report' and 'Walk In ETBR' share one
+groupby. Each builder then only formats its slice of the aggregate.
+"""
+import time
+
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objs as go
+
+import aggcache
+import backends
+import lod
+import singleflight
+
+MTD_METRICS = ['ENQUIRY MTD', 'TD MTD', 'BOOKING MTD', 'RETAIL MTD']
+LMTD_METRICS = ['ENQUIRY LMTD', 'TD LMTD', 'BOOKING LMTD', 'RETAIL LMTD']
+METRIC_ABBR = {
+    'ENQUIRY MTD': 'E',
+    'TD MTD': 'T',
+    'BOOKING MTD': 'B',
+    'RETAIL MTD': 'R'
+}
+
+
+def view_context(location, manager, consultant, mode='export'):
+    """Title parts and scaling the builders need for a Location / Manager / Consultant view."""
+    return {
+        'location_display': location if location else 'All Locations',
+        'manager_display': f', {manager}' if manager else '',
+        'consultant_display': f', {consultant}' if consultant else '',
+        # Export totals are halved when no location is selected; event data has no such rows
+        'halve_totals': not location and mode != 'events'
+    }
+
+
+def create_title(ctx, base_title):
+    return f"{base_title} for {ctx['location_display']}{ctx['manager_display']}{ctx['consultant_display']}"
+
+
+def _long_format(agg, dimension):
+    # Same shape the charts used to build metric by metric: one row per (metric, group)
+    return agg[MTD_METRICS].reset_index().melt(id_vars=[dimension], value_vars=MTD_METRICS, var_name='Metric', value_name='Value')
+
+
+def _percentages(values, total):
+    return f"""Enquiries: {values[0]:.0f} ({values[0]/total*100:.1f}%)
+        Test Drives: {values[1]:.0f} ({values[1]/total*100:.1f}%)
+        Bookings: {values[2]:.0f} ({values[2]/total*100:.1f}%)
+        Retails: {values[3]:.0f} ({values[3]/total*100:.1f}%)"""
+
+
+def create_etbr_report(totals, ctx):
+    values = [totals[metric] for metric in MTD_METRICS]
+    if ctx['halve_totals']:
+        values = [v / 2 for v in values]
+    chart_df = pd.DataFrame({'Metric': MTD_METRICS, 'Value': values})
+    fig = px.pie(chart_df, values='Value', names='Metric', title=create_title(ctx, 'ETBR Report'))
+
+    fig.update_traces(
+        textposition='inside',
+        texttemplate='%{label}<br>%{value:.2f}<br>%{percent}',
+        hovertemplate='<b>%{label}</b><br>Value: %{value:.2f}<br>Percentage: %{percent}'
+    )
+    fig.update_layout(
+        height=600,
+        width=600)
+
+    total = sum(values)
+    description = f"""
+        This pie chart shows the distribution of Enquiry, Test Drive, Booking, and Retail metrics for the Month-To-Date (MTD) period.
+
+        Total ETBR: {total:.0f}
+        {_percentages(values, total)}
+        """
+
+    return fig, description
+
+
+def create_lmtd_etbr(totals, ctx):
+    metrics = ['ENQUIRY', 'TD', 'BOOKING', 'RETAIL']
+    mtd_values = [totals[f'{metric} MTD'] for metric in metrics]
+    lmtd_values = [totals[f'{metric} LMTD'] for metric in metrics]
+    if ctx['halve_totals']:
+        mtd_values = [v / 2 for v in mtd_values]
+        lmtd_values = [v / 2 for v in lmtd_values]
+    fig = go.Figure()
+    fig.add_trace(go.Bar(x=metrics, y=mtd_values, name='MTD', text=mtd_values, textposition='outside'))
+    fig.add_trace(go.Bar(x=metrics, y=lmtd_values, name='LMTD', text=lmtd_values, textposition='outside'))
+    fig.update_layout(
+        barmode='group',
+        title=create_title(ctx, 'LMTD vs MTD ETBR'),
+        xaxis_title='Metrics',
+        yaxis_title='Values',
+        height=600,
+        width=1000,
+        legend_title='Period',
+        legend=dict(orientation="h"),
+        bargap=0.2,
+        bargroupgap=0.1,
+        xaxis=dict(tickangle=0)
+    )
+
+    mtd_total = sum(mtd_values)
+    lmtd_total = sum(lmtd_values)
+    percent_change = ((mtd_total - lmtd_total) / lmtd_total) * 100
+
+    description = f"""
+        This grouped bar chart compares Month-To-Date (MTD) and Last Month-To-Date (LMTD) values for Enquiry, Test Drive, Booking, and Retail metrics.
+
+        Total MTD: {mtd_total:.0f}
+        Total LMTD: {lmtd_total:.0f}
+        Percent change: {percent_change:.1f}%
+        """
+
+    return fig, description
+
+
+def create_model_etbr(agg, ctx):
+    chart_df = _long_format(agg, 'Model')
+    if chart_df.empty:
+        # Return an empty figure and a message if there's no data
+        fig = go.Figure()
+        fig.update_layout(
+            title=create_title(ctx, 'MODEL ETBR - No Data Available'),
+            annotations=[dict(
+                text='No data available for the current selection',
+                showarrow=False,
+                xref="paper",
+                yref="paper",
+                x=0.5,
+                y=0.5,
+                font=dict(size=20)
+            )]
+        )
+        return fig, "No data available for the current selection."
+
+    fig = px.bar(
+        chart_df,
+        x='Model',
+        y='Value',
+        color='Metric',
+        barmode='group',
+        title=create_title(ctx, 'MODEL ETBR'),
+        labels={'Value': 'Total Value', 'Model': 'Model'},
+        text='Value',
+        custom_data=['Model']
+    )
+    fig.update_layout(
+        yaxis=dict(title='Total Value'),
+        xaxis=dict(title='Model'),
+        showlegend=True,
+        margin=dict(l=40, r=40, t=40, b=40),
+        height=600,
+        width=1000,
+        bargap=0.2,
+        font=dict(size=12)
+    )
+
+    model_totals = lod.categories(agg)[MTD_METRICS].sum(axis=1)
+    description = f"""
+        This grouped bar chart shows the performance of different car models across Enquiry, Test Drive, Booking, and Retail metrics for the Month-To-Date period.
+
+        Top performing model: {model_totals.idxmax()}
+        Total value for top model: {model_totals.max():.0f}
+        """
+
+    return fig, description
+
+
+def create_enquiry_type_etbr(agg, ctx):
+    chart_df = _long_format(agg, 'Enquiry Type')
+    chart_df['Metric'] = chart_df['Metric'].map(METRIC_ABBR)
+    fig = px.sunburst(
+        chart_df,
+        path=['Enquiry Type', 'Metric'],
+        values='Value',
+        custom_data=['Enquiry Type'],
+        title=create_title(ctx, 'Enquiry Type vs ETBR Report')
+    )
+    fig.update_traces(
+        texttemplate='%{label}<br>%{value}',
+        textfont=dict(size=12, color='black')
+    )
+    fig.update_layout(
+        height=600,
+        width=1000)
+
+    type_totals = lod.categories(agg)[MTD_METRICS].sum(axis=1)
+    description = f"""
+        This sunburst chart shows the distribution of Enquiry Types across ETBR (Enquiry, Test Drive, Booking, Retail) metrics.
+
+        Top performing Enquiry Type: {type_totals.idxmax()}
+        Total value for top Enquiry Type: {type_totals.max():.0f}
+        """
+
+    return fig, description
+
+
+def create_enquiry_source_etbr(agg, ctx):
+    chart_df = _long_format(agg, 'Enquiry Source')
+    fig = px.bar(chart_df, x='Metric', y='Value', color='Enquiry Source', custom_data=['Enquiry Source'], title=f"Enquiry Source vs ETBR for {ctx['location_display']}")
+    fig.update_traces(texttemplate='%{y}', textposition='outside')
+    fig.update_layout(
+        height=600,
+        width=1000)
+
+    source_totals = lod.categories(agg)[MTD_METRICS].sum(axis=1)
+    description = f"""
+        This stacked bar chart shows how different Enquiry Sources contribute to ETBR metrics.
+
+        Top performing Enquiry Source: {source_totals.idxmax()}
+        Total value for top Enquiry Source: {source_totals.max():.0f}
+        """
+
+    return fig, description
+
+
+def create_team_etbr(agg, ctx):
+    chart_df = _long_format(agg, 'Sales Consultant')
+    fig = px.bar(chart_df, x='Metric', y='Value', color='Sales Consultant', custom_data=['Sales Consultant'], title=f"Team vs Enquiry, Booking, Test Drive, Retail for {ctx['location_display']}")
+    fig.update_traces(texttemplate='%{y}', textposition='outside')
+    fig.update_layout(
+        height=600,
+        width=1000)
+
+    consultant_totals = lod.categories(agg)[MTD_METRICS].sum(axis=1)
+    description = f"""
+        This stacked bar chart shows the performance of individual Sales Consultants across ETBR metrics.
+
+        Top performing Sales Consultant: {consultant_totals.idxmax()}
+        Total value for top Sales Consultant: {consultant_totals.max():.0f}
+        """
+
+    return fig, description
+
+
+def create_team_enquiry_type(agg, ctx):
+    chart_df = _long_format(agg, 'Enquiry Type')
+    fig = px.bar(chart_df, x='Enquiry Type', y='Value', color='Metric', custom_data=['Enquiry Type'], title=create_title(ctx, 'Team vs Enquiry Type ETBR Report'))
+    fig.update_traces(texttemplate='%{y}', textposition='outside')
+    fig.update_layout(barmode='group',
+        height=600,
+        width=1000)
+
+    type_totals = lod.categories(agg)[MTD_METRICS].sum(axis=1)
+    description = f"""
+        This grouped bar chart shows how different Enquiry Types perform across ETBR metrics.
+
+        Top performing Enquiry Type: {type_totals.idxmax()}
+        Total value for top Enquiry Type: {type_totals.max():.0f}
+        """
+
+    return fig, description
+
+
+def create_walk_in_etbr(agg, ctx):
+    # The walk-in row of the Enquiry Type aggregate, instead of a second filter pass
+    walk_in = agg.loc['Walk-in'] if 'Walk-in' in agg.index else pd.Series(0, index=MTD_METRICS)
+    values = [walk_in[metric] for metric in MTD_METRICS]
+    chart_df = pd.DataFrame({'Metric': MTD_METRICS, 'Value': values})
+    fig = px.pie(chart_df, names='Metric', values='Value', title=create_title(ctx, 'Walk In Report'))
+    fig.update_traces(
+        textinfo='label+percent',
+        textposition='inside',
+        textfont=dict(
+            color='black',
+            family='Arial',
+            size=12
+        )
+    )
+    fig.update_layout(
+        title_text='Walk In ETBR',
+        title_x=0.5,
+        height=600,
+        width=1000,
+        uniformtext_minsize=12,
+        uniformtext_mode='hide'
+    )
+
+    total = sum(values)
+    description = f"""
+        This pie chart shows the distribution of Walk-in enquiries across ETBR metrics.
+
+        Total Walk-in ETBR: {total:.0f}
+        {_percentages(values, total)}
+        """
+
+    return fig, description
+
+
+# Chart registry, in the order 'All Visualisations' shows them. 'group_by' is
+# empty for charts that only need dataset totals. Clicking a point selects the
+# rows whose group_by column equals the point's customdata; 'row_filter'
+# replaces that for charts whose points are metrics, not categories. 'detail'
+# is how the figure grows with its categories (see lod.COST_MS); charts
+# without it have a fixed size and are never reduced.
+CHARTS = {
+    'ETBR Report': {
+        'columns': [],
+        'group_by': (),
+        'metrics': MTD_METRICS,
+        'build': create_etbr_report
+    },
+    'LMTD ETBR': {
+        'columns': [],
+        'group_by': (),
+        'metrics': MTD_METRICS + LMTD_METRICS,
+        'build': create_lmtd_etbr
+    },
+    'Model ETBR': {
+        'columns': ['Model'],
+        'group_by': ('Model',),
+        'metrics': MTD_METRICS,
+        'detail': 'bars',
+        'build': create_model_etbr
+    },
+    'Enquiry Type vs ETBR': {
+        'columns': ['Enquiry Type'],
+        'group_by': ('Enquiry Type',),
+        'metrics': MTD_METRICS,
+        'detail': 'sectors',
+        'build': create_enquiry_type_etbr
+    },
+    'Enquiry Source vs ETBR': {
+        'columns': ['Enquiry Source'],
+        'group_by': ('Enquiry Source',),
+        'metrics': MTD_METRICS,
+        'detail': 'traces',
+        'build': create_enquiry_source_etbr
+    },
+    'Team vs Enquiry, Booking, Test Drive, Retail': {
+        'columns': ['Sales Consultant'],
+        'group_by': ('Sales Consultant',),
+        'metrics': MTD_METRICS,
+        'detail': 'traces',
+        'build': create_team_etbr
+    },
+    'Team vs Enquiry Type Report': {
+        'columns': ['Enquiry Type'],
+        'group_by': ('Enquiry Type',),
+        'metrics': MTD_METRICS,
+        'detail': 'bars',
+        'build': create_team_enquiry_type
+    },
+    'Walk In ETBR': {
+        'columns': ['Enquiry Type'],
+        'group_by': ('Enquiry Type',),
+        'metrics': MTD_METRICS,
+        'row_filter': {'Enquiry Type': 'Walk-in'},
+        'build': create_walk_in_etbr
+    }
+}
+
+ALL_CHARTS = list(CHARTS)
+
+
+def chart_keys(selected_visualization):
+    if selected_visualization == 'All Visualisations':
+        return ALL_CHARTS
+    if selected_visualization in CHARTS:
+        return [selected_visualization]
+    return []
+
+
+def used_columns():
+    columns = {}
+    for spec in CHARTS.values():
+        columns.update(dict.fromkeys(spec['columns']))
+        columns.update(dict.fromkeys(spec['metrics']))
+    return list(columns)
+
+
+def required_columns(keys):
+    return [col for key in keys for col in CHARTS[key]['columns']]
+
+
+def missing_columns(key, columns):
+    return [col for col in CHARTS[key]['columns'] if col not in columns]
+
+
+def plan_aggregations(keys):
+    """Merge the aggregations of the charts into {group_by: [metrics]}."""
+    plan = {}
+    for key in keys:
+        metrics = plan.setdefault(CHARTS[key]['group_by'], {})
+        metrics.update(dict.fromkeys(CHARTS[key]['metrics']))
+    return {group_by: list(metrics) for group_by, metrics in plan.items()}
+
+
+def run_plan(plan, source, backend=None, cache_key=None):
+    """Run each aggregation of ``plan``; with a ``cache_key`` (see aggcache.key) results are cached.
+
+    Cached aggregations are also coalesced: identical ones running at the
+    same time, in any thread or worker, are computed once (see singleflight.py).
+    """
+    backend = backend or backends.get_backend()
+    aggregates = {}
+    for group_by, metrics in plan.items():
+        agg = aggcache.get(cache_key, backend.name, group_by, metrics) if cache_key else None
+        if agg is None and cache_key:
+            agg = singleflight.run(('aggregate', cache_key, backend.name, group_by, tuple(metrics)),
+                                   lambda: backend.aggregate(source, group_by, metrics))
+            aggcache.put(cache_key, backend.name, group_by, agg)
+        elif agg is None:
+            agg = backend.aggregate(source, group_by, metrics)
+        aggregates[group_by] = agg
+    return aggregates
+
+
+def combine_aggregates(aggs):
+    """Sum aggregates of disjoint row sets into the aggregate of their union."""
+    total = aggs[0]
+    for agg in aggs[1:]:
+        total = total.add(agg, fill_value=0)
+    if total.ndim == 2:
+        total = total.sort_index()
+        for metric in total.columns:
+            # Groups missing from one part turn int sums into floats
+            if all(pd.api.types.is_integer_dtype(agg[metric]) for agg in aggs):
+                total[metric] = total[metric].astype('int64')
+    return total
+
+
+def build_charts(keys, source, ctx, backend=None, cache_key=None, checkpoint=None, budget=None):
+    """Build (figure, description) for each chart, scanning ``source`` once per distinct aggregation.
+
+    ``source`` is a pandas DataFrame or a pyarrow Table; the configured
+    backend does the aggregation. ``checkpoint``, if given, is called
+    between the aggregation and the figure build and may raise to abandon it.
+    With a ``budget`` (see lod.py), figures that would not fit in the time
+    left are drawn with less detail, and listed in ``budget.reduced``.
+    """
+    names = backends.columns(source)
+    available = [key for key in keys if not missing_columns(key, names)]
+    aggregates = run_plan(plan_aggregations(available), source, backend, cache_key)
+    if checkpoint is not None:
+        checkpoint()
+    details = {}
+    if budget is not None:
+        details = budget.plan([(key, CHARTS[key].get('detail'), len(aggregates[CHARTS[key]['group_by']])) for key in available])
+    viz_data = []
+    for key in keys:
+        missing = missing_columns(key, names)
+        if missing:
+            viz_data.append((go.Figure(), f"Missing columns: {', '.join(missing)}"))
+            continue
+        spec = CHARTS[key]
+        detail = details.get(key)
+        agg = aggregates[spec['group_by']]
+        if detail is not None:
+            agg = lod.coarsen(agg, detail.keep, spec['metrics'])
+        started = time.perf_counter()
+        fig, description = spec['build'](agg, ctx)
+        lod.observe(spec.get('detail'), len(agg), (time.perf_counter() - started) * 1000)
+        viz_data.append(lod.apply(detail, fig, description, spec['group_by'][-1] if spec['group_by'] else ''))
+    return viz_data
@@ -0,0 +1,62 @@
+"""Side-by-side comparison of several locations, managers or consultants.
+
+All selected entities come out of one groupby over the chosen dimension
+(MTD and LMTD sums). The small multiples are drawn from that single
+result. Comparing N entities costs one scan, or none when the cached
+unfiltered aggregate is already there.
+"""
+import math
+
+import plotly.graph_objs as go
+from plotly.subplots import make_subplots
+
+import charts
+
+VIEW = 'Compare'
+DIMENSIONS = ['Dealer Location', 'Sales Manager', 'Sales Consultant']
+STAGES = ['ENQUIRY', 'TD', 'BOOKING', 'RETAIL']
+METRICS = charts.MTD_METRICS + charts.LMTD_METRICS
+MAX_COLUMNS = 3
+
+
+def compare_aggregate(source, dimension, entities, backend=None, cache_key=None):
+    """MTD/LMTD sums for ``entities`` from one groupby of ``source`` by ``dimension``."""
+    agg = charts.run_plan({(dimension,): METRICS}, source, backend, cache_key)[(dimension,)]
+    return agg.reindex(entities, fill_value=0)
+
+
+def create_comparison(agg, dimension):
+    columns = min(len(agg), MAX_COLUMNS)
+    rows = math.ceil(len(agg) / columns)
+    fig = make_subplots(rows=rows, cols=columns, subplot_titles=[str(entity) for entity in agg.index],
+                        shared_yaxes=True, vertical_spacing=0.12)
+    for position, (entity, values) in enumerate(agg.iterrows()):
+        row, col = position // columns + 1, position % columns + 1
+        for period, color in (('MTD', '#1f77b4'), ('LMTD', '#ff7f0e')):
+            fig.add_trace(go.Bar(
+                x=STAGES,
+                y=[values[f'{stage} {period}'] for stage in STAGES],
+                name=period,
+                marker_color=color,
+                legendgroup=period,
+                showlegend=position == 0
+            ), row=row, col=col)
+    fig.update_layout(
+        barmode='group',
+        title=f'{dimension} Comparison: MTD vs LMTD ETBR',
+        height=max(400, 350 * rows))
+
+    lines = []
+    for entity, values in agg.iterrows():
+        mtd = ', '.join(f"{charts.METRIC_ABBR[f'{stage} MTD']}: {values[f'{stage} MTD']:.0f}" for stage in STAGES)
+        retail_change = values['RETAIL MTD'] - values['RETAIL LMTD']
+        lines.append(f'{entity} - {mtd} (Retail {retail_change:+.0f} vs LMTD)')
+    best = agg['RETAIL MTD'].idxmax()
+    description = f"""
+        MTD and LMTD Enquiry, Test Drive, Booking and Retail for {len(agg)} {dimension} values, computed in one pass.
+
+        """ + '\n        '.join(lines) + f"""
+
+        Most retails MTD: {best} ({agg.loc[best, 'RETAIL MTD']:.0f})
+        """
+    return fig, description
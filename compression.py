@@ -0,0 +1,144 @@
+"""Response compression and static asset caching for the Flask server.
+
+Callback responses (``/_dash-update-component``), the layout routes and the
+index page are compressed when they exceed ETBR_COMPRESS_MIN_BYTES (default
+1024) and the browser accepts it. Brotli is used when the ``brotli`` package
+is installed, gzip otherwise. ETBR_COMPRESS_LEVEL sets the gzip level
+(default 6); brotli always uses quality 5.
+
+Fingerprinted assets get ``Cache-Control: public, max-age=31536000,
+immutable``. These are the Dash component bundles (``.v2_9_3m1690000.js``)
+and ``/assets`` files requested with Dash's ``?m=<mtime>`` query. A new
+release changes the URL, so browsers never have to revalidate them.
+
+Per-route ratio and CPU time are kept per worker and served at
+``/_etbr/compression`` so the threshold can be tuned.
+"""
+import gzip
+import os
+import threading
+import time
+
+from dash.fingerprint import check_fingerprint
+from flask import jsonify, request
+
+MIN_BYTES = int(os.environ.get('ETBR_COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('ETBR_COMPRESS_LEVEL', 6))
+BROTLI_QUALITY = 5
+COMPRESSIBLE_TYPES = ('application/json', 'text/html', 'text/css', 'application/javascript', 'text/javascript')
+LONG_CACHE = 'public, max-age=31536000, immutable'
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_lock = threading.Lock()
+_stats = {}
+
+
+def _qualities(accept_encoding):
+    # {coding: q} from an Accept-Encoding header; a coding without q has q=1
+    qualities = {}
+    for token in accept_encoding.lower().split(','):
+        coding, *params = [part.strip() for part in token.split(';')]
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    return qualities
+
+
+def accepts(accept_encoding, encoding):
+    """Whether ``encoding`` is acceptable: listed, or covered by ``*``, with a non-zero q."""
+    qualities = _qualities(accept_encoding)
+    return qualities.get(encoding, qualities.get('*', 0.0)) > 0
+
+
+def _encoding(accept_encoding):
+    # Identity (None) when neither coding is acceptable, e.g. 'gzip;q=0'
+    if brotli is not None and accepts(accept_encoding, 'br'):
+        return 'br'
+    if accepts(accept_encoding, 'gzip'):
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL)
+
+
+def _route(path):
+    # Group the stats by Dash route, not by fingerprinted file name
+    if '/_dash-component-suites/' in path:
+        return '/_dash-component-suites/'
+    if '/assets/' in path:
+        return '/assets/'
+    return path
+
+
+def _record(path, encoding, size, compressed_size, cpu_seconds):
+    with _lock:
+        stats = _stats.setdefault((_route(path), encoding), {'responses': 0, 'bytes_in': 0, 'bytes_out': 0, 'cpu_seconds': 0.0})
+        stats['responses'] += 1
+        stats['bytes_in'] += size
+        stats['bytes_out'] += compressed_size
+        stats['cpu_seconds'] += cpu_seconds
+
+
+def stats():
+    with _lock:
+        return [
+            dict(route=route, encoding=encoding, ratio=round(values['bytes_in'] / max(values['bytes_out'], 1), 2),
+                 cpu_ms_per_response=round(values['cpu_seconds'] * 1000 / values['responses'], 3), **values)
+            for (route, encoding), values in sorted(_stats.items())
+        ]
+
+
+def _cache_static(response):
+    path = request.path
+    if '/_dash-component-suites/' in path:
+        fingerprinted = check_fingerprint(path)[1]
+    else:
+        fingerprinted = '/assets/' in path and 'm' in request.args
+    if fingerprinted and response.status_code == 200:
+        response.headers['Cache-Control'] = LONG_CACHE
+
+
+def _compress(response):
+    encoding = _encoding(request.headers.get('Accept-Encoding', ''))
+    if (encoding is None or response.direct_passthrough or response.is_streamed or response.status_code != 200
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_TYPES):
+        return
+    data = response.get_data()
+    if len(data) < MIN_BYTES:
+        return
+    start = time.thread_time()
+    compressed = compress(data, encoding)
+    _record(request.path, encoding, len(data), len(compressed), time.thread_time() - start)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    response.headers['Content-Length'] = str(len(compressed))
+    response.vary.add('Accept-Encoding')
+
+
+def register(server):
+    @server.after_request
+    def compress_response(response):
+        _cache_static(response)
+        _compress(response)
+        return response
+
+    @server.route('/_etbr/compression')
+    def compression_stats():
+        return jsonify({'pid': os.getpid(), 'min_bytes': MIN_BYTES, 'brotli': brotli is not None, 'routes': stats()})
@@ -0,0 +1,229 @@
+"""Shared, memory-mapped dataset store.
+
+Parsed uploads are written once to an uncompressed Feather (Arrow IPC) file
+named after the SHA-256 of the uploaded bytes. Every gunicorn worker attaches
+to the same file with ``memory_map=True``. The OS page cache holds one copy of
+the data no matter how many workers serve it. The browser ``dcc.Store`` only
+carries the key, never the rows.
+
+A dataset can also be stored as a list of other datasets (``save_parts``).
+Attaching it concatenates the memory-mapped parts, so no rows are copied or
+written again.
+"""
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+
+import singleflight
+
+logger = logging.getLogger(__name__)
+
+DATA_DIR = os.environ.get('ETBR_DATA_DIR', os.path.join(tempfile.gettempdir(), 'etbr-datasets'))
+# A content hash, optionally followed by the hash of the column projection
+KEY_PATTERN = re.compile(r'^[0-9a-f]+(-[0-9a-f]+)?$')
+
+# Arrow tables attached in this worker. They are backed by the mmap, so
+# keeping them around costs address space, not resident memory. The oldest
+# are dropped past MAX_TABLES, so the open maps and file handles stay bounded.
+MAX_TABLES = int(os.environ.get('ETBR_MAX_TABLES', 32))
+_tables = {}
+_tables_lock = threading.Lock()
+
+
+def _path(key):
+    return os.path.join(DATA_DIR, f'{key}.feather')
+
+
+def _parts_path(key):
+    return os.path.join(DATA_DIR, f'{key}.parts.json')
+
+
+def content_hash(decoded):
+    return hashlib.sha256(decoded).hexdigest()
+
+
+def decode_contents(contents):
+    content_type, content_string = contents.split(',')
+    return base64.b64decode(content_string)
+
+
+def exists(key):
+    return bool(key) and (os.path.exists(_path(key)) or os.path.exists(_parts_path(key)))
+
+
+def _arrow_safe(df):
+    # Excel columns often mix numbers and text; Arrow needs one type per column.
+    df = df.copy()
+    for col in df.columns:
+        if df[col].dtype == object and pd.api.types.infer_dtype(df[col], skipna=True) not in ('string', 'empty'):
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    df.columns = [str(col) for col in df.columns]
+    return df
+
+
+def save_dataset(df, key):
+    if exists(key):
+        return key
+    save_table(pa.Table.from_pandas(_arrow_safe(df), preserve_index=False), key)
+    return key
+
+
+def save_table(table, key):
+    os.makedirs(DATA_DIR, exist_ok=True)
+    path = _path(key)
+    if os.path.exists(path):
+        return key
+    # Write to a private temp file and rename, so concurrent workers never
+    # attach to a half-written file.
+    fd, tmp_path = tempfile.mkstemp(dir=DATA_DIR, suffix='.tmp')
+    os.close(fd)
+    try:
+        feather.write_feather(table, tmp_path, compression='uncompressed')
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    logger.info(f"Dataset {key} stored. Shape: {(table.num_rows, table.num_columns)}")
+    return key
+
+
+def save_parts(parts, key):
+    """Store ``key`` as the concatenation of the datasets ``parts``, without copying their rows."""
+    os.makedirs(DATA_DIR, exist_ok=True)
+    path = _parts_path(key)
+    if os.path.exists(path):
+        return key
+    fd, tmp_path = tempfile.mkstemp(dir=DATA_DIR, suffix='.tmp')
+    with os.fdopen(fd, 'w') as handle:
+        json.dump(list(parts), handle)
+    os.replace(tmp_path, path)
+    logger.info(f'Dataset {key} stored as {len(parts)} part(s)')
+    return key
+
+
+def remove_parts(key):
+    """Forget a dataset stored with ``save_parts``; its parts are kept."""
+    try:
+        os.remove(_parts_path(key))
+    except FileNotFoundError:
+        pass
+    with _tables_lock:
+        _tables.pop(key, None)
+
+
+def _concat(tables):
+    try:
+        return pa.concat_tables(tables, promote_options='default')
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        # e.g. a column that is numeric in one export and text in another
+        return pa.concat_tables(tables, promote_options='permissive')
+
+
+def attach(key):
+    with _tables_lock:
+        table = _tables.get(key)
+    if table is None:
+        if os.path.exists(_parts_path(key)):
+            with open(_parts_path(key)) as handle:
+                table = _concat([attach(part) for part in json.load(handle)])
+        else:
+            table = feather.read_table(_path(key), memory_map=True)
+        with _tables_lock:
+            if key not in _tables and len(_tables) >= MAX_TABLES:
+                _tables.pop(next(iter(_tables)))
+            _tables[key] = table
+    return table
+
+
+def _typed(column, values, column_type):
+    # Filters from a URL are text; cast them to the column's type, e.g. numeric consultant codes
+    array = pa.array(values)
+    if array.type == column_type:
+        return array
+    try:
+        return pc.cast(array, column_type)
+    except (pa.ArrowInvalid, pa.ArrowNotImplementedError) as e:
+        raise ValueError(f"{column}: {', '.join(map(str, values))} is not a valid {column_type} value") from e
+
+
+def typed_filters(schema, filters):
+    """``filters`` with their values cast to the column types of ``schema``; raises ValueError if one does not parse."""
+    typed = {}
+    for column, value in (filters or {}).items():
+        if value is None or column not in schema.names:
+            typed[column] = value
+            continue
+        values = _typed(column, list(value) if isinstance(value, (list, tuple)) else [value], schema.field(column).type).to_pylist()
+        typed[column] = values if isinstance(value, (list, tuple)) else values[0]
+    return typed
+
+
+def filter_table(table, filters):
+    """Keep rows where each column equals its value (or is in it, for lists); None skips a filter.
+
+    Values are cast to the column's type; a ValueError says which one does not parse.
+    """
+    for column, value in (filters or {}).items():
+        if value is None or column not in table.column_names:
+            continue
+        column_type = table.schema.field(column).type
+        if isinstance(value, (list, tuple)):
+            mask = pc.is_in(table[column], value_set=_typed(column, list(value), column_type))
+        else:
+            mask = pc.equal(table[column], _typed(column, [value], column_type)[0])
+        table = table.filter(mask)
+    return table
+
+
+def load_dataset(key, columns=None, filters=None):
+    """Return the stored dataset as a DataFrame.
+
+    Filters (column -> value) are applied on the memory-mapped Arrow table, so
+    only the matching rows are copied into pandas.
+    """
+    table = attach(key)
+    if columns is not None:
+        table = table.select([col for col in columns if col in table.column_names])
+    table = filter_table(table, filters)
+    return table.to_pandas()
+
+
+def unique_values(key, column, filters=None):
+    table = filter_table(attach(key), filters)
+    values = pc.unique(pc.drop_null(table[column]))
+    return values.to_pylist()
+
+
+def column_names(key):
+    return attach(key).column_names
+
+
+def dataset_key(decoded, columns=None, sheet=None):
+    # The same file parsed from another sheet or with another column projection is a different dataset
+    key = content_hash(decoded)
+    if columns is not None or sheet is not None:
+        spec = ([f'sheet:{sheet}'] if sheet is not None else []) + list(columns or [])
+        key += '-' + hashlib.sha256('\n'.join(spec).encode('utf-8')).hexdigest()[:12]
+    return key
+
+
+def ingest(decoded, parse, columns=None, sheet=None):
+    """Store the parsed upload under its content hash and return the key.
+
+    ``parse`` is only called when no worker has stored these bytes yet, and
+    only once for uploads of the same file that arrive together.
+    """
+    key = dataset_key(decoded, columns, sheet)
+    if not exists(key):
+        singleflight.run(('parse', key), lambda: save_dataset(parse(decoded), key), lookup=lambda: key if exists(key) else None)
+    return key
@@ -0,0 +1,161 @@
+"""Read enquiries straight from a local SQLite or DuckDB file.
+
+Set ETBR_DB_PATH to the file the DMS writes (``.duckdb`` files open with
+DuckDB, anything else with SQLite) and ETBR_DB_TABLE to the table name
+(default ``enquiries``). The table has the same columns as the Excel export.
+
+Filters and per-dimension sums are pushed down as SQL. Only aggregated rows
+reach Python, and no rows are ever put in the browser store. Connections are
+read-only and pooled (ETBR_DB_POOL, default 4). Results worth caching, such
+as the dropdown search index, are keyed by ``snapshot`` and rebuilt every
+ETBR_DB_INDEX_TTL seconds (default 30), so new rows show up soon after.
+"""
+import os
+import queue
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+from backends import sql_quote, sql_where
+
+DB_PATH = os.environ.get('ETBR_DB_PATH')
+DB_TABLE = os.environ.get('ETBR_DB_TABLE', 'enquiries')
+POOL_SIZE = int(os.environ.get('ETBR_DB_POOL', 4))
+INDEX_TTL = float(os.environ.get('ETBR_DB_INDEX_TTL', 30))
+
+_pool = queue.Queue()
+_pool_lock = threading.Lock()
+_opened = [0]
+# table -> whether it has a rowid to order by
+_rowid = {}
+
+
+def enabled():
+    return bool(DB_PATH) and os.path.exists(DB_PATH)
+
+
+def _connect():
+    if DB_PATH.endswith('.duckdb'):
+        import duckdb
+        return duckdb.connect(DB_PATH, read_only=True)
+    return sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True, check_same_thread=False)
+
+
+@contextmanager
+def connection():
+    try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        with _pool_lock:
+            can_open = _opened[0] < POOL_SIZE
+            if can_open:
+                _opened[0] += 1
+        conn = _connect() if can_open else _pool.get()
+    try:
+        yield conn
+    finally:
+        _pool.put(conn)
+
+
+def snapshot(name):
+    """A cache key for ``name`` computed from the database; it changes every INDEX_TTL seconds (0: every call)."""
+    window = int(time.time() // INDEX_TTL) if INDEX_TTL else time.time_ns()
+    return f'database:{DB_PATH}:{DB_TABLE}:{name}:{window}'
+
+
+def query(sql, params=()):
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql, list(params))
+        names = [column[0] for column in cursor.description]
+        return names, cursor.fetchall()
+
+
+class TableRef:
+    """A database table plus the filters applied so far; stands in for a DataFrame."""
+
+    def __init__(self, table=DB_TABLE, filters=None):
+        self.table = table
+        self.filters = dict(filters or {})
+        self._columns = None
+
+    @property
+    def column_names(self):
+        if self._columns is None:
+            self._columns, _ = query(f'SELECT * FROM {sql_quote(self.table)} LIMIT 0')
+        return self._columns
+
+    def where(self, nulls=()):
+        return sql_where(self.filters, self.column_names, nulls)
+
+
+def _order(table, keys):
+    # Order of first appearance, like Series.unique() on the export, where the table has a
+    # rowid. WITHOUT ROWID tables and DuckDB views have none, and SQLite views give NULL:
+    # those are sorted by value
+    if table not in _rowid:
+        try:
+            query(f'SELECT rowid FROM {sql_quote(table)} LIMIT 0')
+            _rowid[table] = True
+        except Exception:
+            _rowid[table] = False
+    return f'MIN(rowid), {keys}' if _rowid[table] else keys
+
+
+def distinct(column, filters=None):
+    ref = TableRef(filters=filters)
+    where, params = ref.where(nulls=[column])
+    key = sql_quote(column)
+    _, rows = query(f'SELECT {key} FROM {sql_quote(ref.table)}{where} GROUP BY {key} ORDER BY {_order(ref.table, key)}', params)
+    return [row[0] for row in rows]
+
+
+def distinct_rows(columns):
+    """Distinct combinations of ``columns``, in order of first appearance where the table allows it."""
+    keys = ', '.join(sql_quote(column) for column in columns)
+    names, rows = query(f'SELECT {keys} FROM {sql_quote(DB_TABLE)} GROUP BY {keys} ORDER BY {_order(DB_TABLE, keys)}')
+    return pd.DataFrame(rows, columns=names)
+
+
+class SQLBackend:
+    """Backend (see backends.py) that runs filters and aggregations inside the database."""
+    name = 'database'
+
+    def filter(self, source, filters):
+        merged = dict(source.filters)
+        merged.update({column: value for column, value in (filters or {}).items() if value is not None})
+        ref = TableRef(source.table, merged)
+        ref._columns = source._columns
+        return ref
+
+    def aggregate(self, source, group_by, metrics):
+        present = [metric for metric in metrics if metric in source.column_names]
+        sums = [f'SUM({sql_quote(metric)})' for metric in present]
+        table = sql_quote(source.table)
+        if group_by:
+            keys = ', '.join(sql_quote(col) for col in group_by)
+            where, params = source.where(nulls=group_by)
+            _, rows = query(f"SELECT {', '.join([keys] + sums)} FROM {table}{where} GROUP BY {keys} ORDER BY {keys}", params)
+            agg = pd.DataFrame(rows, columns=list(group_by) + present).set_index(list(group_by))
+            for metric in metrics:
+                agg[metric] = agg[metric].fillna(0) if metric in present else 0
+            return agg[metrics]
+        where, params = source.where()
+        totals = dict.fromkeys(metrics, 0)
+        if present:
+            _, rows = query(f"SELECT {', '.join(sums)} FROM {table}{where}", params)
+            totals.update({metric: value or 0 for metric, value in zip(present, rows[0])})
+        return pd.Series(totals, dtype='object')
+
+    def count(self, source, group_by, filters=None):
+        source = self.filter(source, filters)
+        keys = ', '.join(sql_quote(col) for col in group_by)
+        where, params = source.where(nulls=group_by)
+        _, rows = query(f'SELECT {keys}, COUNT(*) FROM {sql_quote(source.table)}{where} GROUP BY {keys} ORDER BY {keys}', params)
+        return pd.DataFrame(rows, columns=list(group_by) + ['size']).set_index(list(group_by))['size']
+
+
+backend = SQLBackend()
@@ -0,0 +1,137 @@
+"""Click-to-drill-down from Location to Manager, Consultant, Model and Enquiry Type.
+
+The MTD sums are aggregated once per level of the hierarchy: total, per
+location, per (location, manager) and so on. Each level's index is sorted,
+so the children of a clicked path come from one ``.loc`` lookup on the next
+level. The raw rows are only scanned once, when the hierarchy is built.
+The warmer builds it right after an upload; any other worker builds it on
+its first drill.
+"""
+import threading
+
+import pandas as pd
+import plotly.graph_objs as go
+
+import backends
+import charts
+import singleflight
+
+VIEW = 'Drill Down'
+LEVELS = ['Dealer Location', 'Sales Manager', 'Sales Consultant', 'Model', 'Enquiry Type']
+CHART_TYPES = ['Bar', 'Pie', 'Sunburst']
+# Pie and sunburst slices are sized by this metric
+SIZE_METRIC = 'ENQUIRY MTD'
+
+MAX_HIERARCHIES = 4
+
+_hierarchies = {}
+_lock = threading.Lock()
+
+
+def build_hierarchy(source, backend=None):
+    backend = backend or backends.get_backend()
+    names = backends.columns(source)
+    levels = []
+    # Stop at the first missing column; a level without its parents is meaningless
+    for level in LEVELS:
+        if level not in names:
+            break
+        levels.append(level)
+    aggregates = [backend.aggregate(source, tuple(levels[:depth]), charts.MTD_METRICS) for depth in range(len(levels) + 1)]
+    return {'levels': levels, 'aggregates': aggregates}
+
+
+def get_hierarchy(key, load):
+    # One hierarchy per dataset and worker; ``load`` only runs on a miss.
+    with _lock:
+        hierarchy = _hierarchies.get(key)
+    if hierarchy is None:
+        hierarchy = singleflight.run(('hierarchy', key), lambda: build_hierarchy(load()), workers=False)
+        with _lock:
+            if len(_hierarchies) >= MAX_HIERARCHIES:
+                _hierarchies.pop(next(iter(_hierarchies)))
+            _hierarchies[key] = hierarchy
+    return hierarchy
+
+
+def children(hierarchy, path, depth=1):
+    """Rows ``depth`` levels below ``path``, indexed by the remaining levels (empty at the bottom)."""
+    target = len(path) + depth
+    if target >= len(hierarchy['aggregates']):
+        return pd.DataFrame(columns=charts.MTD_METRICS)
+    agg = hierarchy['aggregates'][target]
+    if not path:
+        return agg
+    try:
+        rows = agg.loc[tuple(path)]
+    except KeyError:
+        return pd.DataFrame(columns=charts.MTD_METRICS)
+    return rows
+
+
+def _label(value):
+    return value[-1] if isinstance(value, tuple) else value
+
+
+def breadcrumb(path):
+    return ['All Locations'] + [str(value) for value in path]
+
+
+def create_drill_figure(hierarchy, path, chart_type):
+    """Figure and description for the level below ``path``; every point's customdata is the path to drill into."""
+    levels = hierarchy['levels']
+    level = levels[len(path)] if len(path) < len(levels) else None
+    title = 'Drill Down: ' + ' > '.join(breadcrumb(path))
+    rows = children(hierarchy, path)
+    if level is None or rows.empty:
+        fig = go.Figure()
+        fig.update_layout(title=title, height=600)
+        if level is None:
+            return fig, 'This is the lowest level of the hierarchy. Click a level in the breadcrumb to go back up.'
+        return fig, 'No rows under this selection. Click a level in the breadcrumb to go back up.'
+
+    labels = [str(_label(value)) for value in rows.index]
+    targets = [list(path) + [_label(value)] for value in rows.index]
+    if chart_type == 'Pie':
+        fig = go.Figure(go.Pie(labels=labels, values=rows[SIZE_METRIC], customdata=targets, textinfo='label+value+percent'))
+    elif chart_type == 'Sunburst':
+        ids, names, parents, values, custom = [], [], [], [], []
+        for label, target, (_, row) in zip(labels, targets, rows.iterrows()):
+            ids.append(label)
+            names.append(label)
+            parents.append('')
+            values.append(row[SIZE_METRIC])
+            custom.append(target)
+        grandchildren = children(hierarchy, path, depth=2)
+        for index, row in grandchildren.iterrows():
+            child, grandchild = index[0], index[1]
+            ids.append(f'{child}/{grandchild}')
+            names.append(str(grandchild))
+            parents.append(str(child))
+            values.append(row[SIZE_METRIC])
+            custom.append(list(path) + [child, grandchild])
+        fig = go.Figure(go.Sunburst(ids=ids, labels=names, parents=parents, values=values, customdata=custom, branchvalues='total'))
+    else:
+        fig = go.Figure([
+            go.Bar(x=labels, y=rows[metric], name=metric, customdata=targets, text=rows[metric], textposition='outside')
+            for metric in charts.MTD_METRICS
+        ])
+        fig.update_layout(barmode='group', xaxis_title=level, yaxis_title='Count')
+    fig.update_layout(title=title, height=600)
+
+    totals = rows[charts.MTD_METRICS].sum(axis=1)
+    clickable = 'Click a bar or slice to drill into it.' if len(path) + 1 < len(levels) else ''
+    description = f"""
+        {len(rows)} {level} value(s) under {' > '.join(breadcrumb(path))}. {clickable}
+
+        Top {level}: {_label(totals.idxmax())} ({totals.max():.0f} across Enquiry, Test Drive, Booking and Retail)
+        """
+    return fig, description
+
+
+def clicked_path(click_data):
+    """The drill path stored in the customdata of the clicked point, if any."""
+    if not click_data or not click_data.get('points'):
+        return None
+    custom = click_data['points'][0].get('customdata')
+    return list(custom) if isinstance(custom, (list, tuple)) else None
@@ -0,0 +1,220 @@
+"""Watched drop folder: the DMS's hourly exports, ingested as they arrive.
+
+Set ETBR_WATCH_DIR to the shared folder. Every ETBR_WATCH_INTERVAL seconds
+(default 30), each worker lists the .xlsx / .xls / .csv files in it:
+
+* a file whose size and mtime are unchanged is skipped without being read;
+* a changed file is hashed, and only a new hash is parsed, into its own
+  part dataset in the datastore (content-addressed, so workers share it);
+* files still being written (modified in the last ETBR_WATCH_SETTLE
+  seconds, default 5) wait for the next scan.
+
+DMS hourly exports are cumulative MTD snapshots: each file already holds
+the rows of the earlier ones. By default the dashboard dataset is therefore
+the newest settled file alone, and older files are never parsed.
+
+Exports that are partitions instead, e.g. one file per day, are declared
+with ETBR_WATCH_PARTITION, the column that tells them apart. Every file is
+then a part, and a file whose partition values overlap an earlier file's
+(by name) is rejected, so no row is counted twice. The dashboard dataset
+lists the parts (``datastore.save_parts``); their rows are not copied into
+a combined file. Its key is derived from the part keys, so every worker
+agrees on it, and the list it replaces is deleted. The warmer sums cached
+per-part aggregates, so a new part only costs the aggregates of that file.
+
+Open sessions poll ``current()`` from a ``dcc.Interval`` and get the new
+data as a figure patch, not a page reload.
+"""
+import hashlib
+import logging
+import os
+import threading
+import time
+
+import pyarrow.compute as pc
+
+import charts
+import datastore
+import eventstore
+import governor
+import ingest
+import warmer
+
+logger = logging.getLogger(__name__)
+
+WATCH_DIR = os.environ.get('ETBR_WATCH_DIR')
+WATCH_INTERVAL = float(os.environ.get('ETBR_WATCH_INTERVAL', 30))
+SETTLE_SECONDS = float(os.environ.get('ETBR_WATCH_SETTLE', 5))
+# Column whose values split the exports into disjoint parts; unset: the newest file only
+PARTITION_COLUMN = os.environ.get('ETBR_WATCH_PARTITION') or None
+EXTENSIONS = ('.xlsx', '.xls', '.csv')
+REQUIRED_COLUMNS = ['Dealer Location', 'Sales Manager', 'Sales Consultant', 'Enquiry Type']
+
+_lock = threading.Lock()
+# path -> {'size', 'mtime', 'hash', 'key'}
+_files = {}
+# part key -> set of its partition values
+_partitions = {}
+_current = {'key': None, 'mode': None, 'parts': []}
+_started = [False]
+
+
+def enabled():
+    return bool(WATCH_DIR) and os.path.isdir(WATCH_DIR)
+
+
+def current():
+    """The folder dataset as page 1 stores it, or None before the first file is ingested."""
+    with _lock:
+        if _current['key'] is None:
+            return None
+        return {'key': _current['key'], 'mode': _current['mode'], 'source': 'folder'}
+
+
+def _session(path):
+    # Each file's dataset counts against the worker's memory while it is served
+    return f'drop folder:{path}'
+
+
+def _ingest_file(path, decoded):
+    filename = os.path.basename(path)
+    header = ingest.read_header(decoded, filename)
+    sheet = ingest.find_sheet(header, REQUIRED_COLUMNS)
+    columns = header.get(sheet, [])
+    missing = ingest.missing_columns(columns, REQUIRED_COLUMNS)
+    if missing:
+        logger.warning(f"Skipping {filename}: missing columns {', '.join(missing)}")
+        return None
+    if PARTITION_COLUMN and PARTITION_COLUMN not in columns:
+        logger.warning(f'Skipping {filename}: no partition column {PARTITION_COLUMN}')
+        return None
+    usecols = ingest.stored_columns(columns, REQUIRED_COLUMNS + charts.used_columns() + eventstore.EVENT_COLUMNS + ([PARTITION_COLUMN] if PARTITION_COLUMN else []))
+    key = datastore.dataset_key(decoded, usecols, sheet)
+    governor.check_rows(decoded, filename, sheet, usecols)
+
+    def parse(raw):
+        df = ingest.read_frame(raw, filename, usecols, sheet=sheet)
+        governor.check_dataset(key, df, _session(path))
+        return df
+
+    with governor.heavy_job():
+        return datastore.ingest(decoded, parse, columns=usecols, sheet=sheet)
+
+
+def _is_export(entry):
+    return entry.is_file() and entry.name.lower().endswith(EXTENSIONS) and not entry.name.startswith(('~$', '.'))
+
+
+def _partition_values(part):
+    values = _partitions.get(part)
+    if values is None:
+        values = _partitions[part] = set(pc.unique(datastore.attach(part)[PARTITION_COLUMN]).to_pylist())
+    return values
+
+
+def _disjoint(entries):
+    # Part keys in file name order, without files that repeat partitions of an earlier one
+    parts, claimed = [], set()
+    for path, entry in entries:
+        if not entry['key'] or entry['key'] in parts:
+            continue
+        values = _partition_values(entry['key'])
+        overlap = sorted(str(value) for value in values if value in claimed)
+        if overlap:
+            logger.warning(f"Rejecting {os.path.basename(path)}: {PARTITION_COLUMN} {', '.join(overlap[:5])} is already in an earlier file")
+            continue
+        claimed.update(values)
+        parts.append(entry['key'])
+    return parts
+
+
+def _combine(parts):
+    key = hashlib.sha256('\n'.join(sorted(parts)).encode('utf-8')).hexdigest()
+    return datastore.save_parts(parts, key)
+
+
+def scan():
+    """Ingest new or changed files; returns True when the folder dataset changed."""
+    seen, changed = {}, False
+    now = time.time()
+    entries = sorted((entry for entry in os.scandir(WATCH_DIR) if _is_export(entry)), key=lambda entry: entry.name)
+    if not PARTITION_COLUMN:
+        # Each export is a cumulative snapshot; only the newest complete one counts.
+        # A known file being rewritten is still a candidate: its previous version is served.
+        settled = [entry for entry in entries if now - entry.stat().st_mtime >= SETTLE_SECONDS or entry.path in _files]
+        entries = [max(settled, key=lambda entry: (entry.stat().st_mtime, entry.name))] if settled else []
+    for entry in entries:
+        stat = entry.stat()
+        previous = _files.get(entry.path)
+        if previous and (previous['size'], previous['mtime']) == (stat.st_size, stat.st_mtime):
+            seen[entry.path] = previous
+            continue
+        if now - stat.st_mtime < SETTLE_SECONDS:
+            # Still being copied in; keep serving the previous version of this file
+            if previous:
+                seen[entry.path] = previous
+            continue
+        with open(entry.path, 'rb') as handle:
+            decoded = handle.read()
+        digest = datastore.content_hash(decoded)
+        if previous and previous['hash'] == digest:
+            # Touched, not changed
+            seen[entry.path] = dict(previous, size=stat.st_size, mtime=stat.st_mtime)
+            continue
+        try:
+            key = _ingest_file(entry.path, decoded)
+        except Exception:
+            logger.exception(f'Could not ingest {entry.path}')
+            key = previous['key'] if previous else None
+        seen[entry.path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': digest, 'key': key}
+        changed = changed or key != (previous or {}).get('key')
+    changed = changed or set(seen) != set(_files)
+    dropped = set(_files) - set(seen)
+    _files.clear()
+    _files.update(seen)
+    for path in dropped:
+        governor.release(_session(path))
+    if not changed:
+        return False
+
+    if PARTITION_COLUMN:
+        parts = _disjoint(sorted(seen.items()))
+        key = _combine(parts) if parts else None
+    else:
+        parts = [entry['key'] for entry in seen.values() if entry['key']]
+        key = parts[0] if parts else None
+    mode = None
+    if key:
+        mode = 'events' if eventstore.is_event_data(datastore.column_names(key)) else 'export'
+    with _lock:
+        replaced = _current['key']
+        _current.update(key=key, mode=mode, parts=parts)
+    if PARTITION_COLUMN and replaced and replaced != key:
+        # Only the part list is deleted; the parts are content-addressed datasets
+        datastore.remove_parts(replaced)
+    for path, entry in seen.items():
+        if entry['key'] not in parts:
+            governor.release(_session(path))
+    logger.info(f'Drop folder now has {len(parts)} part(s): dataset {key[:12] if key else None}')
+    if key and mode == 'export':
+        # Unchanged parts hit the aggregate cache; only the new file is scanned
+        warmer.start(key, parts=parts if PARTITION_COLUMN else None)
+    return True
+
+
+def _watch():
+    while True:
+        try:
+            scan()
+        except Exception:
+            logger.exception(f'Scanning {WATCH_DIR} failed')
+        time.sleep(WATCH_INTERVAL)
+
+
+def start():
+    """Start this worker's watcher thread once; a no-op unless ETBR_WATCH_DIR is set."""
+    with _lock:
+        if _started[0] or not enabled():
+            return
+        _started[0] = True
+    threading.Thread(target=_watch, name='etbr-drop-folder', daemon=True).start()
@@ -0,0 +1,153 @@
+"""Date-window metrics from row-level enquiry events.
+
+The usual export only carries precomputed 'ENQUIRY MTD', 'TD LMTD', ...
+columns. This module takes dated events instead. Two layouts are accepted:
+
+* long: one row per event with 'Event Date' and 'Event Type'
+  (Enquiry / Test Drive / Booking / Retail);
+* wide: one row per enquiry with 'Enquiry Date', 'Test Drive Date',
+  'Booking Date' and 'Retail Date'.
+
+Events are kept per stage, sorted by date. A date window is two binary
+searches, and its events are one contiguous slice. The export-shaped frame
+the charts expect is built from the slices only.
+"""
+import datetime
+import threading
+
+import numpy as np
+import pandas as pd
+
+import singleflight
+
+STAGES = ['ENQUIRY', 'TD', 'BOOKING', 'RETAIL']
+EVENT_DATE = 'Event Date'
+EVENT_TYPE = 'Event Type'
+EVENT_TYPES = {
+    'enquiry': 'ENQUIRY',
+    'test drive': 'TD',
+    'td': 'TD',
+    'booking': 'BOOKING',
+    'retail': 'RETAIL'
+}
+WIDE_DATE_COLUMNS = {
+    'Enquiry Date': 'ENQUIRY',
+    'Test Drive Date': 'TD',
+    'Booking Date': 'BOOKING',
+    'Retail Date': 'RETAIL'
+}
+EVENT_COLUMNS = [EVENT_DATE, EVENT_TYPE] + list(WIDE_DATE_COLUMNS)
+PERIODS = ['MTD', 'QTD', 'Custom']
+
+MAX_STORES = 4
+
+_stores = {}
+_lock = threading.Lock()
+
+
+def is_event_data(columns):
+    columns = set(columns)
+    if 'ENQUIRY MTD' in columns:
+        return False
+    return {EVENT_DATE, EVENT_TYPE} <= columns or any(col in columns for col in WIDE_DATE_COLUMNS)
+
+
+def to_events(df):
+    if EVENT_DATE in df.columns and EVENT_TYPE in df.columns:
+        events = df.copy()
+        events[EVENT_TYPE] = events[EVENT_TYPE].astype(str).str.strip().str.lower().map(EVENT_TYPES)
+    else:
+        date_columns = [col for col in WIDE_DATE_COLUMNS if col in df.columns]
+        id_columns = [col for col in df.columns if col not in date_columns]
+        events = df.melt(id_vars=id_columns, value_vars=date_columns, var_name=EVENT_TYPE, value_name=EVENT_DATE)
+        events[EVENT_TYPE] = events[EVENT_TYPE].map(WIDE_DATE_COLUMNS)
+    events[EVENT_DATE] = pd.to_datetime(events[EVENT_DATE], errors='coerce')
+    return events.dropna(subset=[EVENT_DATE, EVENT_TYPE])
+
+
+def build_store(df):
+    events = to_events(df)
+    store = {}
+    for stage in STAGES:
+        stage_df = events[events[EVENT_TYPE] == stage].sort_values(EVENT_DATE, kind='mergesort').reset_index(drop=True)
+        dates = stage_df[EVENT_DATE].values.astype('datetime64[ns]')
+        store[stage] = {
+            'frame': stage_df.drop(columns=[EVENT_DATE, EVENT_TYPE]),
+            'dates': dates
+        }
+    return store
+
+
+def get_store(key, load):
+    # One sorted store per dataset and worker; ``load`` only runs on a miss.
+    with _lock:
+        store = _stores.get(key)
+    if store is None:
+        store = singleflight.run(('event store', key), lambda: build_store(load()), workers=False)
+        with _lock:
+            if len(_stores) >= MAX_STORES:
+                _stores.pop(next(iter(_stores)))
+            _stores[key] = store
+    return store
+
+
+def latest_date(store):
+    last = [entry['dates'][-1] for entry in store.values() if len(entry['dates'])]
+    if not last:
+        return datetime.date.today()
+    return pd.Timestamp(max(last)).date()
+
+
+def _bounds(entry, start, end):
+    # Inclusive calendar dates: [start 00:00, end + 1 day 00:00)
+    lo = np.searchsorted(entry['dates'], np.datetime64(start, 'ns'), side='left')
+    hi = np.searchsorted(entry['dates'], np.datetime64(end + datetime.timedelta(days=1), 'ns'), side='left')
+    return lo, hi
+
+
+def _same_day(year, month, day):
+    last_day = (datetime.date(year + month // 12, month % 12 + 1, 1) - datetime.timedelta(days=1)).day
+    return datetime.date(year, month, min(day, last_day))
+
+
+def _shift_months(date, months):
+    index = date.year * 12 + date.month - 1 - months
+    return _same_day(index // 12, index % 12 + 1, date.day)
+
+
+def period_windows(period, as_of, start=None, end=None):
+    """Return {'MTD': (start, end), 'LMTD': (start, end)} for a period.
+
+    The current window always lands in the '... MTD' columns and the comparison
+    window in '... LMTD', so every chart keeps working on any period.
+    """
+    if period == 'QTD':
+        quarter_start = datetime.date(as_of.year, 3 * ((as_of.month - 1) // 3) + 1, 1)
+        previous_start = _shift_months(quarter_start, 3)
+        return {'MTD': (quarter_start, as_of), 'LMTD': (previous_start, _shift_months(as_of, 3))}
+    if period == 'Custom' and start and end:
+        start, end = pd.Timestamp(start).date(), pd.Timestamp(end).date()
+        length = end - start
+        previous_end = start - datetime.timedelta(days=1)
+        return {'MTD': (start, end), 'LMTD': (previous_end - length, previous_end)}
+    month_start = as_of.replace(day=1)
+    return {'MTD': (month_start, as_of), 'LMTD': (_shift_months(month_start, 1), _shift_months(as_of, 1))}
+
+
+def window_frame(store, windows, filters=None):
+    """Build an export-shaped frame ('ENQUIRY MTD', 'TD LMTD', ...) for the windows."""
+    parts = []
+    for stage, entry in store.items():
+        for label, (start, end) in windows.items():
+            lo, hi = _bounds(entry, start, end)
+            part = entry['frame'].iloc[lo:hi]
+            for column, value in (filters or {}).items():
+                if value:
+                    part = part[part[column] == value]
+            parts.append(part.assign(**{f'{stage} {label}': 1}))
+    if not parts:
+        return pd.DataFrame()
+    frame = pd.concat(parts, ignore_index=True)
+    for column in [f'{stage} {label}' for stage in STAGES for label in windows]:
+        frame[column] = frame[column].fillna(0) if column in frame.columns else 0
+    return frame
@@ -0,0 +1,66 @@
+"""Row counts behind the page 2 charts, by every column they group or filter on.
+
+The cube has one row per combination of Location, Manager, Consultant,
+Product Family, existing vehicle, exchange interest and follow-up count
+found in the dataset, with the number of rows that have it. It is built
+with one groupby when page 2 stores a dataset, and kept per dataset and
+worker. The vehicle, product family and follow-up charts and their
+descriptions are sums over cube rows. A Location / Manager / Consultant
+filter selects cube rows, never raw rows, so filtering any chart costs no
+extra scan.
+
+Unlike the backends, the cube keeps null keys as their own group. A row
+without a product family still counts towards the vehicle chart.
+"""
+import threading
+
+import pandas as pd
+
+import singleflight
+
+DIMENSIONS = ['Dealer Location', 'Sales Manager', 'Sales Consultant', 'Product Family', 'Existing vehicle Latest1',
+              'Intrested In Exchange', 'Completed Followup Count']
+FILTER_COLUMNS = ['Dealer Location', 'Sales Manager', 'Sales Consultant']
+
+MAX_CUBES = 4
+
+_cubes = {}
+_lock = threading.Lock()
+
+
+def build_cube(frame):
+    dimensions = [column for column in DIMENSIONS if column in frame.columns]
+    if not dimensions:
+        return pd.DataFrame({'Rows': [len(frame)]})
+    return frame.groupby(dimensions, dropna=False, sort=False, observed=True).size().rename('Rows').reset_index()
+
+
+def get_cube(key, load):
+    # One cube per dataset and worker; ``load`` only runs on a miss.
+    with _lock:
+        cube = _cubes.get(key)
+    if cube is None:
+        cube = singleflight.run(('exchange cube', key), lambda: build_cube(load()), workers=False)
+        with _lock:
+            if len(_cubes) >= MAX_CUBES:
+                _cubes.pop(next(iter(_cubes)))
+            _cubes[key] = cube
+    return cube
+
+
+def select(cube, filters):
+    """Cube rows where each column equals its value; None skips a filter."""
+    for column, value in (filters or {}).items():
+        if value is not None and column in cube.columns:
+            cube = cube[cube[column] == value]
+    return cube
+
+
+def total(cube):
+    return int(cube['Rows'].sum())
+
+
+def counts(cube, group_by, sort=False):
+    """Rows per value of ``group_by`` (nulls dropped): busiest first like value_counts, or by key with ``sort``."""
+    counted = cube.groupby(group_by, sort=sort, observed=True)['Rows'].sum()
+    return counted if sort else counted.sort_values(ascending=False, kind='stable')
@@ -0,0 +1,201 @@
+"""Downloads of the current view: aggregated tables and the matching raw rows.
+
+The aggregated tables are small. They are built from the same plan as the
+charts and sent through ``dcc.Download``: an xlsx workbook with one sheet
+per table, or a zip of CSV or Parquet files.
+
+Raw rows are the rows as uploaded, with every column the dataset store kept
+(see ingest.ROW_COLUMNS). They can be a whole year of enquiries, so they
+are served from the ``/_etbr/export/<key>.<format>`` route, with one query
+parameter per filter. The memory-mapped dataset (or the database cursor) is read in
+chunks of ETBR_EXPORT_CHUNK_ROWS rows (default 50000). CSV and Parquet
+chunks are streamed to the client as they are encoded. Excel cannot be
+streamed, so xlsx is written row by row to a temporary file and then
+sent from disk. The Excel sheet limit starts a new sheet when needed.
+"""
+import io
+import os
+import tempfile
+import zipfile
+from urllib.parse import urlencode
+
+import openpyxl
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+from flask import Response, abort, request, send_file
+
+import backends
+import charts
+import datastore
+import dbsource
+
+CHUNK_ROWS = int(os.environ.get('ETBR_EXPORT_CHUNK_ROWS', 50000))
+FORMATS = {
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+}
+FILTER_COLUMNS = ['Dealer Location', 'Sales Manager', 'Sales Consultant']
+DATABASE_KEY = 'database'
+EXCEL_MAX_ROWS = 1048575
+
+
+def aggregate_tables(keys, source, backend=None, cache_key=None):
+    """The aggregates behind the charts ``keys``, one flat table per groupby."""
+    names = backends.columns(source)
+    available = [key for key in keys if not charts.missing_columns(key, names)]
+    tables = {}
+    for group_by, agg in charts.run_plan(charts.plan_aggregations(available), source, backend, cache_key).items():
+        name = ' by '.join(group_by) if group_by else 'Totals'
+        tables[name] = agg.reset_index() if group_by else agg.to_frame('Value').rename_axis('Metric').reset_index()
+    return tables
+
+
+def aggregates_file(tables, fmt):
+    """Bytes and file name of ``tables`` in ``fmt`` for ``dcc.send_bytes``."""
+    buffer = io.BytesIO()
+    if fmt == 'xlsx':
+        with pd.ExcelWriter(buffer, engine='openpyxl') as writer:
+            for name, table in tables.items():
+                # Excel sheet names are limited to 31 characters
+                table.to_excel(writer, sheet_name=name[:31], index=False)
+        return buffer.getvalue(), 'etbr-aggregates.xlsx'
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, table in tables.items():
+            if fmt == 'parquet':
+                data = io.BytesIO()
+                table.astype({col: str for col in table.columns if table[col].dtype == object}).to_parquet(data, index=False)
+                archive.writestr(f'{name}.parquet', data.getvalue())
+            else:
+                archive.writestr(f'{name}.csv', table.to_csv(index=False))
+    return buffer.getvalue(), f'etbr-aggregates-{fmt}.zip'
+
+
+def export_url(key, fmt, filters):
+    query = urlencode({column: value for column, value in (filters or {}).items() if value is not None})
+    url = f'/_etbr/export/{key}.{fmt}'
+    return f'{url}?{query}' if query else url
+
+
+def dataset_chunks(key, filters):
+    # Filter one record batch at a time; the mmap is never copied as a whole
+    table = datastore.attach(key)
+    empty = True
+    for batch in table.to_batches(max_chunksize=CHUNK_ROWS):
+        chunk = datastore.filter_table(pa.Table.from_batches([batch], schema=table.schema), filters)
+        if chunk.num_rows:
+            empty = False
+            yield chunk
+    if empty:
+        # No matching rows still gets the header row
+        yield table.schema.empty_table()
+
+
+def database_chunks(filters):
+    ref = dbsource.backend.filter(dbsource.TableRef(), filters)
+    where, params = ref.where()
+    with dbsource.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f'SELECT * FROM {backends.sql_quote(ref.table)}{where}', params)
+        names = [column[0] for column in cursor.description]
+        empty = True
+        while True:
+            rows = cursor.fetchmany(CHUNK_ROWS)
+            if not rows:
+                break
+            empty = False
+            yield pa.Table.from_pylist([dict(zip(names, row)) for row in rows])
+        if empty:
+            # No matching rows still gets the header row
+            yield pa.table({name: pa.array([], type=pa.null()) for name in names})
+
+
+class _StreamSink(io.RawIOBase):
+    """Write-only file that hands out what was written since the last drain."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_csv(chunks):
+    for index, chunk in enumerate(chunks):
+        buffer = io.BytesIO()
+        pa_csv.write_csv(chunk, buffer, write_options=pa_csv.WriteOptions(include_header=index == 0))
+        yield buffer.getvalue()
+
+
+def stream_parquet(chunks):
+    sink, writer = _StreamSink(), None
+    for chunk in chunks:
+        if writer is None:
+            writer = pq.ParquetWriter(sink, chunk.schema)
+        # Database chunks infer their types independently
+        writer.write_table(chunk.cast(writer.schema) if chunk.schema != writer.schema else chunk)
+        yield sink.drain()
+    if writer is not None:
+        writer.close()
+        yield sink.drain()
+
+
+def write_xlsx(chunks, target):
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet, rows_in_sheet, names = None, 0, []
+    for chunk in chunks:
+        names = chunk.column_names
+        for row in zip(*(column.to_pylist() for column in chunk.columns)):
+            if sheet is None or rows_in_sheet >= EXCEL_MAX_ROWS:
+                sheet = workbook.create_sheet(f'Rows {len(workbook.worksheets) + 1}')
+                sheet.append(chunk.column_names)
+                rows_in_sheet = 0
+            sheet.append(row)
+            rows_in_sheet += 1
+    if sheet is None:
+        workbook.create_sheet('Rows 1').append(names)
+    workbook.save(target)
+
+
+def register_routes(server):
+    @server.route('/_etbr/export/<key>.<fmt>')
+    def export_rows(key, fmt):
+        if fmt not in FORMATS:
+            abort(404)
+        filters = {column: request.args[column] for column in FILTER_COLUMNS if request.args.get(column)}
+        if key == DATABASE_KEY and dbsource.enabled():
+            chunks = database_chunks(filters)
+        elif datastore.KEY_PATTERN.match(key) and datastore.exists(key):
+            # Checked before the response starts, so a bad filter is a 400 and not a broken download
+            try:
+                filters = datastore.typed_filters(datastore.attach(key).schema, filters)
+            except ValueError as e:
+                return Response(str(e), status=400, mimetype='text/plain')
+            chunks = dataset_chunks(key, filters)
+        else:
+            abort(404)
+        filename = f'etbr-rows.{fmt}'
+        if fmt == 'xlsx':
+            # Anonymous temp file: removed as soon as send_file closes it
+            handle = tempfile.TemporaryFile()
+            write_xlsx(chunks, handle)
+            handle.seek(0)
+            return send_file(handle, mimetype=FORMATS[fmt], as_attachment=True, download_name=filename)
+        stream = stream_parquet(chunks) if fmt == 'parquet' else stream_csv(chunks)
+        return Response(stream, mimetype=FORMATS[fmt], headers={'Content-Disposition': f'attachment; filename="{filename}"'})
@@ -0,0 +1,54 @@
+"""Partial figure updates with ``dash.Patch``.
+
+A filter change usually changes only the numbers in a chart. When the
+signature of the new figure (chart, trace types and names, category labels,
+axis titles) matches what the client already shows, we send a Patch holding
+just the data arrays and the title. The layout and template stay in the
+browser.
+"""
+from dash import Patch
+
+PATCHED_ATTRS = ('x', 'y', 'values', 'text', 'customdata')
+STRUCTURE_ATTRS = ('labels', 'ids', 'parents')
+
+
+def _plain(value):
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    if isinstance(value, tuple):
+        return [_plain(v) for v in value]
+    return value
+
+
+def figure_signature(chart, fig):
+    traces = []
+    for trace in fig.data:
+        entry = [trace.type, trace.name]
+        for attr in STRUCTURE_ATTRS:
+            entry.append(_plain(getattr(trace, attr, None)) if attr in trace else None)
+        traces.append(entry)
+    return [chart, traces, fig.layout.xaxis.title.text, fig.layout.yaxis.title.text]
+
+
+def fill_patch(node, fig):
+    for i, trace in enumerate(fig.data):
+        for attr in PATCHED_ATTRS:
+            if attr in trace and trace[attr] is not None:
+                node['data'][i][attr] = _plain(trace[attr])
+    node['layout']['title']['text'] = fig.layout.title.text
+    return node
+
+
+def visualization_patch(viz_data, nested):
+    # Mirrors the page 1 container: [Graph, description] for a single chart,
+    # or one Div([Graph, description]) per chart for 'All Visualisations'.
+    patch = Patch()
+    if nested:
+        for i, (fig, description) in enumerate(viz_data):
+            fill_patch(patch[i]['props']['children'][0]['props']['figure'], fig)
+            patch[i]['props']['children'][1]['props']['children'] = description
+    else:
+        fig, description = viz_data[0]
+        fill_patch(patch[0]['props']['figure'], fig)
+        patch[1]['props']['children'] = description
+    return patch
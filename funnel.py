@@ -0,0 +1,136 @@
+"""E -> T -> B -> R conversion funnel and leaderboards for every location, manager and consultant.
+
+One groupby by (Location, Manager, Consultant) sums the MTD and LMTD
+stages. Managers and locations are rolled up from that result, so the rows
+are scanned once, or not at all when aggcache already has the groupby.
+Conversion rates, MTD vs LMTD deltas, ranks and percentiles are then
+column operations on the rolled-up frame. Nothing loops over entities, so
+a leaderboard of thousands of consultants is a sort and a slice.
+
+Each level is ranked among its peers: locations against all locations,
+managers within the selected location, and consultants within the selected
+location and manager.
+"""
+import pandas as pd
+import plotly.graph_objs as go
+
+import charts
+
+VIEW = 'Funnel'
+LEVELS = ['Dealer Location', 'Sales Manager', 'Sales Consultant']
+STAGES = ['ENQUIRY', 'TD', 'BOOKING', 'RETAIL']
+STAGE_NAMES = {'ENQUIRY': 'Enquiry', 'TD': 'Test Drive', 'BOOKING': 'Booking', 'RETAIL': 'Retail'}
+ABBR = {'ENQUIRY': 'E', 'TD': 'T', 'BOOKING': 'B', 'RETAIL': 'R'}
+CONVERSIONS = [('ENQUIRY', 'TD'), ('TD', 'BOOKING'), ('BOOKING', 'RETAIL'), ('ENQUIRY', 'RETAIL')]
+METRICS = charts.MTD_METRICS + charts.LMTD_METRICS
+PAGE_SIZE = 25
+
+
+def _rate_column(start, end):
+    return f'{ABBR[start]}→{ABBR[end]} %'
+
+
+RATE_COLUMNS = [_rate_column(start, end) for start, end in CONVERSIONS]
+# Leaderboard orderings: rates, then raw retail and its change
+RANK_BY = RATE_COLUMNS + ['RETAIL MTD', 'Retail Δ']
+
+
+def level_aggregate(source, level, backend=None, cache_key=None):
+    """MTD/LMTD sums per ``level``, rolled up from the one (Location, Manager, Consultant) groupby."""
+    agg = charts.run_plan({tuple(LEVELS): METRICS}, source, backend, cache_key)[tuple(LEVELS)]
+    depth = LEVELS.index(level) + 1
+    if depth == len(LEVELS):
+        return agg
+    return agg.groupby(level=list(range(depth))).sum()
+
+
+def _rates(frame, period):
+    rates = {}
+    for start, end in CONVERSIONS:
+        denominator = frame[f'{start} {period}']
+        # No enquiries (or bookings, ...) means no rate, not a zero rate
+        rates[_rate_column(start, end)] = frame[f'{end} {period}'] / denominator.where(denominator > 0) * 100
+    return pd.DataFrame(rates, index=frame.index)
+
+
+def leaderboard(agg, rank_by):
+    """Counts, conversion rates, deltas vs LMTD, rank and percentile for every row of ``agg``."""
+    mtd, lmtd = _rates(agg, 'MTD'), _rates(agg, 'LMTD')
+    board = agg[charts.MTD_METRICS].join(mtd)
+    for column in RATE_COLUMNS:
+        # Percentage points gained or lost since last month
+        board[column.replace('%', 'Δ pp')] = mtd[column] - lmtd[column]
+    board['Retail Δ'] = agg['RETAIL MTD'] - agg['RETAIL LMTD']
+    ranked = board[rank_by]
+    board['Rank'] = ranked.rank(ascending=False, method='min', na_option='bottom').astype(int)
+    board['Percentile'] = (ranked.rank(pct=True) * 100).round(0)
+    return board
+
+
+def totals(agg):
+    return agg[METRICS].sum()
+
+
+def create_funnel(total, scope):
+    fig = go.Figure([
+        go.Funnel(name=period, y=[STAGE_NAMES[stage] for stage in STAGES], x=[total[f'{stage} {period}'] for stage in STAGES],
+                  textinfo='value+percent initial+percent previous')
+        for period in ('MTD', 'LMTD')
+    ])
+    fig.update_layout(title=f'Enquiry to Retail Funnel for {scope}', height=500)
+    return fig
+
+
+def _name(index):
+    return index[-1] if isinstance(index, tuple) else index
+
+
+def _format(value, column):
+    if pd.isna(value):
+        return 'n/a'
+    if '%' in column:
+        return f'{value:.1f}%'
+    return f'{value:+.0f}' if 'Δ' in column else f'{value:.0f}'
+
+
+def describe(board, total, level, rank_by, selected=None):
+    if board.empty:
+        return f'No rows for this selection, so there are no {level} values to rank.'
+    rates = _rates(total.to_frame().T, 'MTD').iloc[0]
+    last_month = _rates(total.to_frame().T, 'LMTD').iloc[0]
+    lines = [f'{column}: {_format(rates[column], column)} (LMTD {_format(last_month[column], column)})' for column in RATE_COLUMNS]
+    ordered = board.sort_values('Rank', kind='stable')
+    description = f"""
+        Conversion for the whole selection: {', '.join(lines)}.
+
+        {len(board)} {level} values ranked by {rank_by}. Best: {_name(ordered.index[0])} ({_format(ordered[rank_by].iloc[0], rank_by)}). Median: {_format(board[rank_by].median(), rank_by)}.
+        """
+    if selected is not None:
+        matches = board[board.index.get_level_values(-1) == selected]
+        if not matches.empty:
+            row = matches.iloc[0]
+            description += f"""
+        {selected} ranks {int(row['Rank'])} of {len(board)} by {rank_by} ({_format(row[rank_by], rank_by)}, percentile {row['Percentile']:.0f}).
+        """
+    return description
+
+
+def page(board, sort_by, page_current, page_size):
+    """One page of the leaderboard as DataTable rows, sorted by ``sort_by`` (default: rank)."""
+    frame = board.reset_index()
+    sort = [(entry['column_id'], entry['direction'] == 'asc') for entry in sort_by or [] if entry['column_id'] in frame.columns]
+    if sort:
+        frame = frame.sort_values([column for column, _ in sort], ascending=[ascending for _, ascending in sort],
+                                  kind='stable', na_position='last')
+    else:
+        frame = frame.sort_values('Rank', kind='stable')
+    start = page_current * page_size
+    rows = frame.iloc[start:start + page_size].round(1)
+    # NaN is not valid JSON for the table
+    return rows.astype(object).where(rows.notna(), None).to_dict('records')
+
+
+def columns(board):
+    index_names = [name for name in board.index.names if name]
+    ordered = ['Rank'] + index_names + [column for column in board.columns if column != 'Rank']
+    return [{'name': column, 'id': column, 'type': 'text' if column in index_names else 'numeric'} for column in ordered]
@@ -0,0 +1,140 @@
+"""Abandon page 1 builds that a newer request from the same page has replaced.
+
+Clicking through consultants sends one request per click. The browser only
+shows the last answer, so every earlier build is wasted work. The browser
+holds filter changes back for ETBR_DEBOUNCE_MS (default 250; see
+DEBOUNCE_SCRIPT), so a burst of clicks sends only the last one. Each request
+that still arrives records itself as its page's latest in a tiny file under
+``<ETBR_DATA_DIR>/generations``. The file is shared, so a newer request
+handled by another gunicorn worker also counts. A build checks that it is
+still the latest at each stage boundary:
+
+* after filtering, once it holds a heavy-job slot;
+* after aggregation, before the figures are built.
+
+A superseded build raises ``Superseded``. It is a ``PreventUpdate``, so
+Dash sends nothing back and the newer request's answer is the one shown.
+Pages are told apart by a random id each page load puts in its
+``page-id`` store (PAGE_ID_SCRIPT), so two tabs of one browser never
+supersede each other.
+"""
+import logging
+import os
+import threading
+import time
+import uuid
+
+from dash.exceptions import PreventUpdate
+
+import datastore
+
+logger = logging.getLogger(__name__)
+
+DEBOUNCE_MS = float(os.environ.get('ETBR_DEBOUNCE_MS', 250))
+# Generation files of pages idle for longer than this are removed
+SESSION_TTL = 24 * 3600
+GENERATIONS_DIR = os.path.join(datastore.DATA_DIR, 'generations')
+
+_lock = threading.Lock()
+_last_sweep = [0.0]
+_stats = {'started': 0, 'superseded': 0}
+
+# Clientside callback: a random id for this page load, set once into the page-id store
+PAGE_ID_SCRIPT = """
+function(_, pageId) {
+    if (pageId) {
+        return window.dash_clientside.no_update;
+    }
+    if (window.crypto && window.crypto.randomUUID) {
+        return window.crypto.randomUUID().replace(/-/g, '');
+    }
+    return Math.random().toString(36).slice(2) + Date.now().toString(36);
+}
+"""
+
+# Clientside callback: copy the filter values into the filter-settled store
+# once they have not changed for DEBOUNCE_MS. The store is the only input of
+# the page 1 build that the filters start; values it was already built for
+# (e.g. a consultant the server cleared) start nothing.
+DEBOUNCE_SCRIPT = """
+function() {
+    var values = Array.prototype.slice.call(arguments, 0, -1);
+    var settled = arguments[arguments.length - 1];
+    var noUpdate = window.dash_clientside.no_update;
+    if (JSON.stringify(values) === JSON.stringify(settled)) {
+        return noUpdate;
+    }
+    var change = window.etbrFilterChange = (window.etbrFilterChange || 0) + 1;
+    return new Promise(function(resolve) {
+        setTimeout(function() {
+            resolve(change === window.etbrFilterChange ? values : noUpdate);
+        }, %d);
+    });
+}
+""" % DEBOUNCE_MS
+
+
+class Superseded(PreventUpdate):
+    """A newer request from the same session replaced this one."""
+
+
+def _path(page, scope):
+    return os.path.join(GENERATIONS_DIR, f'{page}-{scope}')
+
+
+def _sweep():
+    now = time.time()
+    with _lock:
+        if now - _last_sweep[0] < 3600:
+            return
+        _last_sweep[0] = now
+    for entry in os.scandir(GENERATIONS_DIR):
+        try:
+            if now - entry.stat().st_mtime > SESSION_TTL:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def begin(page, scope, abandonable=True):
+    """Record this request as the latest of ``page`` for ``scope``; returns its token.
+
+    ``page`` is the id in the page-id store; None (before it is set, or not
+    an id we made) tracks nothing. Requests that change the dataset
+    (uploads, database, drop folder) are not abandonable: a newer request
+    cannot see their result. They still supersede older builds.
+    """
+    if not page or not str(page).isalnum():
+        return None
+    os.makedirs(GENERATIONS_DIR, exist_ok=True)
+    token = {'path': _path(page, scope), 'id': uuid.uuid4().hex, 'abandonable': abandonable}
+    # Whole-file replace: readers see the old or the new id, never half of one
+    temp_path = f"{token['path']}.{token['id']}"
+    with open(temp_path, 'w') as handle:
+        handle.write(token['id'])
+    os.replace(temp_path, token['path'])
+    with _lock:
+        _stats['started'] += 1
+    _sweep()
+    return token
+
+
+def check(token, stage=''):
+    """Raise ``Superseded`` if a newer request of the same page has begun."""
+    if token is None or not token['abandonable']:
+        return
+    try:
+        with open(token['path']) as handle:
+            latest = handle.read()
+    except OSError:
+        return
+    if latest != token['id']:
+        with _lock:
+            _stats['superseded'] += 1
+        logger.info(f'Abandoned a superseded build at {stage or "a checkpoint"}')
+        raise Superseded()
+
+
+def usage():
+    with _lock:
+        return dict(_stats)
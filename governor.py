@@ -0,0 +1,177 @@
+"""Admission control for uploads and chart builds.
+
+Limits (environment variables, 0 disables a limit):
+
+* ETBR_MAX_UPLOAD_MB      - decoded upload size
+* ETBR_MAX_ROWS           - rows in a parsed dataset (checked from the sheet dimensions first)
+* ETBR_MAX_DATASET_MB     - resident memory of one session's dataset, estimated
+                            from the sheet dimensions before the parse and
+                            measured after it
+* ETBR_MAX_HEAVY_JOBS     - concurrent parses / chart builds per worker
+* ETBR_QUEUE_TIMEOUT      - seconds a heavy job may wait for a slot before it is rejected
+
+Requests over the concurrency limit wait in line; requests over a hard
+limit are rejected with a ``ResourceLimitError`` whose message is shown to
+the user.
+"""
+import io
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import openpyxl
+from flask import jsonify
+
+import generations
+import ingest
+import singleflight
+
+MAX_UPLOAD_BYTES = int(float(os.environ.get('ETBR_MAX_UPLOAD_MB', 50)) * 2**20)
+MAX_ROWS = int(os.environ.get('ETBR_MAX_ROWS', 1000000))
+MAX_DATASET_BYTES = int(float(os.environ.get('ETBR_MAX_DATASET_MB', 1024)) * 2**20)
+MAX_HEAVY_JOBS = int(os.environ.get('ETBR_MAX_HEAVY_JOBS', 2))
+QUEUE_TIMEOUT = float(os.environ.get('ETBR_QUEUE_TIMEOUT', 60))
+# Parsed bytes per cell used to estimate a dataset before parsing it: between a
+# number (8) and a short name (about 70), so only a clearly oversized file is refused
+CELL_BYTES = 40
+
+_slots = threading.BoundedSemaphore(MAX_HEAVY_JOBS) if MAX_HEAVY_JOBS else None
+_lock = threading.Lock()
+# 'datasets': session -> (dataset key, bytes) of the dataset it loaded last
+_usage = {'running': 0, 'queued': 0, 'rejected': 0, 'datasets': {}}
+
+
+class ResourceLimitError(Exception):
+    pass
+
+
+def _mb(value):
+    return f'{value / 2**20:.1f} MB'
+
+
+def check_upload(contents):
+    # Base64 inflates by 4/3; check before decoding so an oversized file is never copied
+    encoded_size = len(contents) - contents.find(',') - 1
+    decoded_size = encoded_size * 3 // 4
+    if MAX_UPLOAD_BYTES and decoded_size > MAX_UPLOAD_BYTES:
+        _reject()
+        raise ResourceLimitError(f'File is {_mb(decoded_size)}; uploads are limited to {_mb(MAX_UPLOAD_BYTES)}.')
+
+
+def _declared_rows(decoded, filename, sheet):
+    # Data rows of a sheet (default: the first) from its dimensions, or of a CSV from its line breaks
+    if ingest.is_csv(filename):
+        return max(decoded.count(b'\n') - 1, 0)
+    try:
+        workbook = openpyxl.load_workbook(io.BytesIO(decoded), read_only=True)
+    except Exception:
+        return 0
+    try:
+        if sheet in workbook.sheetnames:
+            rows = workbook[sheet].max_row
+        else:
+            rows = workbook.worksheets[0].max_row if workbook.worksheets else 0
+    finally:
+        workbook.close()
+    return max((rows or 0) - 1, 0)
+
+
+def check_rows(decoded, filename, sheet=None, columns=None):
+    """Reject a sheet whose declared size exceeds the row or memory limit, without parsing it.
+
+    ``columns`` are the columns that will be parsed; the memory estimate is
+    skipped without them.
+    """
+    if not MAX_ROWS and not (MAX_DATASET_BYTES and columns):
+        return
+    rows = _declared_rows(decoded, filename, sheet)
+    if MAX_ROWS and rows > MAX_ROWS:
+        _reject()
+        raise ResourceLimitError(f'File has {rows} rows; uploads are limited to {MAX_ROWS} rows.')
+    estimate = rows * len(columns or []) * CELL_BYTES
+    if MAX_DATASET_BYTES and estimate > MAX_DATASET_BYTES:
+        _reject()
+        raise ResourceLimitError(f'Dataset would need at least {_mb(estimate)} in memory; the limit is {_mb(MAX_DATASET_BYTES)}.')
+
+
+def check_dataset(key, df, session=None):
+    """Reject a parsed dataset over the limits, and count it as ``session``'s (default: its own key)."""
+    if MAX_ROWS and len(df) > MAX_ROWS:
+        _reject()
+        raise ResourceLimitError(f'File has {len(df)} rows; uploads are limited to {MAX_ROWS} rows.')
+    size = int(df.memory_usage(deep=True).sum())
+    if MAX_DATASET_BYTES and size > MAX_DATASET_BYTES:
+        _reject()
+        raise ResourceLimitError(f'Dataset needs {_mb(size)} in memory; the limit is {_mb(MAX_DATASET_BYTES)}.')
+    with _lock:
+        # A session's new dataset replaces its previous one
+        _usage['datasets'][session or key] = (key, size)
+
+
+def _reject():
+    with _lock:
+        _usage['rejected'] += 1
+
+
+@contextmanager
+def heavy_job():
+    """Run a parse or chart build once a slot is free; waits at most QUEUE_TIMEOUT."""
+    if _slots is None:
+        yield
+        return
+    with _lock:
+        _usage['queued'] += 1
+    start = time.monotonic()
+    acquired = _slots.acquire(timeout=QUEUE_TIMEOUT)
+    with _lock:
+        _usage['queued'] -= 1
+        if acquired:
+            _usage['running'] += 1
+    if not acquired:
+        _reject()
+        raise ResourceLimitError(f'The server is busy ({usage_message()}); gave up after waiting {time.monotonic() - start:.0f}s. Please try again.')
+    try:
+        yield
+    finally:
+        with _lock:
+            _usage['running'] -= 1
+        _slots.release()
+
+
+def release(session):
+    """Stop counting the dataset of ``session``, e.g. a drop-folder file that is no longer served."""
+    with _lock:
+        _usage['datasets'].pop(session, None)
+
+
+def usage():
+    with _lock:
+        datasets = {session: size for session, (_, size) in _usage['datasets'].items()}
+        return {
+            'pid': os.getpid(),
+            'running_jobs': _usage['running'],
+            'queued_jobs': _usage['queued'],
+            'rejected': _usage['rejected'],
+            'max_heavy_jobs': MAX_HEAVY_JOBS,
+            'datasets': len(datasets),
+            'dataset_bytes': sum(datasets.values()),
+            'builds': generations.usage(),
+            'flights': singleflight.usage(),
+            'limits': {
+                'upload_bytes': MAX_UPLOAD_BYTES,
+                'rows': MAX_ROWS,
+                'dataset_bytes': MAX_DATASET_BYTES
+            }
+        }
+
+
+def usage_message():
+    current = usage()
+    return f"{current['running_jobs']}/{current['max_heavy_jobs']} heavy jobs running, {current['queued_jobs']} queued"
+
+
+def register_routes(server):
+    @server.route('/_etbr/usage')
+    def resource_usage():
+        return jsonify(usage())
@@ -0,0 +1,234 @@
+"""Static chart images for slow connections, and for embedding in intranet pages.
+
+With the "Static images" box ticked, a page gets an ``<img>`` per chart
+instead of the Plotly figure JSON. Old PCs then have no figures to lay out.
+Images are rendered on the server with kaleido (``plotly.io.to_image``)
+and stored under ``<ETBR_DATA_DIR>/images``. They are named after the
+dataset hash, the chart, the parameters its renderer reads and a hash of
+the chart code, so every worker and every later request for the same view
+reuses them, and a new release never serves an old drawing. The cache is trimmed to
+ETBR_IMAGE_CACHE_MB (default 256), oldest first.
+
+ETBR_IMAGE_FORMAT picks ``png`` (default) or ``svg``. SVG is stored
+gzipped and sent compressed to browsers that accept it.
+
+The same URL embeds a chart in another page::
+
+    <img src="http://etbr:8050/_etbr/chart/<dataset>/ETBR%20Report.png?Dealer%20Location=Kochi">
+
+Page 1 charts of an export dataset, and the charts registered with
+``register`` (page 2), are rendered on demand for any filters. Windows of
+dated events are served once the dashboard has rendered them. Database
+sources change under the same name, so their images are rendered inline
+and never cached.
+"""
+import base64
+import gzip
+import functools
+import hashlib
+import importlib.util
+import inspect
+import json
+import logging
+import os
+import threading
+import uuid
+from urllib.parse import quote, urlencode
+
+import plotly
+import plotly.io as pio
+from flask import Response, abort, request
+
+import aggcache
+import backends
+import charts
+import compression
+import datastore
+import eventstore
+import governor
+import singleflight
+
+logger = logging.getLogger(__name__)
+
+IMAGE_FORMAT = os.environ.get('ETBR_IMAGE_FORMAT', 'png')
+IMAGE_WIDTH = int(os.environ.get('ETBR_IMAGE_WIDTH', 1200))
+IMAGE_HEIGHT = 600
+MAX_CACHE_BYTES = int(float(os.environ.get('ETBR_IMAGE_CACHE_MB', 256)) * 2**20)
+IMAGE_DIR = os.path.join(datastore.DATA_DIR, 'images')
+MIMETYPES = {'png': 'image/png', 'svg': 'image/svg+xml'}
+FILTER_COLUMNS = ['Dealer Location', 'Sales Manager', 'Sales Consultant']
+# Page 1 images of dated events also depend on the window
+PAGE1_PARAMS = FILTER_COLUMNS + ['Period', 'Start', 'End']
+# Content-addressed: a new upload has a new dataset key, so a URL never changes meaning
+LONG_CACHE = 'public, max-age=31536000, immutable'
+
+_lock = threading.Lock()
+# chart name -> (build(dataset key, params) returning a figure, the names of the params it reads)
+_renderers = {}
+_writes = [0]
+
+
+def available():
+    return IMAGE_FORMAT in MIMETYPES and importlib.util.find_spec('kaleido') is not None
+
+
+def register(name, build, params=FILTER_COLUMNS):
+    """Let the chart route render ``name`` on demand; ``build(key, params)`` returns its figure.
+
+    ``params`` names the query parameters ``build`` reads; others are dropped.
+    """
+    _renderers[name] = (build, list(params))
+
+
+def _declared(chart):
+    if chart in charts.CHARTS:
+        return PAGE1_PARAMS
+    return _renderers[chart][1] if chart in _renderers else []
+
+
+def _params(chart, params):
+    # Query strings only carry text; empty filters and parameters the renderer ignores are left out
+    declared = _declared(chart)
+    return {name: str(value) for name, value in sorted((params or {}).items()) if name in declared and value not in (None, '')}
+
+
+@functools.lru_cache(maxsize=None)
+def _code_version(path):
+    with open(path, 'rb') as handle:
+        return hashlib.sha256(handle.read()).hexdigest()[:12]
+
+
+def _version(chart):
+    # Images are served as immutable, so a change to the code drawing them must change their names
+    path = charts.__file__ if chart in charts.CHARTS else inspect.getsourcefile(_renderers[chart][0]) if chart in _renderers else None
+    return [plotly.__version__, IMAGE_WIDTH, _code_version(path) if path else None]
+
+
+def _image_id(key, chart, params):
+    spec = json.dumps([key, chart, _params(chart, params), _version(chart)], sort_keys=True)
+    return hashlib.sha256(spec.encode('utf-8')).hexdigest()
+
+
+def _file(image_id):
+    suffix = '.svg.gz' if IMAGE_FORMAT == 'svg' else '.png'
+    return os.path.join(IMAGE_DIR, image_id + suffix)
+
+
+def chart_url(key, chart, params=None):
+    url = f'/_etbr/chart/{key}/{quote(chart, safe="")}.{IMAGE_FORMAT}'
+    query = urlencode(_params(chart, params))
+    return f'{url}?{query}' if query else url
+
+
+def render(fig):
+    """Image bytes of ``fig``, sized as on the page."""
+    return pio.to_image(fig, format=IMAGE_FORMAT,
+                        width=fig.layout.width or IMAGE_WIDTH, height=fig.layout.height or IMAGE_HEIGHT)
+
+
+def _trim():
+    entries = []
+    for entry in os.scandir(IMAGE_DIR):
+        try:
+            stat = entry.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= MAX_CACHE_BYTES:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def _store(image_id, fig):
+    data = render(fig)
+    if IMAGE_FORMAT == 'svg':
+        data = gzip.compress(data)
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    # Write then rename, so a concurrent reader never sees half an image
+    temp_path = f'{_file(image_id)}.{uuid.uuid4().hex}'
+    with open(temp_path, 'wb') as handle:
+        handle.write(data)
+    os.replace(temp_path, _file(image_id))
+    with _lock:
+        _writes[0] += 1
+        trim = _writes[0] % 50 == 0
+    if trim:
+        _trim()
+
+
+def image_src(key, chart, fig, params=None):
+    """``src`` for an ``<img>`` of ``fig``: a cached chart URL, or inline data for uncacheable sources.
+
+    Returns None when the image cannot be rendered; the caller then falls
+    back to the interactive figure.
+    """
+    try:
+        if key is None or not datastore.KEY_PATTERN.match(key):
+            data = render(fig)
+            return f'data:{MIMETYPES[IMAGE_FORMAT]};base64,{base64.b64encode(data).decode("ascii")}'
+        image_id = _image_id(key, chart, params)
+        if not os.path.exists(_file(image_id)):
+            # Many viewers of one view render it once
+            singleflight.run(('image', image_id), lambda: _store(image_id, fig),
+                             lookup=lambda: True if os.path.exists(_file(image_id)) else None)
+        return chart_url(key, chart, params)
+    except Exception:
+        logger.exception(f'Could not render {chart} as {IMAGE_FORMAT}')
+        return None
+
+
+def _page1_figure(key, chart, params):
+    if eventstore.is_event_data(datastore.column_names(key)):
+        return None
+    filters = datastore.typed_filters(datastore.attach(key).schema, {column: params.get(column) for column in FILTER_COLUMNS})
+    backend = backends.get_backend()
+    ctx = charts.view_context(filters['Dealer Location'], filters['Sales Manager'], filters['Sales Consultant'])
+    source = backend.filter(datastore.attach(key), filters)
+    fig, _ = charts.build_charts([chart], source, ctx, backend, aggcache.key(key, filters))[0]
+    return fig
+
+
+def _send(path):
+    with open(path, 'rb') as handle:
+        data = handle.read()
+    headers = {'Cache-Control': LONG_CACHE, 'Vary': 'Accept-Encoding'}
+    if path.endswith('.gz'):
+        if compression.accepts(request.headers.get('Accept-Encoding', ''), 'gzip'):
+            headers['Content-Encoding'] = 'gzip'
+        else:
+            data = gzip.decompress(data)
+    return Response(data, mimetype=MIMETYPES[IMAGE_FORMAT], headers=headers)
+
+
+def register_routes(server):
+    @server.route('/_etbr/chart/<key>/<chart>.<fmt>')
+    def chart_image(key, chart, fmt):
+        if fmt != IMAGE_FORMAT or not datastore.KEY_PATTERN.match(key) or not datastore.exists(key):
+            abort(404)
+        if chart not in charts.CHARTS and chart not in _renderers:
+            abort(404)
+        # Only what the renderer reads, so made-up parameters cannot each render and store an image
+        params = _params(chart, request.args)
+        try:
+            datastore.typed_filters(datastore.attach(key).schema, {column: params.get(column) for column in FILTER_COLUMNS})
+        except ValueError as e:
+            return Response(str(e), status=400, mimetype='text/plain')
+        path = _file(_image_id(key, chart, params))
+        if not os.path.exists(path):
+            try:
+                with governor.heavy_job():
+                    fig = _page1_figure(key, chart, params) if chart in charts.CHARTS else _renderers[chart][0](key, params)
+                    if fig is None or image_src(key, chart, fig, params) is None:
+                        abort(404)
+            except governor.ResourceLimitError as e:
+                return Response(str(e), status=503, mimetype='text/plain')
+            except (KeyError, ValueError):
+                # The dataset lacks the chart's columns
+                abort(404)
+        return _send(path)
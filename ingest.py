@@ -0,0 +1,84 @@
+"""Header-first upload checks.
+
+Reading the header row (and the sheet list) of a workbook takes
+milliseconds. Reading the whole workbook can take minutes. We validate the
+schema against the header first, then parse only the columns the charts and
+the row view use. The row view shows the rows as uploaded, so by default
+every column is kept; set ETBR_ROW_COLUMNS to a comma-separated list to keep
+only those columns besides the chart ones.
+Exports that bundle several sheets are matched sheet by sheet: each chart
+parses only the sheet that has its columns.
+"""
+import csv
+import io
+import os
+
+import openpyxl
+import pandas as pd
+
+# Columns kept for the row view and the raw-row downloads; empty keeps them all
+ROW_COLUMNS = [col.strip() for col in os.environ.get('ETBR_ROW_COLUMNS', '').split(',') if col.strip()]
+
+
+def is_csv(filename):
+    return bool(filename) and 'csv' in filename
+
+
+def read_header(decoded, filename):
+    """Return {sheet name: [column names]} without reading any data rows."""
+    if is_csv(filename):
+        first_line = decoded.split(b'\n', 1)[0].decode('utf-8-sig').rstrip('\r')
+        return {'csv': next(csv.reader([first_line]), [])}
+    try:
+        workbook = openpyxl.load_workbook(io.BytesIO(decoded), read_only=True)
+    except Exception:
+        # Legacy .xls files are not zip archives; let pandas read zero rows instead
+        frames = pd.read_excel(io.BytesIO(decoded), sheet_name=None, nrows=0)
+        return {name: [str(col) for col in df.columns] for name, df in frames.items()}
+    try:
+        header = {}
+        for worksheet in workbook.worksheets:
+            first_row = next(worksheet.iter_rows(max_row=1, values_only=True), ())
+            header[worksheet.title] = [str(value) for value in first_row if value is not None]
+        return header
+    finally:
+        workbook.close()
+
+
+def first_sheet_columns(header):
+    return next(iter(header.values()), [])
+
+
+def find_sheet(header, required):
+    """The first sheet whose header has every ``required`` column, else the first sheet."""
+    for sheet, columns in header.items():
+        if not missing_columns(columns, required):
+            return sheet
+    return next(iter(header), None)
+
+
+def missing_columns(columns, required):
+    return [col for col in dict.fromkeys(required) if col not in columns]
+
+
+def projection(columns, wanted):
+    wanted = set(wanted)
+    return [col for col in columns if col in wanted]
+
+
+def stored_columns(columns, wanted):
+    """The columns of a sheet to parse and store: ``wanted`` by the charts, and the row view's."""
+    if not ROW_COLUMNS:
+        # Blank headers are read as 'Unnamed: n' and carry nothing to show
+        return [col for col in dict.fromkeys(columns) if col]
+    return projection(columns, list(wanted) + ROW_COLUMNS)
+
+
+def read_frame(decoded, filename, usecols=None, nrows=None, sheet=None):
+    if usecols is not None:
+        # Header names are read as text; a numeric header such as 2024 must still match '2024'
+        wanted = set(usecols)
+        usecols = lambda col: str(col) in wanted
+    if is_csv(filename):
+        return pd.read_csv(io.BytesIO(decoded), usecols=usecols, nrows=nrows)
+    return pd.read_excel(io.BytesIO(decoded), usecols=usecols, nrows=nrows, sheet_name=sheet if sheet is not None else 0)
@@ -0,0 +1,271 @@
+"""Replay realistic dashboard sessions against a local gunicorn server.
+
+    python loadtest.py --users 1,10,30 --workers 4
+    python loadtest.py --app "FINAL VISUALIZATION:server" --prefix page1-
+
+Each virtual user uploads a synthetic workbook, picks a visualization, walks
+the Location -> Manager -> Consultant cascade and opens 'All Visualisations'.
+Every step is a POST to /_dash-update-component, built from the server's own
+/_dash-dependencies. The report shows p50/p95/p99 latency and throughput per
+step, plus the RSS of the gunicorn master and its workers.
+"""
+import argparse
+import base64
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+import uuid
+
+import numpy as np
+import pandas as pd
+
+VISUALIZATIONS = [
+    'ETBR Report',
+    'LMTD ETBR',
+    'Model ETBR',
+    'Enquiry Type vs ETBR',
+    'Enquiry Source vs ETBR',
+    'Team vs Enquiry, Booking, Test Drive, Retail',
+    'Team vs Enquiry Type Report',
+    'Walk In ETBR'
+]
+XLSX_MIME = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+# The filters the browser debounces into the filter-settled store, in its order; see generations.py
+CASCADE = [('visualization-dropdown', 'value'), ('location-dropdown', 'value'), ('sales-manager-dropdown', 'value'),
+           ('consultant-dropdown', 'value'), ('period-dropdown', 'value'), ('period-range', 'start_date'), ('period-range', 'end_date')]
+
+
+def synthetic_frame(rows, locations=5, managers=4, consultants=6, seed=0):
+    rng = np.random.default_rng(seed)
+    location = rng.integers(0, locations, rows)
+    manager = location * managers + rng.integers(0, managers, rows)
+    consultant = manager * consultants + rng.integers(0, consultants, rows)
+    df = pd.DataFrame({
+        'Dealer Location': [f'Location {i}' for i in location],
+        'Sales Manager': [f'Manager {i}' for i in manager],
+        'Sales Consultant': [f'Consultant {i}' for i in consultant],
+        'Enquiry Type': rng.choice(['Walk-in', 'Digital', 'Referral', 'Tele-in', 'Event'], rows),
+        'Enquiry Source': rng.choice(['Website', 'Showroom', 'Dealer Event', 'Social Media'], rows),
+        'Model': rng.choice(['Alpha', 'Bravo', 'Charlie', 'Delta', 'Echo', 'Foxtrot'], rows)
+    })
+    for stage in ['ENQUIRY', 'TD', 'BOOKING', 'RETAIL']:
+        df[f'{stage} MTD'] = rng.integers(0, 5, rows)
+        df[f'{stage} LMTD'] = rng.integers(0, 5, rows)
+    # Page 2 columns
+    df['Product Family'] = rng.choice(['Hatchback', 'Sedan', 'SUV', 'MUV'], rows)
+    df['Existing vehicle Latest1'] = rng.choice([f'Vehicle {i}' for i in range(40)], rows)
+    df['Intrested In Exchange'] = rng.random(rows) < 0.3
+    df['Completed Followup Count'] = rng.integers(0, 3, rows)
+    return df
+
+
+def synthetic_workbook(rows, **kwargs):
+    buffer = io.BytesIO()
+    synthetic_frame(rows, **kwargs).to_excel(buffer, index=False)
+    return f'data:{XLSX_MIME};base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+
+def _split_output(output):
+    # Multi-output callbacks are encoded as "..id.prop...id.prop.."
+    parts = output[2:-2].split('...') if output.startswith('..') else [output]
+    return [dict(zip(('id', 'property'), part.rsplit('.', 1))) for part in parts]
+
+
+class Session:
+    def __init__(self, base_url, callback, prefix):
+        self.base_url = base_url
+        self.callback = callback
+        self.prefix = prefix
+        # Each virtual user is one page load, with its own page id
+        self.props = {('page-id', 'data'): uuid.uuid4().hex}
+
+    def _id(self, name):
+        return self.prefix + name
+
+    def options(self, name):
+        return [opt['value'] for opt in self.props.get((self._id(name), 'options')) or []]
+
+    def fire(self, changes):
+        for (name, prop), value in changes.items():
+            self.props[(self._id(name), prop)] = value
+        if any(change in CASCADE for change in changes):
+            # As the browser does once the debounce has passed; the wait itself is not replayed.
+            # Other changes in the same step, such as an upload, still reach the callback.
+            settled = [self.props.get((self._id(name), prop)) for name, prop in CASCADE]
+            changes = {**{change: value for change, value in changes.items() if change not in CASCADE},
+                       ('filter-settled', 'data'): settled}
+            self.props[(self._id('filter-settled'), 'data')] = changes[('filter-settled', 'data')]
+        body = {
+            'output': self.callback['output'],
+            'outputs': _split_output(self.callback['output']),
+            'inputs': [dict(dep, value=self.props.get((dep['id'], dep['property']))) for dep in self.callback['inputs']],
+            'state': [dict(dep, value=self.props.get((dep['id'], dep['property']))) for dep in self.callback['state']],
+            'changedPropIds': [f'{self._id(name)}.{prop}' for name, prop in changes]
+        }
+        request = urllib.request.Request(
+            self.base_url + '/_dash-update-component',
+            data=json.dumps(body).encode('utf-8'),
+            headers={'Content-Type': 'application/json'}
+        )
+        with urllib.request.urlopen(request, timeout=600) as response:
+            payload = json.loads(response.read() or b'{}')
+        for component_id, props in payload.get('response', {}).items():
+            for prop, value in props.items():
+                # Patches only make sense on the client; the props we replay never need them
+                if not (isinstance(value, dict) and '__dash_patch_update' in value):
+                    self.props[(component_id, prop)] = value
+
+
+def run_session(session, contents, record):
+    def step(name, changes):
+        start = time.perf_counter()
+        try:
+            session.fire(changes)
+            record(name, time.perf_counter() - start, None)
+        except Exception as e:
+            record(name, time.perf_counter() - start, e)
+
+    step('upload', {('upload-data', 'contents'): contents, ('upload-data', 'filename'): 'loadtest.xlsx'})
+    step('visualization', {('visualization-dropdown', 'value'): random.choice(VISUALIZATIONS)})
+    for name, dropdown in (('location', 'location-dropdown'), ('manager', 'sales-manager-dropdown'), ('consultant', 'consultant-dropdown')):
+        options = session.options(dropdown)
+        if options:
+            step(name, {(dropdown, 'value'): random.choice(options)})
+    step('all visualisations', {('visualization-dropdown', 'value'): 'All Visualisations'})
+
+
+def find_callback(base_url, prefix):
+    with urllib.request.urlopen(base_url + '/_dash-dependencies', timeout=60) as response:
+        dependencies = json.loads(response.read())
+    for callback in dependencies:
+        inputs = {(dep['id'], dep['property']) for dep in callback['inputs']}
+        if (prefix + 'upload-data', 'contents') in inputs and (prefix + 'filter-settled', 'data') in inputs:
+            return callback
+    raise SystemExit('Could not find the page 1 callback; check --prefix')
+
+
+def process_tree_rss(pid):
+    # Sum VmRSS over the gunicorn master and every worker it forked
+    pids, total = [pid], 0
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as stat:
+                    if int(stat.read().rsplit(')', 1)[1].split()[1]) == pid:
+                        pids.append(int(entry))
+            except (OSError, IndexError, ValueError):
+                continue
+    for child in pids:
+        try:
+            with open(f'/proc/{child}/status') as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+def start_server(app, workers, threads, port):
+    command = [sys.executable, '-m', 'gunicorn', '-w', str(workers), '--threads', str(threads), '-b', f'127.0.0.1:{port}', '--timeout', '600', app]
+    process = subprocess.Popen(command)
+    base_url = f'http://127.0.0.1:{port}'
+    for _ in range(120):
+        try:
+            urllib.request.urlopen(base_url + '/_dash-layout', timeout=1)
+            return process, base_url
+        except Exception:
+            time.sleep(0.5)
+    process.terminate()
+    raise SystemExit('gunicorn did not start')
+
+
+def percentile(values, q):
+    if len(values) == 1:
+        return values[0]
+    return statistics.quantiles(values, n=100, method='inclusive')[q - 1]
+
+
+def run_level(base_url, callback, prefix, users, sessions, contents, server_pid):
+    timings, errors, lock = {}, {}, threading.Lock()
+    peak_rss = [0]
+    done = threading.Event()
+
+    def record(name, elapsed, error):
+        with lock:
+            timings.setdefault(name, []).append(elapsed)
+            if error is not None:
+                errors[name] = errors.get(name, 0) + 1
+
+    def sample_rss():
+        while server_pid and not done.wait(0.2):
+            peak_rss[0] = max(peak_rss[0], process_tree_rss(server_pid))
+
+    def user():
+        for _ in range(sessions):
+            run_session(Session(base_url, callback, prefix), contents, record)
+
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=user) for _ in range(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    done.set()
+    sampler.join()
+
+    print(f'\n{users} concurrent users, {sessions} session(s) each, {elapsed:.1f}s')
+    if server_pid:
+        print(f'server RSS: peak {peak_rss[0] / 2**20:.0f} MiB, final {process_tree_rss(server_pid) / 2**20:.0f} MiB')
+    print(f"{'step':<20}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>9}")
+    for name, values in timings.items():
+        values = sorted(values)
+        print(f"{name:<20}{len(values):>7}{errors.get(name, 0):>8}"
+              f"{percentile(values, 50) * 1000:>10.0f}{percentile(values, 95) * 1000:>10.0f}{percentile(values, 99) * 1000:>10.0f}"
+              f"{len(values) / elapsed:>9.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--app', default='visualizations:server', help='gunicorn app to start')
+    parser.add_argument('--url', help='test an already running server instead of starting gunicorn')
+    parser.add_argument('--prefix', default='', help="component id prefix, e.g. 'page1-' for FINAL VISUALIZATION")
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--users', default='1,5,10,30', help='comma-separated concurrency levels')
+    parser.add_argument('--sessions', type=int, default=3, help='sessions per virtual user')
+    parser.add_argument('--rows', type=int, default=20000, help='rows in the synthetic workbook')
+    args = parser.parse_args()
+
+    print(f'Building a synthetic workbook with {args.rows} rows...')
+    contents = synthetic_workbook(args.rows)
+
+    process = None
+    if args.url:
+        base_url, server_pid = args.url.rstrip('/'), None
+    else:
+        process, base_url = start_server(args.app, args.workers, args.threads, args.port)
+        server_pid = process.pid
+    try:
+        callback = find_callback(base_url, args.prefix)
+        for users in [int(level) for level in args.users.split(',')]:
+            run_level(base_url, callback, args.prefix, users, args.sessions, contents, server_pid)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+
+if __name__ == '__main__':
+    main()
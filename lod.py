@@ -0,0 +1,286 @@
+"""Chart detail that fits a response-time budget, with the exact charts on request.
+
+A group-wide export can have thousands of consultants or vehicle models.
+The team chart then has one trace per consultant and takes tens of
+seconds to build. The browser also struggles with figures of tens of
+thousands of labelled bars. Each chart request gets a budget of
+ETBR_CHART_BUDGET_MS milliseconds (default 2000). The budget starts before
+the aggregation, so a slow aggregation leaves less time for the figures.
+
+Once the aggregates are known, the cost of each figure is estimated from
+its number of categories (see COST_MS), or from the build times measured
+on this worker where those are slower. The cheapest figures are planned
+first, so the small charts keep their detail and a huge one gets the time
+that is left. A figure that does not fit is degraded one step at a time:
+
+1. the value labels are dropped;
+2. only the largest categories are kept, by their summed metrics, and the
+   rest are summed into one 'Other (n more)' category. Totals are unchanged.
+
+A reduced chart says so in its description, and the page shows a 'Load full
+detail' button. The button builds the exact charts in a background thread,
+under a heavy-job slot. The figure JSON, or a ``.failed`` marker if the build
+fails, is written under ``<ETBR_DATA_DIR>/detail``, so any worker can answer
+the page's polls. The page swaps the figures in when they are ready.
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import plotly.io
+
+import datastore
+import governor
+
+logger = logging.getLogger(__name__)
+
+BUDGET_MS = float(os.environ.get('ETBR_CHART_BUDGET_MS', 2000))
+POLL_INTERVAL = float(os.environ.get('ETBR_DETAIL_POLL', 1))
+DETAIL_DIR = os.path.join(datastore.DATA_DIR, 'detail')
+# Full-detail results unused for longer than this are removed
+RESULT_TTL = 600
+# Never coarsen below this many categories, whatever the budget
+MIN_CATEGORIES = 10
+
+# Estimated milliseconds to build, send and draw a figure: a fixed part, then
+# per category for each kind of chart. 'bars' is a bar per category and
+# metric, 'traces' a trace per category (stacked by consultant or source),
+# 'sectors' a sunburst. Measured on the reference server and a mid-range
+# laptop; the team chart with 1000 consultants takes about 4.4 s to build.
+FIGURE_MS = 80
+COST_MS = {'bars': 0.4, 'traces': 5.0, 'sectors': 1.0}
+# Per-category build times measured on this worker are used where they are
+# slower, e.g. on a busy server; see observe()
+MEASURE_WEIGHT = 0.3
+# Share of that cost saved by dropping the value labels
+LABEL_SHARE = {'bars': 0.5, 'traces': 0.1, 'sectors': 0.4}
+
+# How a chart is drawn: with or without value labels, and at most ``keep``
+# of its ``categories`` (None: all of them)
+Detail = namedtuple('Detail', ['labels', 'keep', 'categories'])
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='etbr-full-detail')
+_lock = threading.Lock()
+# job id -> Future of its background build
+_jobs = {}
+_last_sweep = [0.0]
+# kind -> measured milliseconds per category, a moving average
+_measured = {}
+
+
+def estimate(kind, categories, labels=True):
+    """Estimated milliseconds for a figure of ``kind`` with ``categories`` categories."""
+    if kind is None:
+        return FIGURE_MS
+    cost = _per_category(kind) * categories
+    if not labels:
+        cost *= 1 - LABEL_SHARE[kind]
+    return FIGURE_MS + cost
+
+
+def _per_category(kind):
+    with _lock:
+        return max(COST_MS[kind], _measured.get(kind, 0))
+
+
+def _affordable(kind, ms):
+    # Categories a labelled figure of ``kind`` can show in ``ms``
+    return int((ms - FIGURE_MS) // _per_category(kind))
+
+
+def observe(kind, categories, ms):
+    """Learn from a figure of ``kind`` with ``categories`` categories that took ``ms`` to build."""
+    if kind is None or categories < MIN_CATEGORIES:
+        return
+    per_category = max(ms - FIGURE_MS, 0) / categories
+    with _lock:
+        previous = _measured.get(kind)
+        _measured[kind] = per_category if previous is None else (1 - MEASURE_WEIGHT) * previous + MEASURE_WEIGHT * per_category
+
+
+class Budget:
+    """The time one chart request may take, started when it is created."""
+
+    def __init__(self, ms=None):
+        self.ms = BUDGET_MS if ms is None else ms
+        self.started = time.perf_counter()
+        # Names of the charts drawn with less than full detail
+        self.reduced = []
+
+    def remaining(self):
+        return self.ms - (time.perf_counter() - self.started) * 1000
+
+    def plan(self, figures):
+        """{name: Detail} for the figures of [(name, kind, categories)] that must be reduced.
+
+        ``kind`` is a key of COST_MS, or None for a figure of fixed size. The
+        cheapest figures are planned first. Each may use the time left, less
+        what the figures after it need at their smallest, so one huge chart
+        is coarsened rather than every chart losing detail.
+        """
+        left = self.remaining()
+        details = {}
+        pending = sorted(figures, key=lambda figure: estimate(figure[1], figure[2]))
+        smallest = [estimate(kind, min(categories, MIN_CATEGORIES)) for _, kind, categories in pending]
+        for position, (name, kind, categories) in enumerate(pending):
+            share = left - sum(smallest[position + 1:])
+            cost = estimate(kind, categories)
+            if kind is not None and cost > share and categories > MIN_CATEGORIES:
+                if estimate(kind, categories, labels=False) <= share:
+                    detail = Detail(False, None, categories)
+                else:
+                    detail = Detail(True, min(max(MIN_CATEGORIES, _affordable(kind, share)), categories - 1), categories)
+                details[name] = detail
+                self.reduced.append(name)
+                cost = estimate(kind, detail.keep or categories, detail.labels)
+            left -= cost
+        if details:
+            logger.info(f'Reduced detail with {self.remaining():.0f} ms of {self.ms:.0f} left: {details}')
+        return details
+
+
+def other_label(count):
+    return f'Other ({count} more)'
+
+
+def is_other(value):
+    return isinstance(value, str) and re.fullmatch(r'Other \(\d+ more\)', value) is not None
+
+
+def coarsen(agg, keep, columns=None):
+    """The ``keep - 1`` largest rows of ``agg`` in their original order, and one row summing the others.
+
+    ``agg`` is a Series or a DataFrame indexed by category; rows are ranked
+    by the sum of ``columns`` (default: all of them).
+    """
+    if keep is None or len(agg) <= keep:
+        return agg
+    weight = agg if agg.ndim == 1 else agg[columns or list(agg.columns)].sum(axis=1)
+    top = agg.index.isin(weight.nlargest(keep - 1, keep='first').index)
+    rest = agg[~top]
+    if agg.ndim == 1:
+        other = pd.Series([rest.sum()], index=[other_label(len(rest))], name=agg.name)
+    else:
+        other = rest.sum().to_frame(other_label(len(rest))).T.astype(agg.dtypes.to_dict())
+    coarse = pd.concat([agg[top], other])
+    coarse.index.name = agg.index.name
+    coarse.attrs['other'] = other.index[0]
+    return coarse
+
+
+def categories(agg):
+    """``agg`` without the 'Other' row ``coarsen`` added, e.g. to name its top category."""
+    return agg.drop(index=agg.attrs['other']) if 'other' in agg.attrs else agg
+
+
+def apply(detail, fig, description, noun):
+    """Drop the labels of ``fig`` if planned, and say in ``description`` how it was reduced."""
+    if detail is None:
+        return fig, description
+    if not detail.labels:
+        fig.update_traces(text=None, texttemplate=None)
+        fig.update_traces(textinfo='none', selector={'type': 'sunburst'})
+        note = 'Value labels are hidden to keep this chart quick.'
+    else:
+        note = (f'Showing the {detail.keep - 1} largest of {detail.categories} {noun} values; '
+                f'the other {detail.categories - detail.keep + 1} are summed as "Other".')
+    return fig, f'{note} Use "Load Full Detail" for the exact chart.\n' + description
+
+
+def job_id(view, reuse=True):
+    """A content address for the exact charts of ``view``, a JSON-serialisable description of it.
+
+    With ``reuse=False``, for a source that changes under us such as the
+    database, every call gets a new id, so an earlier build is never reused.
+    """
+    if not reuse:
+        view = [view, uuid.uuid4().hex]
+    return hashlib.sha256(json.dumps(view, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _path(job):
+    return os.path.join(DETAIL_DIR, f'{job}.json')
+
+
+def _failed_path(job):
+    return os.path.join(DETAIL_DIR, f'{job}.failed')
+
+
+def _sweep():
+    now = time.time()
+    if now - _last_sweep[0] < RESULT_TTL:
+        return
+    _last_sweep[0] = now
+    for entry in os.scandir(DETAIL_DIR):
+        try:
+            if now - entry.stat().st_mtime > RESULT_TTL:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def _build(job, compute):
+    os.makedirs(DETAIL_DIR, exist_ok=True)
+    try:
+        with governor.heavy_job():
+            result = compute()
+    except Exception:
+        logger.exception(f'Full detail {job[:12]} failed')
+        # Shared, so a poll answered by any worker sees the failure
+        with open(_failed_path(job), 'w', encoding='utf-8'):
+            pass
+        raise
+    # Write then rename, so a poll in another worker never reads half a file
+    temp_path = f'{_path(job)}.{uuid.uuid4().hex}'
+    with open(temp_path, 'w', encoding='utf-8') as handle:
+        handle.write(plotly.io.json.to_json_plotly(result))
+    os.replace(temp_path, _path(job))
+    logger.info(f'Full detail {job[:12]} ready')
+
+
+def start(job, compute):
+    """Run ``compute()`` in the background unless ``job`` is done or running.
+
+    ``compute`` returns the exact charts as JSON-serialisable data, figures
+    included; ``result(job)`` returns them decoded.
+    """
+    os.makedirs(DETAIL_DIR, exist_ok=True)
+    _sweep()
+    if os.path.exists(_path(job)):
+        os.utime(_path(job))
+        return
+    # A retry after a failure starts afresh
+    try:
+        os.remove(_failed_path(job))
+    except FileNotFoundError:
+        pass
+    with _lock:
+        if job not in _jobs or _jobs[job].done():
+            _jobs[job] = _executor.submit(_build, job, compute)
+
+
+def status(job):
+    """'done', 'failed' or 'running' for a full-detail ``job``."""
+    if os.path.exists(_path(job)):
+        with _lock:
+            _jobs.pop(job, None)
+        return 'done'
+    if os.path.exists(_failed_path(job)):
+        with _lock:
+            _jobs.pop(job, None)
+        return 'failed'
+    # Otherwise this or another worker is still building it; either writes to the shared directory
+    return 'running'
+
+
+def result(job):
+    with open(_path(job), encoding='utf-8') as handle:
+        return json.load(handle)
@@ -0,0 +1,123 @@
+"""Progressive uploads: provisional charts from the first rows while the full parse runs.
+
+Parsing a large workbook can take a minute. For an upload of at least
+ETBR_PREVIEW_MIN_MB (default 2), only the first ETBR_PREVIEW_ROWS rows
+(default 2000) are parsed at first. They are stored as a small preview
+dataset, so the page shows charts within about a second. The charts are
+titled as a preview. The full parse then runs in a background thread,
+under a heavy-job slot like any other parse. The page checks ``status``
+every ETBR_PREVIEW_POLL seconds and switches to the full dataset when it
+is ready. The exact figures arrive as a figure patch. A failed parse leaves
+``<key>.failed`` with its message in ETBR_DATA_DIR, so a poll answered by
+any worker sees it.
+
+The first rows of an export are not a random sample, because exports are
+usually sorted. Preview numbers are a first look only and are never
+scaled up to the file size.
+"""
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import datastore
+import governor
+import ingest
+
+logger = logging.getLogger(__name__)
+
+PREVIEW_ROWS = int(os.environ.get('ETBR_PREVIEW_ROWS', 2000))
+PREVIEW_MIN_BYTES = int(float(os.environ.get('ETBR_PREVIEW_MIN_MB', 2)) * 2**20)
+POLL_INTERVAL = float(os.environ.get('ETBR_PREVIEW_POLL', 1))
+TITLE_PREFIX = 'PREVIEW (partial data): '
+
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='etbr-full-parse')
+_lock = threading.Lock()
+# full dataset key -> Future of its background parse
+_jobs = {}
+
+
+def wanted(decoded, key):
+    """Whether to preview this upload: big enough to be slow, and not stored already."""
+    return bool(PREVIEW_ROWS) and len(decoded) >= PREVIEW_MIN_BYTES and not datastore.exists(key)
+
+
+def preview_key(key):
+    return hashlib.sha256(f'{key}:first-{PREVIEW_ROWS}'.encode('utf-8')).hexdigest()
+
+
+def _failed_path(key):
+    return os.path.join(datastore.DATA_DIR, f'{key}.failed')
+
+
+def _parse_full(key, decoded, parse, columns, then, sheet):
+    try:
+        with governor.heavy_job():
+            key = datastore.ingest(decoded, parse, columns=columns, sheet=sheet)
+    except Exception as e:
+        if isinstance(e, governor.ResourceLimitError):
+            message = str(e)
+        else:
+            logger.exception(f'Full parse of {key[:12]} failed')
+            message = 'The file could not be read completely.'
+        with open(_failed_path(key), 'w', encoding='utf-8') as handle:
+            handle.write(message)
+        raise
+    logger.info(f'Full parse of {key[:12]} done')
+    if then is not None:
+        then(key)
+    return key
+
+
+def start(decoded, filename, columns, parse, then=None, sheet=None):
+    """Store the first rows and start the full parse; returns the preview dataset key.
+
+    ``parse`` is the full parse handed to ``datastore.ingest``. ``then(key)``
+    runs in the background thread once the full dataset is stored.
+    """
+    key = datastore.dataset_key(decoded, columns, sheet)
+    first_key = preview_key(key)
+    if not datastore.exists(first_key):
+        datastore.save_dataset(ingest.read_frame(decoded, filename, columns, nrows=PREVIEW_ROWS, sheet=sheet), first_key)
+    with _lock:
+        # Another upload of a file that failed before parses it again
+        if key not in _jobs or _jobs[key].done():
+            if os.path.exists(_failed_path(key)):
+                os.remove(_failed_path(key))
+            _jobs[key] = _executor.submit(_parse_full, key, decoded, parse, columns, then, sheet)
+    return first_key
+
+
+def status(key):
+    """'done', 'failed' or 'running' for the full dataset ``key``."""
+    if os.path.exists(_failed_path(key)):
+        return 'failed'
+    if datastore.exists(key):
+        with _lock:
+            _jobs.pop(key, None)
+        return 'done'
+    # Otherwise this or another worker is still parsing it; either writes to the shared store
+    return 'running'
+
+
+def error(key):
+    """The message of a failed full parse; forgets the failure so the file can be uploaded again."""
+    with _lock:
+        _jobs.pop(key, None)
+    try:
+        with open(_failed_path(key), encoding='utf-8') as handle:
+            message = handle.read()
+        os.remove(_failed_path(key))
+    except OSError:
+        message = ''
+    return message or 'The file could not be read completely.'
+
+
+def mark(viz_data):
+    """Title every figure as a preview and say so above each description."""
+    marked = []
+    for fig, description in viz_data:
+        fig.update_layout(title_text=TITLE_PREFIX + (fig.layout.title.text or ''))
+        marked.append((fig, f'Preview from the first {PREVIEW_ROWS} rows; exact figures will replace it when the whole file is loaded.\n' + description))
+    return marked
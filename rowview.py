@@ -0,0 +1,155 @@
+"""Raw rows behind a chart, one page at a time.
+
+The drill-through table uses DataTable's custom paging, sorting and
+filtering, so the browser only ever holds one page. Every request filters
+the resident dataset by the Location / Manager / Consultant dropdowns, the
+clicked chart category and the table's own filter row. It then sorts only
+the row indices and takes the requested page. Database sources do the same
+with WHERE / ORDER BY / LIMIT.
+"""
+import re
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+import backends
+import charts
+import datastore
+import dbsource
+import lod
+
+PAGE_SIZE = 20
+
+# DataTable filter_query operators, by their canonical form
+OPERATORS = {
+    '=': '=', 'eq': '=', 's=': '=', 'i=': '=',
+    '!=': '!=', 'ne': '!=', 's!=': '!=', 'i!=': '!=',
+    '<': '<', 'lt': '<', 's<': '<', 'i<': '<',
+    '<=': '<=', 'le': '<=', 's<=': '<=', 'i<=': '<=',
+    '>': '>', 'gt': '>', 's>': '>', 'i>': '>',
+    '>=': '>=', 'ge': '>=', 's>=': '>=', 'i>=': '>=',
+    'contains': 'contains', 'icontains': 'contains', 'scontains': 'contains',
+    'datestartswith': 'datestartswith'
+}
+_CONDITION = re.compile(r'^\s*\{(?P<column>[^}]+)\}\s+(?P<operator>\S+)\s+(?P<value>.*?)\s*$')
+_ARROW_COMPARE = {'=': pc.equal, '!=': pc.not_equal, '<': pc.less, '<=': pc.less_equal, '>': pc.greater, '>=': pc.greater_equal}
+
+
+def category_filter(chart, click_data):
+    """Row filter for a click on ``chart``: {group_by column: clicked category}, or {}."""
+    spec = charts.CHARTS.get(chart)
+    if spec is None or not click_data or not click_data.get('points'):
+        return {}
+    if 'row_filter' in spec:
+        return dict(spec['row_filter'])
+    if not spec['group_by']:
+        return {}
+    custom = click_data['points'][0].get('customdata')
+    value = custom[0] if isinstance(custom, (list, tuple)) else custom
+    # Sunburst parents whose children disagree carry '(?)'; the 'Other' bar of a
+    # reduced chart (see lod.py) stands for many categories
+    if value is None or value == '(?)' or lod.is_other(value):
+        return {}
+    return {spec['group_by'][0]: value}
+
+
+def parse_filter_query(filter_query):
+    """[(column, operator, value)] from a DataTable filter_query; unknown parts are ignored."""
+    conditions = []
+    for part in (filter_query or '').split(' && '):
+        match = _CONDITION.match(part)
+        if not match or match['operator'] not in OPERATORS:
+            continue
+        value = match['value']
+        if len(value) >= 2 and value[0] == value[-1] and value[0] in '"\'`':
+            value = value[1:-1].replace('\\' + value[0], value[0])
+        else:
+            try:
+                value = float(value)
+            except ValueError:
+                pass
+        conditions.append((match['column'], OPERATORS[match['operator']], value))
+    return conditions
+
+
+def _text(value):
+    # '4' typed in the filter row parses as 4.0; match it as '4'
+    return str(int(value)) if isinstance(value, float) and value.is_integer() else str(value)
+
+
+def _arrow_mask(column, operator, value):
+    if operator in ('contains', 'datestartswith'):
+        text = pc.cast(column, pa.string())
+        if operator == 'contains':
+            return pc.match_substring(text, _text(value), ignore_case=True)
+        return pc.starts_with(text, _text(value))
+    if pa.types.is_integer(column.type) or pa.types.is_floating(column.type):
+        value = float(value)
+    else:
+        value = _text(value)
+        column = pc.cast(column, pa.string())
+    return _ARROW_COMPARE[operator](column, pa.scalar(value))
+
+
+def arrow_page(table, filters, conditions, sort_by, page, page_size):
+    table = datastore.filter_table(table, filters)
+    for column, operator, value in conditions:
+        if column not in table.column_names:
+            continue
+        try:
+            table = table.filter(pc.fill_null(_arrow_mask(table[column], operator, value), False))
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError, ValueError):
+            # A filter the column cannot satisfy (e.g. text against numbers) matches nothing
+            table = table.slice(0, 0)
+    start = page * page_size
+    sort_keys = [(sort['column_id'], 'ascending' if sort['direction'] == 'asc' else 'descending')
+                 for sort in sort_by or [] if sort['column_id'] in table.column_names]
+    if sort_keys:
+        # Sort the indices, then materialise only the requested page
+        indices = pc.sort_indices(table, sort_keys=sort_keys)[start:start + page_size]
+        rows = table.take(indices)
+    else:
+        rows = table.slice(start, page_size)
+    return rows.to_pylist(), table.num_rows
+
+
+def _sql_condition(column, operator, value):
+    quoted = backends.sql_quote(column)
+    if operator == 'contains':
+        return f'LOWER(CAST({quoted} AS TEXT)) LIKE ?', f'%{_text(value).lower()}%'
+    if operator == 'datestartswith':
+        return f'CAST({quoted} AS TEXT) LIKE ?', f'{_text(value)}%'
+    return f'{quoted} {operator} ?', value
+
+
+def database_page(filters, conditions, sort_by, page, page_size):
+    ref = dbsource.backend.filter(dbsource.TableRef(), filters)
+    where, params = ref.where()
+    clauses = [where[len(' WHERE '):]] if where else []
+    for column, operator, value in conditions:
+        if column in ref.column_names:
+            clause, param = _sql_condition(column, operator, value)
+            clauses.append(clause)
+            params.append(param)
+    where = (' WHERE ' + ' AND '.join(clauses)) if clauses else ''
+    table = backends.sql_quote(ref.table)
+    order = ', '.join(f"{backends.sql_quote(sort['column_id'])} {'ASC' if sort['direction'] == 'asc' else 'DESC'}"
+                      for sort in sort_by or [] if sort['column_id'] in ref.column_names)
+    _, total = dbsource.query(f'SELECT COUNT(*) FROM {table}{where}', params)
+    names, rows = dbsource.query(f"SELECT * FROM {table}{where}{' ORDER BY ' + order if order else ''} LIMIT ? OFFSET ?",
+                                 params + [page_size, page * page_size])
+    return [dict(zip(names, row)) for row in rows], total[0][0]
+
+
+def columns(stored_data):
+    if stored_data.get('source') == 'database' and dbsource.enabled():
+        return dbsource.TableRef().column_names
+    return datastore.column_names(stored_data['key'])
+
+
+def query_rows(stored_data, filters, filter_query, sort_by, page, page_size):
+    """One page of matching rows and the total number of matches."""
+    conditions = parse_filter_query(filter_query)
+    if stored_data.get('source') == 'database' and dbsource.enabled():
+        return database_page(filters, conditions, sort_by, page, page_size)
+    return arrow_page(datastore.attach(stored_data['key']), filters, conditions, sort_by, page, page_size)
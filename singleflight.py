@@ -0,0 +1,186 @@
+"""Run identical concurrent computations once.
+
+At the start of a review meeting many managers open the same regional file
+and the same default views within seconds of each other. Without
+coordination, every request thread parses and aggregates the same thing in
+parallel. ``run(name, compute)`` coalesces calls that share a name:
+
+* threads of one worker wait for the call in flight and share its result,
+  or its exception;
+* workers take turns on a lock file under ``<ETBR_DATA_DIR>/flights``. The
+  first one computes. The others then find the result where the first one
+  stored it: the dataset or image store, via ``lookup``, or a pickle the
+  first worker writes when it sees that another one is waiting. A worker
+  waits at most ETBR_QUEUE_TIMEOUT seconds (see governor.py), then computes
+  the result itself.
+
+Names are built from the dataset hash, the stage and its parameters, and
+datasets are content-addressed, so a stored result never goes stale.
+Lock files need ``fcntl``; without it (Windows development servers) only
+threads are coalesced.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+import uuid
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+import datastore
+
+logger = logging.getLogger(__name__)
+
+# Result pickles and lock files unused for longer than this are removed
+RESULT_TTL = 600
+
+_lock = threading.Lock()
+# name -> _Flight of the call computing it in this worker
+_flights = {}
+_stats = {'computed': 0, 'coalesced': 0}
+_last_sweep = [0.0]
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def _flights_dir():
+    # Read at call time: datastore imports this module
+    return os.path.join(datastore.DATA_DIR, 'flights')
+
+
+def _sweep(directory):
+    now = time.time()
+    if now - _last_sweep[0] < RESULT_TTL:
+        return
+    _last_sweep[0] = now
+    for entry in os.scandir(directory):
+        try:
+            if now - entry.stat().st_mtime > RESULT_TTL:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+def _read_result(path):
+    try:
+        with open(path, 'rb') as handle:
+            return True, pickle.load(handle)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return False, None
+
+
+def _write_result(path, result):
+    # Write then rename, so a waiting worker never reads half a pickle
+    temp_path = f'{path}.{uuid.uuid4().hex}'
+    with open(temp_path, 'wb') as handle:
+        pickle.dump(result, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, path)
+
+
+def _wait_for_lock(lock_file):
+    # Read at call time: governor imports this module
+    import governor
+    deadline = time.monotonic() + governor.QUEUE_TIMEOUT
+    delay = 0.01
+    while True:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.25)
+
+
+def _across_workers(name, compute, lookup):
+    directory = _flights_dir()
+    os.makedirs(directory, exist_ok=True)
+    _sweep(directory)
+    base = os.path.join(directory, hashlib.sha256(repr(name).encode('utf-8')).hexdigest())
+    with open(base + '.lock', 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # Another worker is computing it; ask it to leave the result behind
+            open(base + '.waiting', 'a').close()
+            if not _wait_for_lock(lock_file):
+                logger.warning(f'Gave up waiting for another worker to compute {name[0]}; computing it here')
+                return compute(), False
+        try:
+            os.utime(base + '.lock')
+            if lookup is not None:
+                result = lookup()
+                if result is not None:
+                    return result, True
+            else:
+                found, result = _read_result(base + '.result')
+                if found:
+                    return result, True
+            result = compute()
+            if os.path.exists(base + '.waiting'):
+                # With a lookup, the waiting workers find the result where compute() stored it
+                if lookup is None:
+                    _write_result(base + '.result', result)
+                try:
+                    os.remove(base + '.waiting')
+                except FileNotFoundError:
+                    pass
+            return result, False
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def run(name, compute, lookup=None, workers=True):
+    """``compute()``, computed once for all concurrent calls with the same ``name``.
+
+    ``name`` is a tuple: the stage, then the dataset key and parameters.
+    ``lookup()`` returns the result if another worker has stored it already,
+    else None. Without ``lookup``, the result is pickled for the workers that
+    waited on it. With ``workers=False`` only threads are coalesced, for
+    results each worker keeps in its own memory.
+    """
+    with _lock:
+        flight = _flights.get(name)
+        leader = flight is None
+        if leader:
+            flight = _flights[name] = _Flight()
+    if not leader:
+        flight.done.wait()
+        with _lock:
+            _stats['coalesced'] += 1
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+    try:
+        if workers and fcntl is not None:
+            flight.result, shared = _across_workers(name, compute, lookup)
+        else:
+            flight.result, shared = compute(), False
+        with _lock:
+            _stats['coalesced' if shared else 'computed'] += 1
+        if shared:
+            logger.info(f'Took {name[0]} from another worker')
+        return flight.result
+    except BaseException as e:
+        flight.error = e
+        raise
+    finally:
+        with _lock:
+            _flights.pop(name, None)
+        flight.done.set()
+
+
+def usage():
+    with _lock:
+        return dict(_stats)
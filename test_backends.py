@@ -0,0 +1,71 @@
+"""Every compute backend agrees with pandas; the parity half of benchmark_backends.py.
+
+    python -m pytest -q test_backends.py
+
+Backends whose package is not installed are skipped.
+"""
+import importlib.util
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pytest
+
+import backends
+import charts
+from benchmark_backends import CTX, _same, workload
+from loadtest import synthetic_frame
+
+ROWS = 5000
+
+
+@pytest.fixture(scope='module')
+def source():
+    # Same shape the app hands to the backends: an Arrow table from the dataset store
+    return pa.Table.from_pandas(synthetic_frame(ROWS), preserve_index=False)
+
+
+@pytest.fixture(scope='module')
+def expected(source):
+    return workload(backends.get_backend('pandas'), source)
+
+
+def _backend(name):
+    if importlib.util.find_spec(name) is None:
+        pytest.skip(f'{name} is not installed')
+    return backends.get_backend(name)
+
+
+@pytest.mark.parametrize('name', ['polars', 'duckdb'])
+def test_aggregations_match_pandas(name, source, expected):
+    actual = workload(_backend(name), source)
+    for key, value in expected.items():
+        _same(value, actual[key])
+
+
+@pytest.mark.parametrize('name', ['polars', 'duckdb'])
+def test_charts_match_pandas(name, source):
+    reference = charts.build_charts(charts.ALL_CHARTS, source, CTX, backends.get_backend('pandas'))
+    actual = charts.build_charts(charts.ALL_CHARTS, source, CTX, _backend(name))
+    for chart, (expected_fig, expected_description), (fig, description) in zip(charts.ALL_CHARTS, reference, actual):
+        assert fig.to_json() == expected_fig.to_json(), chart
+        assert description == expected_description, chart
+
+
+@pytest.mark.parametrize('name', ['polars', 'duckdb'])
+def test_filter_returns_an_arrow_table(name, source):
+    # The charts read the filtered rows more than once, so they must be materialised
+    location = source['Dealer Location'][0].as_py()
+    filtered = _backend(name).filter(source, {'Dealer Location': location})
+    reference = backends.get_backend('pandas').filter(source, {'Dealer Location': location})
+    assert isinstance(filtered, pa.Table)
+    assert filtered.num_rows == len(reference) > 0
+    assert set(filtered['Dealer Location'].to_pylist()) == {location}
+
+
+def test_pandas_filter_returns_a_frame(source):
+    location = source['Dealer Location'][0].as_py()
+    filtered = backends.get_backend('pandas').filter(source, {'Dealer Location': location})
+    expected = source.filter(pc.equal(source['Dealer Location'], location)).num_rows
+    assert isinstance(filtered, pd.DataFrame)
+    assert len(filtered) == expected
@@ -0,0 +1,45 @@
+"""The row view shows the rows as uploaded, not just the columns the charts use.
+
+    python -m pytest -q test_rowview.py
+"""
+import pytest
+
+import charts
+import datastore
+import eventstore
+import ingest
+import rowview
+from loadtest import synthetic_frame
+
+REQUIRED = ['Dealer Location', 'Sales Manager', 'Sales Consultant']
+
+
+@pytest.fixture
+def upload(tmp_path, monkeypatch):
+    monkeypatch.setattr(datastore, 'DATA_DIR', str(tmp_path))
+    df = synthetic_frame(200)
+    df.insert(0, 'Enquiry No', [f'ENQ{i:05d}' for i in range(len(df))])
+    df['Customer Name'] = [f'Customer {i}' for i in range(len(df))]
+    return df.to_csv(index=False).encode('utf-8')
+
+
+def _store(decoded):
+    # As the page 1 upload does
+    columns = ingest.first_sheet_columns(ingest.read_header(decoded, 'export.csv'))
+    usecols = ingest.stored_columns(columns, REQUIRED + charts.used_columns() + eventstore.EVENT_COLUMNS)
+    return datastore.ingest(decoded, lambda raw: ingest.read_frame(raw, 'export.csv', usecols), columns=usecols)
+
+
+def test_non_chart_columns_reach_the_row_view(upload):
+    assert 'Enquiry No' not in charts.used_columns()
+    stored = {'key': _store(upload)}
+    rows, total = rowview.query_rows(stored, {'Dealer Location': 'Location 1'}, '{Enquiry No} contains "ENQ"', [], 0, 5)
+    assert {'Enquiry No', 'Customer Name', 'Product Family'} <= set(rowview.columns(stored))
+    assert total > 0 and all(row['Enquiry No'].startswith('ENQ') for row in rows)
+
+
+def test_row_columns_limit_what_is_kept(upload, monkeypatch):
+    monkeypatch.setattr(ingest, 'ROW_COLUMNS', ['Enquiry No'])
+    columns = rowview.columns({'key': _store(upload)})
+    assert 'Enquiry No' in columns and 'Customer Name' not in columns
+    assert set(charts.used_columns()) & set(ingest.first_sheet_columns(ingest.read_header(upload, 'export.csv'))) <= set(columns)
@@ -0,0 +1,94 @@
+"""Server-side search for the location, manager and consultant dropdowns.
+
+A group-wide dataset has thousands of consultants. Sending all of them as
+dropdown options makes every response large and the browser slow to
+filter. The dropdowns get at most ETBR_TYPEAHEAD_LIMIT options (default 50)
+instead. Each keystroke sends the dropdown's ``search_value`` to the server,
+which answers with the best matches.
+
+The index is the distinct (Location, Manager, Consultant) rows of a
+dataset, in order of first appearance, with a case-folded copy of each
+name. It is built once per dataset and worker; the warmer builds it right
+after an upload. A search is one vectorised match over those rows. The
+selected location and manager are masks on the same rows, so a consultant
+search only returns consultants under them. Names that start with the
+typed text rank first, then names with a word that starts with it, then
+any other name that contains it.
+"""
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+import singleflight
+
+LEVELS = ['Dealer Location', 'Sales Manager', 'Sales Consultant']
+LIMIT = int(os.environ.get('ETBR_TYPEAHEAD_LIMIT', 50))
+
+MAX_INDEXES = 4
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def _folded(level):
+    return f'{level} (folded)'
+
+
+def build_index(source):
+    """Index the distinct hierarchy rows of an Arrow table or DataFrame."""
+    if isinstance(source, pd.DataFrame):
+        rows = source[LEVELS].drop_duplicates()
+    else:
+        # A single-threaded group_by keeps the order of first appearance, like .unique()
+        rows = source.select(LEVELS).group_by(LEVELS, use_threads=False).aggregate([]).to_pandas()
+    rows = rows.reset_index(drop=True)
+    for level in LEVELS:
+        rows[_folded(level)] = rows[level].astype('string').str.casefold()
+    return rows
+
+
+def get_index(key, load):
+    # One index per dataset and worker; ``load`` only runs on a miss.
+    with _lock:
+        index = _indexes.get(key)
+    if index is None:
+        index = singleflight.run(('search index', key), lambda: build_index(load()), workers=False)
+        with _lock:
+            if len(_indexes) >= MAX_INDEXES:
+                _indexes.pop(next(iter(_indexes)))
+            _indexes[key] = index
+    return index
+
+
+def _candidates(index, level, filters):
+    # The levels above ``level`` narrow it down; lower levels do not
+    rows = index
+    for parent in LEVELS[:LEVELS.index(level)]:
+        value = (filters or {}).get(parent)
+        if value is not None:
+            rows = rows[rows[parent] == value]
+    return rows[[level, _folded(level)]].dropna().drop_duplicates(level)
+
+
+def search(index, level, text=None, filters=None, limit=LIMIT):
+    """Up to ``limit`` values of ``level`` under ``filters`` that contain ``text``, best matches first."""
+    rows = _candidates(index, level, filters)
+    text = (text or '').strip().casefold()
+    if text:
+        folded = rows[_folded(level)]
+        position = folded.str.find(text)
+        # 0: starts with the text, 1: a later word starts with it, 2: contains it
+        rank = pd.Series(np.select([position == 0, folded.str.contains(' ' + text, regex=False)], [0, 1], 2), index=rows.index)
+        rank = rank[position >= 0]
+        rows = rows.loc[rank.sort_values(kind='stable').index]
+    return rows[level].head(limit).tolist()
+
+
+def options(index, level, filters=None, text=None, selected=None):
+    """Dropdown options for ``level``; a valid selection is always kept among them, so it stays shown."""
+    values = search(index, level, text, filters)
+    if selected is not None and selected not in values and (_candidates(index, level, filters)[level] == selected).any():
+        values.append(selected)
+    return [{'label': value, 'value': value} for value in values]
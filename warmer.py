@@ -0,0 +1,175 @@
+"""Precompute chart aggregates for every Location / Manager / Consultant view.
+
+After an upload, a small background pool walks the hierarchy top-down: the
+unfiltered view first, then each location, each (location, manager) and
+finally each consultant. Within a level, the views with the most rows go
+first. Each view runs the aggregations of the ETBR_WARM_CHARTS charts
+(default: all page 1 charts) into ``aggcache`` and publishes them to its
+shared directory, so every worker finds them. The first click on any
+combination then only builds the figure, whichever worker answers it. The
+drill-down hierarchy (see drilldown.py) and the dropdown search index (see
+typeahead.py) are built before any of the views.
+
+* ETBR_WARM_WORKERS - warming threads per worker process (default 2, 0 disables)
+
+Only the latest upload is warmed: starting a new job cancels the previous
+one. The key of the latest job is kept in ``<ETBR_DATA_DIR>/warming``, so
+an upload to another worker cancels it too. Each view takes a heavy-job
+slot like a user request, and warming pauses while user requests are
+queued for one. The aggregate cache is an LRU of ``aggcache.MAX_ENTRIES``,
+so warming stops after the views that fill CACHE_SHARE of it. A big export then keeps its top levels cached instead of
+evicting them with its last consultants.
+"""
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import aggcache
+import backends
+import charts
+import datastore
+import drilldown
+import governor
+import typeahead
+
+logger = logging.getLogger(__name__)
+
+WARM_WORKERS = int(os.environ.get('ETBR_WARM_WORKERS', 2))
+WARM_CHARTS = [chart for chart in os.environ.get('ETBR_WARM_CHARTS', '').split(',') if chart in charts.CHARTS] or charts.ALL_CHARTS
+HIERARCHY = ['Dealer Location', 'Sales Manager', 'Sales Consultant']
+# Share of the aggregate cache warming may fill; the rest is left to the views users open
+CACHE_SHARE = 0.5
+# Key of the dataset being warmed, in whichever worker took its upload
+MARKER = os.path.join(datastore.DATA_DIR, 'warming')
+
+_executor = ThreadPoolExecutor(max_workers=WARM_WORKERS, thread_name_prefix='etbr-warm') if WARM_WORKERS else None
+_lock = threading.Lock()
+_current = {'key': None, 'cancelled': threading.Event(), 'futures': []}
+
+
+def views(counts):
+    """Filter dicts for every level of the hierarchy, top level first, busiest first within a level."""
+    ordered = [dict.fromkeys(HIERARCHY)]
+    for depth in range(1, len(HIERARCHY) + 1):
+        level = counts.groupby(level=list(range(depth))).sum().sort_values(ascending=False, kind='stable')
+        for values in level.index:
+            values = values if isinstance(values, tuple) else (values,)
+            view = dict.fromkeys(HIERARCHY)
+            view.update(zip(HIERARCHY, values))
+            ordered.append(view)
+    return ordered
+
+
+def _mark(key):
+    os.makedirs(datastore.DATA_DIR, exist_ok=True)
+    temp_path = f'{MARKER}.{uuid.uuid4().hex}'
+    with open(temp_path, 'w', encoding='utf-8') as handle:
+        handle.write(key)
+    os.replace(temp_path, MARKER)
+
+
+def _superseded(key):
+    try:
+        with open(MARKER, encoding='utf-8') as handle:
+            return handle.read() != key
+    except OSError:
+        return False
+
+
+def _part_aggregates(part, filters, plan, backend):
+    cache_key = aggcache.key(part, filters)
+    aggregates = {group_by: aggcache.get(cache_key, backend.name, group_by, metrics) for group_by, metrics in plan.items()}
+    missing = {group_by: plan[group_by] for group_by, agg in aggregates.items() if agg is None}
+    if missing:
+        aggregates.update(charts.run_plan(missing, backend.filter(datastore.attach(part), filters), backend, cache_key))
+    return aggregates
+
+
+def _warm_view(key, filters, plan, cancelled, parts=None):
+    # Let interactive requests have the CPU first
+    while governor.usage()['queued_jobs'] and not cancelled.is_set():
+        cancelled.wait(0.1)
+    if not cancelled.is_set() and _superseded(key):
+        # A later upload, maybe to another worker
+        cancelled.set()
+    if cancelled.is_set() or not datastore.exists(key):
+        return
+    backend = backends.get_backend()
+    cache_key = aggcache.key(key, filters)
+    pending = {group_by: metrics for group_by, metrics in plan.items()
+               if aggcache.get(cache_key, backend.name, group_by, metrics) is None}
+    if not pending:
+        return
+    try:
+        with governor.heavy_job():
+            if cancelled.is_set():
+                return
+            if parts:
+                # Sums are additive: combine the (mostly cached) aggregates of each part
+                per_part = [_part_aggregates(part, filters, pending, backend) for part in parts]
+                for group_by in pending:
+                    aggcache.put(cache_key, backend.name, group_by, charts.combine_aggregates([aggregates[group_by] for aggregates in per_part]))
+            else:
+                source = backend.filter(datastore.attach(key), filters)
+                charts.run_plan(pending, source, backend, cache_key)
+        for group_by in pending:
+            aggcache.publish(cache_key, backend.name, group_by)
+    except governor.ResourceLimitError:
+        # The server stayed busy; a user opening this view aggregates it then
+        logger.info(f'Skipped warming a view of dataset {key[:12]}: no free slot')
+
+
+def _schedule(key, cancelled, parts):
+    try:
+        table = datastore.attach(key)
+        if not set(HIERARCHY) <= set(table.column_names):
+            return
+        # The drill-down hierarchy first: one pass per level, then every drill step is a lookup
+        drilldown.get_hierarchy(key, lambda: table)
+        typeahead.get_index(key, lambda: table)
+        plan = charts.plan_aggregations([chart for chart in WARM_CHARTS if not charts.missing_columns(chart, table.column_names)])
+        counts = backends.get_backend().count(table, HIERARCHY)
+        ordered = views(counts)
+        # Each view caches one aggregate per group-by, and one more per part
+        per_view = max(len(plan) * (1 + len(parts or [])), 1)
+        capacity = int(aggcache.MAX_ENTRIES * CACHE_SHARE) // per_view
+        if len(ordered) > capacity:
+            logger.info(f'Warming the first {capacity} of {len(ordered)} views of dataset {key[:12]}; the aggregate cache holds no more')
+            ordered = ordered[:capacity]
+        futures = []
+        for filters in ordered:
+            if cancelled.is_set():
+                return
+            futures.append(_executor.submit(_warm_view, key, filters, plan, cancelled, parts))
+        with _lock:
+            if _current['key'] == key:
+                _current['futures'] = futures
+        logger.info(f'Warming {len(futures)} views of dataset {key[:12]}')
+    except Exception:
+        logger.exception(f'Could not warm dataset {key[:12]}')
+
+
+def cancel():
+    with _lock:
+        _current['cancelled'].set()
+        for future in _current['futures']:
+            future.cancel()
+        _current['futures'] = []
+
+
+def start(key, parts=None):
+    """Warm ``key`` in the background, cancelling any earlier warming job.
+
+    ``parts`` are the keys of datasets whose concatenation is ``key`` (see
+    dropfolder.py); views are then summed from per-part aggregates.
+    """
+    if _executor is None:
+        return
+    cancel()
+    cancelled = threading.Event()
+    with _lock:
+        _current.update(key=key, cancelled=cancelled, futures=[])
+    _mark(key)
+    threading.Thread(target=_schedule, args=(key, cancelled, parts), daemon=True).start()
@@ -0,0 +1,47 @@
+"""Uploaded workbooks kept on the server, so a later chart can parse another sheet.
+
+Exports often bundle enquiries, follow-ups and exchange data as separate
+sheets. An upload is written once under its content hash, next to the
+datasets. The browser only keeps a small description of it: the hash, the
+file name and the header row of every sheet. When a chart is opened, it
+picks the sheet that has its columns (``ingest.find_sheet``) and parses
+that sheet alone. The parsed sheet is a dataset keyed by the workbook hash,
+the sheet name and the column projection, so every later request, page and
+worker reuses it. Sheets no chart needs are never parsed.
+"""
+import os
+import uuid
+
+import datastore
+import ingest
+
+WORKBOOK_DIR = os.path.join(datastore.DATA_DIR, 'workbooks')
+
+
+def _path(digest):
+    return os.path.join(WORKBOOK_DIR, digest)
+
+
+def remember(decoded, filename, header=None):
+    """Keep the upload on disk and return its description for a ``dcc.Store``."""
+    digest = datastore.content_hash(decoded)
+    path = _path(digest)
+    if not os.path.exists(path):
+        os.makedirs(WORKBOOK_DIR, exist_ok=True)
+        temp_path = f'{path}.{uuid.uuid4().hex}'
+        with open(temp_path, 'wb') as handle:
+            handle.write(decoded)
+        os.replace(temp_path, path)
+    if header is None:
+        header = ingest.read_header(decoded, filename)
+    # Pairs rather than a mapping: the JSON encoder sorts keys, and sheet order decides the fallback sheet
+    return {'workbook': digest, 'filename': filename, 'sheets': [[sheet, columns] for sheet, columns in header.items()]}
+
+
+def exists(workbook):
+    return bool(workbook) and datastore.KEY_PATTERN.match(workbook.get('workbook') or '') is not None and os.path.exists(_path(workbook['workbook']))
+
+
+def read(workbook):
+    with open(_path(workbook['workbook']), 'rb') as handle:
+        return handle.read()